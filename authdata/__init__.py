@@ -28,3 +28,4 @@ Auth Data service is an abstraction of actual data store, or multiple datastores
 which contain user identity and role information.
 """
 
+default_app_config = 'authdata.apps.AuthDataConfig'
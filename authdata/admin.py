@@ -35,6 +35,7 @@ from authdata.models import Source
 from authdata.models import User
 from authdata.models import Attribute
 from authdata.models import UserAttribute
+from authdata.models import PendingProvision
 
 
 class MunicipalityAdmin(admin.ModelAdmin):
@@ -76,6 +77,13 @@ class SourceAdmin(admin.ModelAdmin):
     list_display = ('name',)
 
 
+class PendingProvisionAdmin(admin.ModelAdmin):
+    """PendingProvisionAdmin"""
+    list_display = ('username', 'external_source', 'external_id', 'created')
+    list_filter = ('external_source',)
+    search_fields = ('username', 'external_id')
+
+
 class UserAttributeInline(admin.TabularInline):
     model = UserAttribute
     extra = 0
@@ -120,4 +128,5 @@ admin.site.register(Source, SourceAdmin)
 admin.site.register(User, UserAdmin)
 admin.site.register(Attribute, AttributeAdmin)
 admin.site.register(UserAttribute, UserAttributeAdmin)
+admin.site.register(PendingProvision, PendingProvisionAdmin)
 
@@ -0,0 +1,43 @@
+
+# -*- coding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2014-2015 Haltu Oy, http://haltu.fi
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+from django.apps import AppConfig
+
+
+class AuthDataConfig(AppConfig):
+  name = 'authdata'
+  verbose_name = 'Auth Data'
+
+  def ready(self):
+    # External data source handlers are created once per process
+    from authdata.datasources import registry
+    registry.load()
+    # Connect the signal handlers invalidating cached query responses,
+    # updating the lookup filters and bumping User.last_changed
+    from authdata import changelog  # pylint: disable=unused-variable
+    from authdata import query_cache  # pylint: disable=unused-variable
+    from authdata import lookup_filter  # pylint: disable=unused-variable
+
+# vim: tabstop=2 expandtab shiftwidth=2 softtabstop=2
@@ -0,0 +1,166 @@
+# -*- encoding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2014-2015 Haltu Oy, http://haltu.fi
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+"""
+Read path benchmarks, run with ``manage.py benchmark``.
+
+The query endpoint is queried by attribute and by username and the user
+endpoint listed by municipality, school, group and ``changed_at`` through
+the Django test client, using data created by ``manage.py create_test_data``.
+The client has the name of the source of the data, so the user endpoint
+returns the attributes. The ``query_username_cold`` scenario queries users
+without stored documents and with the query response cache disabled, which
+measures building responses from the tables.
+For each scenario the latency percentiles, the mean number of queries per
+request and the throughput are reported. Results are compared to a baseline
+saved by an earlier run: more queries per request, or latency or throughput
+worse than the tolerance allows, is a regression.
+"""
+
+import math
+import time
+
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+
+from authdata.models import User, UserAttribute, Municipality, School, Attendance, UserDocument
+
+# Requests whose queries are counted. They are not timed, since counting
+# queries slows requests down.
+COUNTED_REQUESTS = 5
+
+
+def percentile(values, p):
+  """ Returns the p:th percentile of values by the nearest rank method """
+  values = sorted(values)
+  rank = int(math.ceil(p / 100.0 * len(values))) - 1
+  return values[max(0, min(rank, len(values) - 1))]
+
+
+def get_paths(rng, count):
+  """ Returns the request paths of each scenario
+
+  Each scenario has count + COUNTED_REQUESTS different paths, so that
+  responses are not read from caches filled by earlier requests.
+  """
+  count += COUNTED_REQUESTS
+  pks = list(User.objects.order_by('pk').values_list('pk', flat=True))
+  users = dict(User.objects.filter(pk__in=[rng.choice(pks) for _ in xrange(count)]).values_list('pk', 'username'))
+  usernames = [users[pk] for pk in sorted(users)]
+  attributes = list(UserAttribute.objects.filter(user__in=users.keys()).order_by('pk')
+      .values_list('attribute__name', 'value'))
+  municipalities = list(Municipality.objects.order_by('pk').values_list('name', flat=True))
+  schools = list(School.objects.order_by('pk').values_list('name', flat=True))
+  groups = sorted(Attendance.objects.values_list('group', flat=True).distinct())
+  now = time.time()
+  paths = {
+    'query_attribute': ['/api/1/query?%s=%s' % rng.choice(attributes) for _ in xrange(count)],
+    'query_username': ['/api/1/query/%s' % rng.choice(usernames) for _ in xrange(count)],
+    'user_municipality': ['/api/1/user/?municipality=%s' % rng.choice(municipalities) for _ in xrange(count)],
+    'user_school': ['/api/1/user/?school=%s' % rng.choice(schools) for _ in xrange(count)],
+    'user_group': ['/api/1/user/?group=%s' % rng.choice(groups) for _ in xrange(count)],
+    'user_changed_at': ['/api/1/user/?changed_at=%d' % (now - rng.randint(0, 3600)) for _ in xrange(count)],
+  }
+  paths['query_username_cold'] = ['/api/1/query/%s' % rng.choice(usernames) for _ in xrange(count)]
+  return paths
+
+
+def run_scenario(client, paths):
+  """ Requests paths and returns the measurements """
+  queries = []
+  for path in paths[:COUNTED_REQUESTS]:
+    with CaptureQueriesContext(connection) as captured:
+      response = client.get(path)
+    if response.status_code != 200:
+      raise AssertionError('%s returned %d' % (path, response.status_code))
+    queries.append(len(captured))
+  latencies = []
+  for path in paths[COUNTED_REQUESTS:]:
+    started = time.time()
+    response = client.get(path)
+    latencies.append(time.time() - started)
+    if response.status_code != 200:
+      raise AssertionError('%s returned %d' % (path, response.status_code))
+  return {
+    'p50': percentile(latencies, 50) * 1000,
+    'p95': percentile(latencies, 95) * 1000,
+    'p99': percentile(latencies, 99) * 1000,
+    'queries': float(sum(queries)) / len(queries),
+    'throughput': len(latencies) / sum(latencies),
+  }
+
+
+def run_cold_scenario(client, paths):
+  """ Requests /query/<username> paths of users without stored documents """
+  UserDocument.objects.filter(user__username__in=[path.rsplit('/', 1)[1] for path in paths]).delete()
+  with override_settings(AUTHDATA_QUERY_CACHE=None):
+    return run_scenario(client, paths)
+
+
+def run(user, rng, count):
+  """ Runs all scenarios as user with count timed requests each
+
+  External sources are not bound to any attributes or municipalities
+  meanwhile, only the local database is benchmarked.
+  """
+  client = APIClient()
+  client.force_authenticate(user=user)
+  paths = get_paths(rng, count)
+  results = {}
+  with override_settings(AUTH_EXTERNAL_ATTRIBUTE_BINDING={}, AUTH_EXTERNAL_MUNICIPALITY_BINDING={}):
+    for name in sorted(paths):
+      if name == 'query_username_cold':
+        results[name] = run_cold_scenario(client, paths[name])
+      else:
+        results[name] = run_scenario(client, paths[name])
+  return results
+
+
+def compare(results, baseline, tolerance):
+  """ Returns the regressions of results compared to baseline
+
+  Both are dicts of scale: scenario: measurements. Scales and scenarios
+  missing from either are skipped.
+  """
+  regressions = []
+  for scale, scenarios in sorted(results.iteritems()):
+    for name, result in sorted(scenarios.iteritems()):
+      base = baseline.get(scale, {}).get(name)
+      if not base:
+        continue
+      if result['queries'] > base['queries']:
+        regressions.append('%s %s: %.1f queries per request, was %.1f' % (scale, name, result['queries'], base['queries']))
+      for key in ('p50', 'p95', 'p99'):
+        if result[key] > base[key] * (1 + tolerance):
+          regressions.append('%s %s: %s %.1f ms, was %.1f ms' % (scale, name, key, result[key], base[key]))
+      if result['throughput'] < base['throughput'] * (1 - tolerance):
+        regressions.append('%s %s: %.0f requests/s, was %.0f' % (scale, name, result['throughput'], base['throughput']))
+  return regressions
+
+
+# vim: tabstop=2 expandtab shiftwidth=2 softtabstop=2
+
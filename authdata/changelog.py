@@ -0,0 +1,124 @@
+# -*- encoding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2014-2015 Haltu Oy, http://haltu.fi
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+"""
+``User.last_changed`` is bumped in the same transaction as every change to
+the data of a user, so the ``changed_at`` filter of the user listing needs
+no joins. Saving a user sets it itself. Saving or deleting a user attribute
+or an attendance bumps it for its user, so clients syncing with
+``changed_at`` learn about removed rows too. Changing an attribute, role,
+school or municipality bumps it for every user referring to it with one
+UPDATE per write.
+
+The stored query responses of the users are rebuilt in the same transaction,
+see :py:mod:`authdata.documents`.
+
+Bulk writes which do not send signals do both with
+:py:func:`authdata.signals.bulk_written`.
+"""
+
+import logging
+
+from django.db import connection
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from authdata import documents
+from authdata.models import User, UserAttribute, Attendance, Attribute, Role, School, Municipality
+
+LOG = logging.getLogger(__name__)
+
+
+def record(user_ids):
+  """ Bumps last_changed of user_ids and rebuilds their documents """
+  user_ids = set(user_ids)
+  if not user_ids:
+    return
+  User.objects.filter(pk__in=user_ids).update(last_changed=timezone.now())
+  documents.refresh(user_ids)
+
+
+def _record_related(select, params):
+  # UPDATE ... IN so that the affected users are never loaded to memory
+  now = connection.ops.value_to_db_datetime(timezone.now())
+  cursor = connection.cursor()
+  cursor.execute('UPDATE authdata_user SET last_changed = %%s WHERE id IN (SELECT user_id %s)' % select, [now] + params)
+  LOG.debug('Related change recorded', extra={'data': {'users': cursor.rowcount}})
+  cursor.execute('SELECT DISTINCT user_id %s' % select, params)
+  documents.refresh([row[0] for row in cursor.fetchall()])
+
+
+@receiver(post_save, sender=User)
+def _user_saved(sender, instance, **kwargs):  # pylint: disable=unused-argument
+  # Saving a user sets last_changed already
+  documents.refresh([instance.pk])
+
+
+@receiver(post_save, sender=UserAttribute)
+@receiver(post_save, sender=Attendance)
+def _user_row_saved(sender, instance, **kwargs):  # pylint: disable=unused-argument
+  record([instance.user_id])
+
+
+@receiver(post_delete, sender=UserAttribute)
+@receiver(post_delete, sender=Attendance)
+def _user_row_deleted(sender, instance, **kwargs):  # pylint: disable=unused-argument
+  # The user may be being deleted too, a document built now would refer to
+  # the deleted user
+  User.objects.filter(pk=instance.user_id).update(last_changed=timezone.now())
+  documents.discard([instance.user_id])
+
+
+# Deleting these deletes the referring rows, which bump last_changed themselves.
+# A new attribute, role, school or municipality has no users yet.
+
+@receiver(post_save, sender=Attribute)
+def _attribute_saved(sender, instance, created, **kwargs):  # pylint: disable=unused-argument
+  if not created:
+    _record_related('FROM authdata_userattribute WHERE attribute_id = %s', [instance.pk])
+
+
+@receiver(post_save, sender=Role)
+def _role_saved(sender, instance, created, **kwargs):  # pylint: disable=unused-argument
+  if not created:
+    _record_related('FROM authdata_attendance WHERE role_id = %s', [instance.pk])
+
+
+@receiver(post_save, sender=School)
+def _school_saved(sender, instance, created, **kwargs):  # pylint: disable=unused-argument
+  if not created:
+    _record_related('FROM authdata_attendance WHERE school_id = %s', [instance.pk])
+
+
+@receiver(post_save, sender=Municipality)
+def _municipality_saved(sender, instance, created, **kwargs):  # pylint: disable=unused-argument
+  if not created:
+    _record_related('FROM authdata_attendance WHERE school_id IN '
+                    '(SELECT id FROM authdata_school WHERE municipality_id = %s)', [instance.pk])
+
+
+# vim: tabstop=2 expandtab shiftwidth=2 softtabstop=2
+
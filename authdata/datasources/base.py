@@ -23,24 +23,202 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import copy
 import logging
-from authdata.models import User, Source, Attribute, UserAttribute
+import threading
+import time
+from collections import OrderedDict, deque
+from django.conf import settings
+from django.db import IntegrityError
+from django.db import connection
+from django.db import transaction
+from django.db.models import Case, When, Value
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+from authdata import signals
+from authdata.models import User, Source, Attribute, UserAttribute, hash_value
+from authdata.datasources import provisioning
 
 LOG = logging.getLogger(__name__)
 
 
+class CursorExpired(Exception):
+  """The paging cursor of a user listing can no longer be continued"""
+
+
+class FingerprintCache(object):
+  """
+  Bounded set which forgets the least recently used entries first.
+  """
+
+  def __init__(self, maxsize):
+    self.maxsize = maxsize
+    self.entries = OrderedDict()
+    self.lock = threading.Lock()
+
+  def __contains__(self, key):
+    with self.lock:
+      if key not in self.entries:
+        return False
+      del self.entries[key]
+      self.entries[key] = True
+      return True
+
+  def __len__(self):
+    return len(self.entries)
+
+  def add(self, key):
+    with self.lock:
+      self.entries.pop(key, None)
+      self.entries[key] = True
+      while len(self.entries) > self.maxsize:
+        self.entries.popitem(last=False)
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+
+
+class DataCache(object):
+  """
+  Bounded cache of user data fetched from an external source.
+
+  An entry is fresh for ``ttl`` seconds. After that the stale entry is still
+  returned while a background thread fetches it again. If fetching raises,
+  e.g. the source can not be reached, the stale entry is kept and served
+  until it is ``max_age`` seconds old. Older entries are fetched before
+  returning. If the user is no longer found the entry is removed.
+
+  Stale keys are fetched one at a time by a single thread per cache. At most
+  ``queue_size`` keys wait to be fetched, further stale entries are served
+  as is until a later request finds room in the queue.
+
+  A ``ttl`` of 0 disables caching.
+  """
+
+  def __init__(self, fetch, ttl, max_age, maxsize, queue_size=100, start_worker=True):
+    self.fetch = fetch
+    self.ttl = ttl
+    self.max_age = max(ttl, max_age)
+    self.maxsize = maxsize
+    self.queue_size = queue_size
+    self.start_worker = start_worker
+    self.entries = OrderedDict()  # key: (fetched at, data)
+    self.refreshing = set()  # keys queued or being fetched
+    self.queue = deque()
+    self.lock = threading.Lock()
+    self.cond = threading.Condition(self.lock)
+    self.worker = None
+
+  def get(self, key):
+    if not self.ttl:
+      return self.fetch(key)
+    with self.lock:
+      entry = self.entries.pop(key, None)
+      if entry is not None:
+        self.entries[key] = entry
+    if entry is None or time.time() - entry[0] >= self.max_age:
+      data = self.fetch(key)
+      self._store(key, data)
+      return data
+    if time.time() - entry[0] >= self.ttl:
+      self._start_refresh(key)
+    # Callers are free to modify the returned data
+    return copy.deepcopy(entry[1])
+
+  def _store(self, key, data):
+    with self.lock:
+      self.entries.pop(key, None)
+      if data is None:
+        return
+      self.entries[key] = (time.time(), copy.deepcopy(data))
+      while len(self.entries) > self.maxsize:
+        self.entries.popitem(last=False)
+
+  def _start_refresh(self, key):
+    with self.cond:
+      if key in self.refreshing or len(self.queue) >= self.queue_size:
+        return
+      self.refreshing.add(key)
+      self.queue.append(key)
+      self.cond.notify()
+      if self.start_worker and self.worker is None:
+        self.worker = threading.Thread(target=self._run, name='authdata-data-cache')
+        self.worker.daemon = True
+        self.worker.start()
+
+  def _run(self):
+    while True:
+      self.work()
+      # Fetching provisions users using a connection of this thread
+      connection.close()
+
+  def work(self):
+    """Fetch the next queued key, waiting for one if the queue is empty"""
+    with self.cond:
+      while not self.queue:
+        self.cond.wait()
+      key = self.queue.popleft()
+    self.refresh(key)
+
+  def refresh(self, key):
+    try:
+      # None removes the entry of a user no longer found
+      self._store(key, self.fetch(key))
+    except Exception:  # pylint: disable=broad-except
+      # Upstream is down or timed out, keep serving the stale entry
+      LOG.warning('Could not refresh external user data', exc_info=True,
+          extra={'data': {'key': repr(key)}})
+    finally:
+      with self.lock:
+        self.refreshing.discard(key)
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+
+
+# (external_source, oid, external_id) of users known to be provisioned
+stored_users = FingerprintCache(getattr(settings, 'AUTHDATA_PROVISIONING_CACHE_SIZE', 100000))
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+@receiver(post_save, sender=UserAttribute)
+@receiver(post_delete, sender=UserAttribute)
+def _clear_stored_users(sender, **kwargs):  # pylint: disable=unused-argument
+  # Users or their attributes were changed outside provisioning
+  stored_users.clear()
+
+
 class ExternalDataSource(object):
   """
   An external user attribute source. The source is identified by a specific
   attribute name, which is configured in the project settings.
 
   This is a base class for all external data sources
+
+  Optional configuration parameters for caching :py:meth:`get_data`, see
+  :py:class:`DataCache`:
+
+  * cache_ttl: seconds the fetched data is used as is (default 60, 0
+    disables caching)
+  * cache_max_age: seconds stale data is served while the source can not
+    be reached (default 3600)
+  * cache_size: number of users kept in the cache (default 10000)
+  * cache_queue_size: number of stale users waiting to be fetched again
+    (default 100)
   """
 
   external_source = ''
 
   def __init__(self, *args, **kwargs):
-    pass
+    self.data_cache = DataCache(self.get_data,
+        ttl=kwargs.get('cache_ttl', 60),
+        max_age=kwargs.get('cache_max_age', 3600),
+        maxsize=kwargs.get('cache_size', 10000),
+        queue_size=kwargs.get('cache_queue_size', 100))
 
   def get_oid(self, username):
     """
@@ -58,6 +236,12 @@ class ExternalDataSource(object):
     """
     raise NotImplementedError
 
+  def get_cached_data(self, external_id):
+    """
+    Get user data like :py:meth:`get_data`, from the cache when possible.
+    """
+    return self.data_cache.get(external_id)
+
   def get_user_data(self, request):
     """
     Query for a user listing.
@@ -73,31 +257,146 @@ class ExternalDataSource(object):
     oid: MPASS identifier
     external_id: id of the user in the external data source
     """
+    self.provision_users([(oid, external_id)])
 
-    user_obj, new_user_created = User.objects.get_or_create(username=oid)
-    LOG.debug('User provision',
-            extra={'data':
-                   {'oid': oid, 'external_id': external_id,
-                    'external_source': self.external_source,
-                    'new_user_created': new_user_created,
-                    }})
-    user_obj.external_id = external_id
-    user_obj.external_source = self.external_source
-    user_obj.save()
+  def provision_users(self, batch):
+    """
+    Save a batch of fetched users to local db
+
+    batch: iterable of (oid, external_id) tuples
+
+    Users are written before returning unless deferred provisioning is
+    enabled, see :py:mod:`authdata.datasources.provisioning`.
+
+    Users already known to be stored are remembered in ``stored_users`` and
+    skipped without touching the database. For the rest one query checks
+    which of them are already stored before anything is written.
+    """
+    batch = [(oid, external_id) for oid, external_id in batch
+        if (self.external_source, oid, external_id) not in stored_users]
+    if not batch:
+      return
+    batch = self._unstored_users(batch)
+    if not batch:
+      return
+    if provisioning.is_deferred():
+      provisioning.get_queue().put(self.external_source, batch)
+    else:
+      self.save_users(batch)
 
+  def _unstored_users(self, batch):
+    """
+    Return the users in batch which are missing from the database or have a
+    different external id.
+    """
+    external_ids = OrderedDict(batch)
+    stored = UserAttribute.objects.filter(
+        user__username__in=external_ids.keys(),
+        user__external_source=self.external_source,
+        attribute__name=self.external_source,
+        data_source__name='local').values_list('user__username', 'user__external_id', 'value')
+    for username, user_external_id, value in stored:
+      external_id = external_ids.get(username)
+      if external_id is not None and user_external_id == external_id and value == external_id:
+        del external_ids[username]
+        self._remember(username, external_id)
+    return external_ids.items()
+
+  def _remember(self, oid, external_id):
+    # Only committed data can be trusted to stay in the database
+    if not transaction.get_connection().in_atomic_block:
+      stored_users.add((self.external_source, oid, external_id))
+
+  def save_users(self, batch):
+    """
+    Write a batch of fetched users to local db
+
+    batch: iterable of (oid, external_id) tuples
+
+    Source and Attribute are resolved once for the batch, existing users and
+    their external id attributes are fetched with one query each and only
+    missing or changed rows are written. Everything happens in one
+    transaction.
+    """
+    external_ids = OrderedDict()
+    for oid, external_id in batch:
+      external_ids[oid] = external_id
+    if not external_ids:
+      return
+
+    try:
+      with transaction.atomic():
+        self._provision_users(external_ids)
+    except IntegrityError:
+      # Another request provisioned some of the same users at the same time
+      LOG.warning('Bulk provision failed, provisioning one by one',
+          extra={'data': {'external_source': self.external_source,
+                          'count': len(external_ids)}})
+      with transaction.atomic():
+        for oid, external_id in external_ids.iteritems():
+          self._provision_users(OrderedDict([(oid, external_id)]))
+    for oid, external_id in external_ids.iteritems():
+      self._remember(oid, external_id)
+
+  def _provision_users(self, external_ids):
+    now = timezone.now()
     source_obj, _ = Source.objects.get_or_create(name='local')
     attribute_obj, _ = Attribute.objects.get_or_create(name=self.external_source)
 
-    user_attr_obj, _ = UserAttribute.objects.get_or_create(user=user_obj,
-        attribute=attribute_obj, data_source=source_obj)
-    user_attr_obj.value = external_id
-    user_attr_obj.save()
+    users = {u.username: u for u in User.objects.filter(username__in=external_ids.keys())}
+    new_users = [User(username=oid, external_id=external_id, external_source=self.external_source)
+        for oid, external_id in external_ids.iteritems() if oid not in users]
+    changed_users = [u for u in users.itervalues()
+        if u.external_id != external_ids[u.username] or u.external_source != self.external_source]
+    new_users_saved = []
+    if new_users:
+      User.objects.bulk_create(new_users)
+      new_users_saved = list(User.objects.filter(username__in=[u.username for u in new_users]))
+      users.update((u.username, u) for u in new_users_saved)
+    if changed_users:
+      User.objects.filter(pk__in=[u.pk for u in changed_users]).update(
+          external_id=Case(*[When(pk=u.pk, then=Value(external_ids[u.username])) for u in changed_users]),
+          external_source=self.external_source,
+          modified=now,
+          last_changed=now)
+    LOG.debug('User provision',
+        extra={'data':
+               {'external_source': self.external_source,
+                'new_users_created': len(new_users),
+                'users_updated': len(changed_users),
+                }})
+
+    values = {u.pk: external_ids[u.username] for u in users.itervalues()}
+    users_with_attribute = set()
+    changed_attributes = {}
+    changed_attribute_users = []
+    for pk, user_id, value in UserAttribute.objects.filter(user__in=values.keys(),
+        attribute=attribute_obj, data_source=source_obj).values_list('pk', 'user_id', 'value'):
+      users_with_attribute.add(user_id)
+      if value != values[user_id]:
+        changed_attributes[pk] = values[user_id]
+        changed_attribute_users.append(user_id)
+    new_attributes = [UserAttribute(user_id=user_id, attribute=attribute_obj,
+        data_source=source_obj, value=value, value_hash=hash_value(value))
+        for user_id, value in values.iteritems() if user_id not in users_with_attribute]
+    if new_attributes:
+      UserAttribute.objects.bulk_create(new_attributes)
+    if changed_attributes:
+      UserAttribute.objects.filter(pk__in=changed_attributes.keys()).update(
+          value=Case(*[When(pk=pk, then=Value(value)) for pk, value in changed_attributes.iteritems()]),
+          value_hash=Case(*[When(pk=pk, then=Value(hash_value(value))) for pk, value in changed_attributes.iteritems()]),
+          modified=now)
     LOG.debug('User attribute added',
         extra={'data':
-              {'oid': oid, 'external_id': external_id,
-               'external_source': self.external_source,
-               'new_user_created': new_user_created,
-               'source_name': 'local'}})
+              {'external_source': self.external_source,
+               'source_name': 'local',
+               'new_attributes_created': len(new_attributes),
+               'attributes_updated': len(changed_attributes),
+               }})
+    signals.bulk_written([u.pk for u in new_users_saved] + [u.pk for u in changed_users], bump=False)
+    signals.bulk_written([a.user_id for a in new_attributes] + changed_attribute_users,
+        [(attribute_obj.pk, a.value) for a in new_attributes] +
+        [(attribute_obj.pk, value) for value in changed_attributes.itervalues()])
 
 
 # vim: tabstop=2 expandtab shiftwidth=2 softtabstop=2
@@ -123,7 +123,11 @@ Example response from Dreamschool::
 
 import logging
 import hashlib
+import threading
+from collections import OrderedDict
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 
 from django.conf import settings
 
@@ -141,17 +145,127 @@ class DreamschoolDataSource(ExternalDataSource):
   * api_url
   * username
   * password
+
+  Optional configuration parameters:
+
+  * pool_size: number of keep-alive connections to the API (default 10)
+  * connect_timeout: seconds to wait for a connection (default 5)
+  * read_timeout: seconds to wait for a response (default 30)
+  * retries: how many times 502 and 503 responses and connection errors are
+    retried (default 2)
+  * backoff_factor: retries wait ``backoff_factor * 2 ** (retry - 1)``
+    seconds (default 0.5)
+  * conditional_cache_size: number of responses kept for conditional
+    requests (default 100)
+  * cache_ttl, cache_max_age, cache_size, cache_queue_size: see
+    :py:class:`authdata.datasources.base.ExternalDataSource`
+
+  All requests go through one ``requests.Session`` which is shared by the
+  worker threads. Responses carrying an ``ETag`` or ``Last-Modified`` header
+  are remembered and the next request to the same URL is made conditional,
+  so an unchanged resource is answered with ``304 Not Modified``.
   """
 
   external_source = 'dreamschool'
 
   def __init__(self, api_url, username, password, *args, **kwargs):
-    self.request = None
     self.api_url = api_url
     self.username = username
     self.password = password
+    self.timeout = (kwargs.get('connect_timeout', 5), kwargs.get('read_timeout', 30))
+    self.conditional_cache_size = kwargs.get('conditional_cache_size', 100)
+    self.conditional_cache = OrderedDict()
+    self.conditional_cache_lock = threading.Lock()
+    self.session = self._create_session(
+        pool_size=kwargs.get('pool_size', 10),
+        retries=kwargs.get('retries', 2),
+        backoff_factor=kwargs.get('backoff_factor', 0.5))
+    super(DreamschoolDataSource, self).__init__(*args, **kwargs)
 
   # PRIVATE METHODS
+  def _create_session(self, pool_size, retries, backoff_factor):
+    session = requests.Session()
+    session.auth = (self.username, self.password)
+    session.headers.update({'Accept-Encoding': 'gzip, deflate'})
+    retry = Retry(total=retries, backoff_factor=backoff_factor,
+        status_forcelist=[502, 503])
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+  def _fetch(self, url, params=None):
+    """
+    GET ``url`` from the API and return the decoded JSON data.
+
+    Returns None if the response is not OK, e.g. the user is not found, or
+    the response can not be parsed. Raises ``requests.RequestException`` if
+    the request fails or the API responds with a server error, so that
+    callers can tell an unavailable API from a missing user.
+    """
+    params = params or {}
+    cache_key = (url, tuple(sorted(params.items())))
+    headers = {}
+    with self.conditional_cache_lock:
+      cached = self.conditional_cache.get(cache_key)
+    if cached is not None:
+      etag, last_modified, _ = cached
+      if etag:
+        headers['If-None-Match'] = etag
+      if last_modified:
+        headers['If-Modified-Since'] = last_modified
+
+    try:
+      r = self.session.get(url, params=params, headers=headers, timeout=self.timeout)
+    except requests.RequestException:
+      LOG.exception('Dreamschool API request failed', extra={'data':
+        {'url': url,
+         'params': params,
+         }})
+      raise
+
+    LOG.debug('Fetched from dreamschool', extra={'data':
+      {'url': url,
+       'params': params,
+       'status_code': r.status_code,
+       }})
+
+    if cached is not None and r.status_code == requests.codes.not_modified:
+      return cached[2]
+
+    if r.status_code >= 500:
+      LOG.warning('Dreamschool API server error', extra={'data':
+        {'status_code': r.status_code,
+         'url': url,
+         'params': params,
+         }})
+      raise requests.HTTPError('Dreamschool API responded %d' % r.status_code, response=r)
+
+    if r.status_code != requests.codes.ok:
+      LOG.warning('Dreamschool API response not OK', extra={'data':
+        {'status_code': r.status_code,
+         'url': url,
+         'username': self.username,
+         'params': params,
+         }})
+      return None
+
+    try:
+      data = r.json()
+    except ValueError:
+      LOG.exception('Could not parse user data from dreamschool API')
+      return None
+
+    etag = r.headers.get('ETag')
+    last_modified = r.headers.get('Last-Modified')
+    with self.conditional_cache_lock:
+      self.conditional_cache.pop(cache_key, None)
+      if etag or last_modified:
+        self.conditional_cache[cache_key] = (etag, last_modified, data)
+        while len(self.conditional_cache) > self.conditional_cache_size:
+          self.conditional_cache.popitem(last=False)
+    return data
+
   def _get_municipality_by_org_id(self, org_id):
     org_id = int(org_id)
     LOG.debug('Fetching municipality for org_id',
@@ -252,7 +366,6 @@ class DreamschoolDataSource(ExternalDataSource):
     Returns a list of users based on request.GET filtering values
     """
 
-    self.request = request
     school = u''
     group = u''
     municipality = request.GET['municipality'].lower()
@@ -262,9 +375,6 @@ class DreamschoolDataSource(ExternalDataSource):
     if 'group' in request.GET:
       group = unicode(request.GET['group'])
 
-    url = self.api_url
-    username = self.username
-    password = self.password
     org_id = self._get_org_id(municipality, school)
 
     params = {}
@@ -274,39 +384,14 @@ class DreamschoolDataSource(ExternalDataSource):
       }
       if group:
         params['user_groups__title__icontains'] = group
-      r = requests.get(url, auth=(username, password), params=params)
-    else:
-      # This may fail to proxy timeout error
-      # TODO: Catch status code 502 Proxy error
-      r = requests.get(url, auth=(username, password))
-
-    LOG.debug('Fetched from dreamschool', extra={'data':
-      {'api_url': self.api_url,
-       'params': params,
-       'status_code': r.status_code,
-       }})
 
-    if r.status_code != requests.codes.ok:
-      LOG.warning('Dreamschool API response not OK', extra={'data':
-        {'status_code': r.status_code,
-         'municipality': repr(municipality),
-         'api_url': self.api_url,
-         'username': self.username,
-         'params': params,
-         }})
-      return {
-        'count': 0,
-        'next': None,
-        'previous': None,
-        'results': [],
-      }
-
-    response = []
-    user_data = {}
+    # Without org_id the whole user list is fetched. This may take until
+    # the read timeout.
     try:
-      user_data = r.json()
-    except ValueError:
-      LOG.exception('Could not parse user data from dreamschool API')
+      user_data = self._fetch(self.api_url, params)
+    except requests.RequestException:
+      user_data = None
+    if user_data is None:
       return {
         'count': 0,
         'next': None,
@@ -314,6 +399,8 @@ class DreamschoolDataSource(ExternalDataSource):
         'results': [],
       }
 
+    response = []
+    provisioned = []
     for d in user_data['objects']:
       user_id = d['id']
       username = d['username']
@@ -331,9 +418,10 @@ class DreamschoolDataSource(ExternalDataSource):
         'roles': roles,
         'attributes': attributes
       })
+      provisioned.append((oid, external_id))
 
-      # On Demand provisioning of the users
-      self.provision_user(oid, external_id)
+    # On Demand provisioning of the users
+    self.provision_users(provisioned)
 
     # TODO: support actual paging via SimplePagedResultsControl
     return {
@@ -349,29 +437,9 @@ class DreamschoolDataSource(ExternalDataSource):
     external_id: user id in dreamschool
     """
     url = self.api_url + external_id + '/'  # TODO: use join
-    username = self.username
-    password = self.password
-
-    r = requests.get(url, auth=(username, password))
-
-    LOG.debug('Fetched from dreamschool', extra={'data':
-      {'url': url,
-       'status_code': r.status_code,
-       }})
 
-    if r.status_code != requests.codes.ok:
-      LOG.warning('Dreamschool API response not OK', extra={'data':
-        {'status_code': r.status_code,
-         'url': url,
-         'username': self.username,
-         }})
-      return None
-
-    user_data = {}
-    try:
-      user_data = r.json()
-    except ValueError:
-      LOG.exception('Could not parse user data from dreamschool API')
+    user_data = self._fetch(url)
+    if user_data is None:
       return None
 
     d = user_data
@@ -380,7 +448,7 @@ class DreamschoolDataSource(ExternalDataSource):
     last_name = d['last_name']
     attributes = [
     ]
-    roles = self._get_roles(d)
+    roles = list(self._get_roles(d))
 
     # On Demand provisioning of the user
     external_id = str(d['id'])
@@ -23,14 +23,153 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import collections
 import hashlib
 import logging
 import string
-from authdata.datasources.base import ExternalDataSource
+import threading
+import time
+import uuid
+from rest_framework.utils.urls import replace_query_param
+from authdata.datasources.base import ExternalDataSource, CursorExpired
+from authdata.pagination import get_page_size
 
 LOG = logging.getLogger(__name__)
 
 
+class PoolTimeout(Exception):
+  """No pooled connection became available in time"""
+
+
+class LDAPConnectionPool(object):
+  """
+  Bounded, thread-safe pool of bound LDAP connections.
+
+  ``factory`` is called to open and bind a new connection and ``validate``
+  is called with an idle connection when it is checked out. Connections that
+  fail validation or have been idle longer than ``max_idle`` seconds are
+  closed and replaced with new ones. At most ``size`` connections are open
+  at a time, ``acquire`` waits up to ``timeout`` seconds for one to be
+  released before raising :py:class:`PoolTimeout`.
+
+  A connection holding server side state, such as an unfinished paged
+  search, can be parked under a key with :py:meth:`park` and picked up by a
+  later request with :py:meth:`unpark`. Parked connections count against
+  ``size``; they are closed after ``max_idle`` seconds or when their slot is
+  needed for a new connection.
+
+  .. automethod:: __init__
+  """
+
+  def __init__(self, factory, validate, size=10, max_idle=300, timeout=10):
+    """
+    Args:
+        factory (callable): returns a new bound connection
+        validate (callable): returns True if the given connection is usable
+        size (int): maximum number of open connections
+        max_idle (int): seconds a connection may stay unused in the pool
+        timeout (int): seconds to wait for a free connection
+    """
+    self.factory = factory
+    self.validate = validate
+    self.size = size
+    self.max_idle = max_idle
+    self.timeout = timeout
+    self._idle = collections.deque()
+    self._parked = collections.OrderedDict()
+    self._open = 0
+    self._cond = threading.Condition(threading.Lock())
+
+  def _close(self, connection):
+    try:
+      connection.unbind_s()
+    except Exception:  # pylint: disable=broad-except
+      LOG.debug('Could not unbind LDAP connection', exc_info=True)
+
+  def _expired(self):
+    """Remove connections idle too long. Must be called holding the lock."""
+    expired = []
+    now = time.time()
+    while self._idle and now - self._idle[0][1] > self.max_idle:
+      expired.append(self._idle.popleft()[0])
+      self._open -= 1
+    for key, (connection, _, parked_at) in self._parked.items():
+      if now - parked_at > self.max_idle:
+        del self._parked[key]
+        expired.append(connection)
+        self._open -= 1
+    return expired
+
+  def acquire(self):
+    """Check out a validated connection, opening a new one if needed"""
+    deadline = time.time() + self.timeout
+    while True:
+      connection = None
+      with self._cond:
+        expired = self._expired()
+        while not self._idle and self._open >= self.size:
+          if self._parked:
+            # give up the oldest parked search rather than wait
+            expired.append(self._parked.popitem(last=False)[1][0])
+            self._open -= 1
+            break
+          remaining = deadline - time.time()
+          if remaining <= 0:
+            raise PoolTimeout('No LDAP connection available in %s seconds' % self.timeout)
+          self._cond.wait(remaining)
+          expired.extend(self._expired())
+        if self._idle:
+          connection = self._idle.pop()[0]
+        else:
+          self._open += 1
+      for c in expired:
+        self._close(c)
+
+      if connection is None:
+        try:
+          return self.factory()
+        except Exception:
+          with self._cond:
+            self._open -= 1
+            self._cond.notify()
+          raise
+      if self.validate(connection):
+        return connection
+      LOG.info('Replacing dead LDAP connection')
+      self.discard(connection)
+
+  def park(self, key, connection, state):
+    """Set a checked out connection aside together with its ``state``"""
+    with self._cond:
+      self._parked[key] = (connection, state, time.time())
+
+  def unpark(self, key):
+    """
+    Check out the connection parked under ``key``.
+
+    Returns a ``(connection, state)`` tuple or None if there is no such
+    connection, for example because it has expired.
+    """
+    with self._cond:
+      parked = self._parked.pop(key, None)
+    if parked is None:
+      return None
+    return parked[0], parked[1]
+
+  def release(self, connection):
+    """Return a healthy connection to the pool"""
+    with self._cond:
+      self._idle.append((connection, time.time()))
+      self._cond.notify()
+
+  def discard(self, connection):
+    """Close a broken connection and free its slot"""
+    self._close(connection)
+    with self._cond:
+      self._open -= 1
+      self._cond.notify()
+
+
 class LDAPDataSource(ExternalDataSource):
   """
   Abstract base class for implementing external LDAP data sources.
@@ -48,12 +187,29 @@ class LDAPDataSource(ExternalDataSource):
   Attributes ``municipality_id_map`` and ``school_id_map`` can be used to map
   between local and external identifiers.
 
+  One instance is shared by all requests, see
+  :py:mod:`authdata.datasources.registry`. Methods must not store per-request
+  state on the instance.
+
+  Bound connections are kept in a :py:class:`LDAPConnectionPool` and all
+  searches go through :py:meth:`query`. User listings use
+  :py:meth:`paged_query`, which fetches one page with the LDAP simple paged
+  results control for each API request. Paging state lives in a connection
+  of the process serving the listing, see :py:meth:`paged_query`.
+
   Configuration should be in the format::
 
     {
       'host': connection string for ldap server,
       'username': name to bind as,
-      'password': password
+      'password': password,
+      'pool_size': maximum number of open connections (optional),
+      'pool_max_idle': seconds an unused connection is kept open (optional),
+      'pool_timeout': seconds to wait for a free connection (optional),
+      'max_replay_pages': pages a listing may be searched again to continue
+        it in another process (optional, default 10),
+      'cache_ttl', 'cache_max_age', 'cache_size', 'cache_queue_size': caching
+        of get_data, see ExternalDataSource (optional)
     }
 
   .. automethod:: __init__
@@ -63,8 +219,6 @@ class LDAPDataSource(ExternalDataSource):
   ldap_password = None
   ldap_base_dn = None
 
-  connection = None
-
   municipality_id_map = {
     # 'municipality': '1234567-8',
   }
@@ -83,12 +237,18 @@ class LDAPDataSource(ExternalDataSource):
         password (string): password for LDAP connection
     """
     import ldap
+    import ldap.controls
     self.ldap = ldap
     self.ldap_server = host
     self.ldap_username = username
     self.ldap_password = password
     if 'external_source' in kwargs:
       self.external_source = kwargs['external_source']
+    self.pool = LDAPConnectionPool(self.connect, self.validate_connection,
+        size=kwargs.get('pool_size', 10),
+        max_idle=kwargs.get('pool_max_idle', 300),
+        timeout=kwargs.get('pool_timeout', 10))
+    self.max_replay_pages = kwargs.get('max_replay_pages', 10)
     LOG.debug('LDAPDataSource initialized',
         extra={'data': {'external_source': self.external_source}})
     super(LDAPDataSource, self).__init__(*args, **kwargs)
@@ -102,26 +262,171 @@ class LDAPDataSource(ExternalDataSource):
   def connect(self):
     """
     Initialize connection the the LDAP server.
-    After this method is executed, self.connection is ready for executing
-    queries.
+    Returns a bound connection which is ready for executing queries.
     """
     ldap = self.ldap # import ldap
     # TODO: error handling
     ldap.set_option(ldap.OPT_X_TLS_REQUIRE_CERT, ldap.OPT_X_TLS_NEVER)
-    self.connection = ldap.initialize(self.ldap_server)
-    self.connection.set_option(ldap.OPT_REFERRALS, 0)
-    self.connection.simple_bind_s(self.ldap_username, self.ldap_password)
+    connection = ldap.initialize(self.ldap_server)
+    connection.set_option(ldap.OPT_REFERRALS, 0)
+    connection.simple_bind_s(self.ldap_username, self.ldap_password)
+    return connection
 
-  def query(self, query_filter):
+  def validate_connection(self, connection):
+    """
+    Check that a pooled connection is still bound to the server.
+    """
+    try:
+      connection.whoami_s()
+    except self.ldap.LDAPError:
+      return False
+    return True
+
+  def query(self, query_filter, base_dn=None):
     """
     query ldap with the provided filter string
+
+    base_dn: search base, defaults to ``ldap_base_dn``
+
+    The search is retried once with a new connection if the server has
+    dropped the pooled one.
+    """
+    ldap = self.ldap # import ldap
+    if base_dn is None:
+      base_dn = self.ldap_base_dn
+    for attempt in xrange(2):
+      connection = self.pool.acquire()
+      try:
+        # TODO: LDAP error handling
+        # TODO: must get exactly one result
+        return connection.search_s(base_dn, filterstr=query_filter, scope=ldap.SCOPE_SUBTREE)
+      except ldap.SERVER_DOWN:
+        self.pool.discard(connection)
+        connection = None
+        if attempt:
+          raise
+        LOG.warning('LDAP connection lost, retrying with a new connection',
+            extra={'data': {'external_source': self.external_source}})
+      finally:
+        if connection is not None:
+          self.pool.release(connection)
+
+
+  def _search_page(self, connection, base_dn, query_filter, page_size, cookie):
+    """
+    Run one page of a paged search. Returns results and the cookie for the
+    next page, which is empty after the last page.
+    """
+    ldap = self.ldap # import ldap
+    page_control = ldap.controls.SimplePagedResultsControl(True, size=page_size, cookie=cookie)
+    msgid = connection.search_ext(base_dn, ldap.SCOPE_SUBTREE, query_filter, serverctrls=[page_control])
+    _, results, _, response_controls = connection.result3(msgid)
+    cookie = ''
+    for control in response_controls:
+      if control.controlType == ldap.controls.SimplePagedResultsControl.controlType:
+        cookie = control.cookie
+    return results, cookie
+
+  def paged_query(self, query_filter, page_size, cursor=None, base_dn=None):
+    """
+    query ldap for one page of results with the provided filter string
+
+    Returns a tuple of results and a cursor for the next page. The cursor is
+    None after the last page.
+
+    LDAP paging state lives in the server connection, so the connection is
+    parked in the pool of this process until the next page is requested. If
+    that request ends up in another process or the connection has expired,
+    the search is started again and the already returned pages are skipped,
+    which costs a search for each of them. Up to ``max_replay_pages`` pages
+    are skipped, a cursor further than that raises :py:class:`CursorExpired`.
+    With many server processes, route the requests of a listing to the same
+    process to keep each page at the cost of one LDAP page.
+
+    The search is retried once with a new connection if the server has
+    dropped the connection.
     """
     ldap = self.ldap # import ldap
-    if not self.connection:
-      self.connect()
-    # TODO: LDAP error handling
-    # TODO: must get exactly one result
-    return self.connection.search_s(self.ldap_base_dn, filterstr=query_filter, scope=ldap.SCOPE_SUBTREE)
+    if base_dn is None:
+      base_dn = self.ldap_base_dn
+    search = (base_dn, query_filter, page_size)
+    page = 0
+    cookie = ''
+    connection = None
+    if cursor:
+      try:
+        token, page = cursor.split('.')
+        page = int(page)
+      except ValueError:
+        LOG.warning('Invalid LDAP paging cursor', extra={'data': {'cursor': repr(cursor)}})
+        token, page = None, 0
+      parked = self.pool.unpark(token)
+      if parked is not None:
+        connection, (parked_search, cookie) = parked
+        if parked_search != search:
+          self.pool.release(connection)
+          connection, cookie = None, ''
+
+    for attempt in xrange(2):
+      try:
+        if connection is None:
+          if page > self.max_replay_pages:
+            raise CursorExpired('LDAP paging state of the cursor is lost')
+          connection = self.pool.acquire()
+          cookie = ''
+          for _ in xrange(page):
+            _, cookie = self._search_page(connection, base_dn, query_filter, page_size, cookie)
+            if not cookie:
+              # the search has fewer pages than the cursor points to
+              self.pool.release(connection)
+              return [], None
+        results, cookie = self._search_page(connection, base_dn, query_filter, page_size, cookie)
+        break
+      except ldap.SERVER_DOWN:
+        self.pool.discard(connection)
+        connection = None
+        if attempt:
+          raise
+        LOG.warning('LDAP connection lost, retrying with a new connection',
+            extra={'data': {'external_source': self.external_source}})
+      except Exception:
+        # paging state of the connection is unknown after an error
+        if connection is not None:
+          self.pool.discard(connection)
+        raise
+
+    if not cookie:
+      self.pool.release(connection)
+      return results, None
+    token = uuid.uuid4().hex
+    self.pool.park(token, connection, (search, cookie))
+    return results, '%s.%d' % (token, page + 1)
+
+  def get_page_size(self, request):
+    """
+    Page size for user listings, using the same parameters and limits as the
+    REST framework pagination.
+    """
+    return get_page_size(request.GET)
+
+  def paginated_response(self, request, results, cursor):
+    """
+    Wrap one page of user listing results. ``next`` links to the page after
+    this one. ``count`` is only known when the whole listing fits in the
+    first page.
+    """
+    count = None
+    if cursor is None and not request.GET.get('cursor'):
+      count = len(results)
+    next_link = None
+    if cursor is not None:
+      next_link = replace_query_param(request.build_absolute_uri(), 'cursor', cursor)
+    return {
+      'count': count,
+      'next': next_link,
+      'previous': None,
+      'results': results,
+    }
 
 
 class TestLDAPDataSource(LDAPDataSource):
@@ -232,11 +537,13 @@ class TestLDAPDataSource(LDAPDataSource):
     ldap_filter = "objectclass=inetOrgPerson"
     query_base = self.ldap_base_dn
     if 'school' in request.GET:
-      self.ldap_base_dn = 'ou=%s,%s' % (request.GET['school'], query_base)
+      query_base = 'ou=%s,%s' % (request.GET['school'], query_base)
     if 'group' in request.GET and request.GET['group'] != '':
       ldap_filter = '(&(departmentNumber=%s)(%s))' % (request.GET['group'], ldap_filter)
-    query_results = self.query(ldap_filter)
+    query_results, cursor = self.paged_query(ldap_filter, self.get_page_size(request),
+        cursor=request.GET.get('cursor'), base_dn=query_base)
     response = []
+    provisioned = []
 
     for result in query_results:
       dn_parts = result[0].split(',')
@@ -261,17 +568,12 @@ class TestLDAPDataSource(LDAPDataSource):
         'roles': roles,
         'attributes': attributes
       })
+      provisioned.append((oid, external_id))
 
-      # Provision
-      self.provision_user(oid, external_id)
+    # Provision
+    self.provision_users(provisioned)
 
-    # TODO: support actual paging via SimplePagedResultsControl
-    return {
-      'count': len(response),
-      'next': None,
-      'previous': None,
-      'results': response,
-    }
+    return self.paginated_response(request, response, cursor)
 
 # vim: tabstop=2 expandtab shiftwidth=2 softtabstop=2
 
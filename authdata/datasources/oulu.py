@@ -114,13 +114,14 @@ class OuluLDAPDataSource(LDAPDataSource):
     """
     ldap = self.ldap # import ldap
     ldap.set_option(ldap.OPT_X_TLS_CACERTFILE, 'oulu_certificate')
-    self.connection = ldap.initialize(self.ldap_server)
-    self.connection.set_option(ldap.OPT_REFERRALS, 0)
-    self.connection.set_option(ldap.OPT_PROTOCOL_VERSION, 3)
-    self.connection.set_option(ldap.OPT_X_TLS_DEMAND, True)
-    self.connection.set_option(ldap.OPT_X_TLS, ldap.OPT_X_TLS_DEMAND)
-    self.connection.start_tls_s()
-    self.connection.simple_bind_s(self.ldap_username, self.ldap_password)
+    connection = ldap.initialize(self.ldap_server)
+    connection.set_option(ldap.OPT_REFERRALS, 0)
+    connection.set_option(ldap.OPT_PROTOCOL_VERSION, 3)
+    connection.set_option(ldap.OPT_X_TLS_DEMAND, True)
+    connection.set_option(ldap.OPT_X_TLS, ldap.OPT_X_TLS_DEMAND)
+    connection.start_tls_s()
+    connection.simple_bind_s(self.ldap_username, self.ldap_password)
+    return connection
 
   def get_oid(self, username):
     """
@@ -196,8 +197,10 @@ class OuluLDAPDataSource(LDAPDataSource):
       ldap_filter = u'(&(physicalDeliveryOfficeName={school}){filter_base})'.format(school=request.GET['school'], filter_base=ldap_filter)
     if 'group' in request.GET and request.GET['group'] != '':
       ldap_filter = u'(&(department={group}){filter_base})'.format(group=request.GET['group'], filter_base=ldap_filter)
-    query_results = self.query(ldap_filter)
+    query_results, cursor = self.paged_query(ldap_filter, self.get_page_size(request),
+        cursor=request.GET.get('cursor'))
     response = []
+    provisioned = []
 
     for query_result in query_results:
       username = self.get_username(query_result)
@@ -221,18 +224,12 @@ class OuluLDAPDataSource(LDAPDataSource):
         'roles': roles,
         'attributes': attributes
       })
+      provisioned.append((oid, external_id))
 
-      # Provision
-      self.provision_user(oid, external_id)
-
-    # TODO: support actual paging via SimplePagedResultsControl
+    # Provision
+    self.provision_users(provisioned)
 
-    return {
-      'count': len(response),
-      'next': None,
-      'previous': None,
-      'results': response,
-    }
+    return self.paginated_response(request, response, cursor)
 
 # vim: tabstop=2 expandtab shiftwidth=2 softtabstop=2
 
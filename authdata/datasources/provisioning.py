@@ -0,0 +1,219 @@
+
+# -*- coding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2014-2015 Haltu Oy, http://haltu.fi
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+"""
+Data sources write every user they fetch to the local database, see
+:py:meth:`authdata.datasources.base.ExternalDataSource.provision_users`. By
+default this happens before the response is returned. With::
+
+  AUTHDATA_PROVISIONING_MODE = 'deferred'
+
+users are put to an in-process write-behind queue instead and a background
+thread writes them in bulk when ``AUTHDATA_PROVISIONING_BATCH_SIZE`` users
+are waiting or ``AUTHDATA_PROVISIONING_FLUSH_INTERVAL`` seconds have passed.
+
+The queue holds at most ``AUTHDATA_PROVISIONING_QUEUE_SIZE`` users. Users
+which do not fit, which fail to be written or which are still queued when
+the process exits are stored in :py:class:`authdata.models.PendingProvision`.
+The background thread writes them when it starts and then every
+``AUTHDATA_PROVISIONING_DRAIN_INTERVAL`` seconds. Stored users are claimed
+with ``SELECT ... FOR UPDATE`` and deleted in the transaction writing them,
+so processes draining at the same time do not write the same users.
+"""
+
+import atexit
+import collections
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import DatabaseError
+from django.db import close_old_connections
+from django.db import transaction
+
+from authdata.models import PendingProvision
+
+LOG = logging.getLogger(__name__)
+
+
+def is_deferred():
+  return getattr(settings, 'AUTHDATA_PROVISIONING_MODE', 'immediate') == 'deferred'
+
+
+def save(items):
+  """
+  Write (username, external_id, external_source) tuples to the database.
+  """
+  from authdata.datasources.base import ExternalDataSource
+  by_source = collections.OrderedDict()
+  for username, external_id, external_source in items:
+    by_source.setdefault(external_source, []).append((username, external_id))
+  for external_source, batch in by_source.iteritems():
+    data_source = ExternalDataSource()
+    data_source.external_source = external_source
+    data_source.save_users(batch)
+
+
+class ProvisioningQueue(object):
+  """
+  Bounded write-behind buffer of users waiting to be provisioned.
+
+  .. automethod:: __init__
+  """
+
+  def __init__(self, maxsize=10000, batch_size=500, flush_interval=2, drain_interval=60, start_worker=True):
+    """
+    Args:
+        maxsize (int): maximum number of users kept in memory
+        batch_size (int): number of users written in one transaction
+        flush_interval (float): seconds a user may wait in the queue
+        drain_interval (float): seconds between writing the stored users
+        start_worker (bool): start the background thread on first use
+    """
+    self.maxsize = maxsize
+    self.batch_size = batch_size
+    self.flush_interval = flush_interval
+    self.drain_interval = drain_interval
+    self.drain_at = 0
+    self.start_worker = start_worker
+    self.items = collections.deque()
+    self.cond = threading.Condition(threading.Lock())
+    self.worker = None
+
+  def put(self, external_source, batch):
+    """Queue (username, external_id) tuples fetched from ``external_source``"""
+    overflow = []
+    with self.cond:
+      for username, external_id in batch:
+        item = (username, external_id, external_source)
+        if len(self.items) < self.maxsize:
+          self.items.append(item)
+        else:
+          overflow.append(item)
+      if len(self.items) >= self.batch_size:
+        self.cond.notify()
+      if self.start_worker and self.worker is None:
+        self._start()
+    if overflow:
+      LOG.warning('Provisioning queue is full, storing users to the database',
+          extra={'data': {'count': len(overflow)}})
+      self.spill(overflow)
+
+  def _start(self):
+    self.worker = threading.Thread(target=self._run, name='authdata-provisioning')
+    self.worker.daemon = True
+    self.worker.start()
+    atexit.register(self.flush)
+
+  def _take(self):
+    batch = []
+    while self.items and len(batch) < self.batch_size:
+      batch.append(self.items.popleft())
+    return batch
+
+  def _run(self):
+    while True:
+      self.work()
+
+  def work(self):
+    """Write a batch when one is due and the stored users when they are due"""
+    with self.cond:
+      if len(self.items) < self.batch_size:
+        self.cond.wait(self.flush_interval)
+      batch = self._take()
+    if batch:
+      self.write(batch)
+    if time.time() >= self.drain_at:
+      self.drain_pending()
+
+  def write(self, batch):
+    """Write a batch, storing it to the pending table if that fails"""
+    close_old_connections()
+    try:
+      save(batch)
+    except Exception:  # pylint: disable=broad-except
+      LOG.exception('Deferred provisioning failed, storing users to the database',
+          extra={'data': {'count': len(batch)}})
+      self.spill(batch)
+
+  def flush(self):
+    """Write everything in the queue now"""
+    while True:
+      with self.cond:
+        batch = self._take()
+      if not batch:
+        return
+      self.write(batch)
+
+  def spill(self, items):
+    """Store items to the pending table"""
+    try:
+      PendingProvision.objects.bulk_create([
+          PendingProvision(username=username, external_id=external_id, external_source=external_source)
+          for username, external_id, external_source in items])
+    except DatabaseError:
+      LOG.exception('Could not store users waiting for provisioning',
+          extra={'data': {'items': repr(items)}})
+
+  def drain_pending(self):
+    """Provision users left in the pending table"""
+    self.drain_at = time.time() + self.drain_interval
+    close_old_connections()
+    while True:
+      try:
+        with transaction.atomic():
+          # Locked rows are skipped by the other processes once this
+          # transaction has deleted them
+          pending = list(PendingProvision.objects.select_for_update().order_by('pk')[:self.batch_size])
+          if not pending:
+            return
+          PendingProvision.objects.filter(pk__in=[p.pk for p in pending]).delete()
+          save([(p.username, p.external_id, p.external_source) for p in pending])
+      except Exception:  # pylint: disable=broad-except
+        # The rows are kept and drained again after drain_interval
+        LOG.exception('Could not provision pending users')
+        return
+      LOG.info('Provisioned pending users', extra={'data': {'count': len(pending)}})
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_queue():
+  """Return the process-wide provisioning queue"""
+  global _queue  # pylint: disable=global-statement
+  with _queue_lock:
+    if _queue is None:
+      _queue = ProvisioningQueue(
+          maxsize=getattr(settings, 'AUTHDATA_PROVISIONING_QUEUE_SIZE', 10000),
+          batch_size=getattr(settings, 'AUTHDATA_PROVISIONING_BATCH_SIZE', 500),
+          flush_interval=getattr(settings, 'AUTHDATA_PROVISIONING_FLUSH_INTERVAL', 2),
+          drain_interval=getattr(settings, 'AUTHDATA_PROVISIONING_DRAIN_INTERVAL', 60))
+    return _queue
+
+# vim: tabstop=2 expandtab shiftwidth=2 softtabstop=2
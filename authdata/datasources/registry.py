@@ -0,0 +1,120 @@
+
+# -*- coding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2014-2015 Haltu Oy, http://haltu.fi
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+"""
+External data source handlers are configured in
+``settings.AUTH_EXTERNAL_SOURCES`` as ``[module import, classname, kwargs dict]``
+lists. Instantiating a handler is not free: LDAP sources bind to the server
+and HTTP sources set up their clients. The registry creates every configured
+handler once when the application starts and hands out the same instances to
+all requests.
+
+Handlers are shared between worker threads, so they must not keep per-request
+state in instance attributes.
+
+Entries which can not be imported or instantiated are logged at startup.
+Asking for such a handler raises ``ImportError`` and asking for a source which
+is not configured at all raises ``KeyError``.
+"""
+
+import importlib
+import logging
+import threading
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+LOG = logging.getLogger(__name__)
+
+_lock = threading.RLock()
+_handlers = None
+_errors = None
+
+
+def _create_handler(source):
+  """Import and instantiate a handler from one settings entry"""
+  handler_module = importlib.import_module(source[0])
+  kwargs = source[2]
+  return getattr(handler_module, source[1])(**kwargs)
+
+
+def load():
+  """
+  Instantiate all handlers in ``settings.AUTH_EXTERNAL_SOURCES``.
+
+  Called when the application is ready. Calling again replaces the handlers.
+  """
+  global _handlers, _errors  # pylint: disable=global-statement
+  with _lock:
+    handlers = {}
+    errors = {}
+    for name, source in getattr(settings, 'AUTH_EXTERNAL_SOURCES', {}).iteritems():
+      LOG.debug('Trying to import module of external authentication source',
+          extra={'data': {'external_source': repr(name), 'module_name': source[0]}})
+      try:
+        handlers[name] = _create_handler(source)
+      except (ImportError, AttributeError, TypeError, ValueError, IndexError) as e:
+        LOG.error('Could not initialize external data source',
+            extra={'data': {'external_source': repr(name), 'error': unicode(e)}})
+        errors[name] = unicode(e)
+    _handlers = handlers
+    _errors = errors
+  return handlers
+
+
+def reset():
+  """Forget all handlers. They are created again on next use."""
+  global _handlers, _errors  # pylint: disable=global-statement
+  with _lock:
+    _handlers = None
+    _errors = None
+
+
+def get_handler(external_source):
+  """
+  Return the shared handler instance for ``external_source``.
+
+  Raises KeyError if the source is not configured and ImportError if the
+  source is configured but could not be initialized.
+  """
+  with _lock:
+    if _handlers is None:
+      load()
+    handlers, errors = _handlers, _errors
+  if external_source in handlers:
+    return handlers[external_source]
+  if external_source in errors:
+    raise ImportError(errors[external_source])
+  raise KeyError(external_source)
+
+
+@receiver(setting_changed)
+def _reset_on_setting_changed(sender, setting, **kwargs):  # pylint: disable=unused-argument
+  if setting == 'AUTH_EXTERNAL_SOURCES':
+    reset()
+
+# vim: tabstop=2 expandtab shiftwidth=2 softtabstop=2
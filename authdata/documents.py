@@ -0,0 +1,138 @@
+# -*- encoding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2014-2015 Haltu Oy, http://haltu.fi
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+"""
+The query endpoint response of each local user is stored encoded as JSON in
+:py:class:`authdata.models.UserDocument`, so queries are answered with one
+indexed row fetch instead of reading the user, attributes, attendances,
+schools, municipalities and roles.
+
+Documents are rebuilt by the writers, in the transaction changing the data of
+the users, see :py:mod:`authdata.changelog`. The query endpoint only reads
+them. Deleting a user attribute or an attendance removes the document instead,
+since the user may be being deleted too, and the user is answered from the
+tables until the next write rebuilds it.
+
+A document records the ``last_changed`` of the user it was built from and is
+used only while it equals the current ``last_changed`` of the user, so a
+document missed by a writer is never returned. ``manage.py
+rebuild_user_documents`` rebuilds all of them, e.g. after writes which
+bypassed the ORM.
+
+Users of external sources have no documents, their data is always fetched
+from the source.
+"""
+
+import logging
+
+from django.db import transaction
+from django.db.models import Q
+from rest_framework.renderers import JSONRenderer
+
+from authdata.models import User, UserDocument
+from authdata.serializers import QuerySerializer
+
+LOG = logging.getLogger(__name__)
+
+
+def encode(data):
+  """ Returns data encoded the same way as by the query endpoint """
+  return JSONRenderer().render(data).decode('utf-8')
+
+
+def _local():
+  return Q(external_source='') | Q(external_id='')
+
+
+def get(**lookup):
+  """ Returns the current document of the only user matching lookup
+
+  lookup is given to ``UserDocument.objects.filter``. Returns None if the user
+  has no current document or more than one user matches.
+  """
+  rows = list(UserDocument.objects.filter(**lookup)
+      .values_list('body', 'last_changed', 'user__last_changed')[:2])
+  if len(rows) != 1:
+    return None
+  body, last_changed, user_last_changed = rows[0]
+  if last_changed != user_last_changed:
+    return None
+  return body
+
+
+def _replace(user_ids, users):
+  # users are the local users among user_ids
+  data = QuerySerializer(users, many=True).data
+  UserDocument.objects.filter(user__in=user_ids).delete()
+  UserDocument.objects.bulk_create([UserDocument(user=user, last_changed=user.last_changed, body=encode(d))
+      for user, d in zip(users, data)])
+
+
+def refresh(user_ids, chunk_size=1000):
+  """ Rebuilds the documents of user_ids
+
+  Call this in the transaction changing the data of the users, after the
+  change. Users are read in chunks of chunk_size. Documents of users of
+  external sources are removed.
+  """
+  user_ids = sorted(set(user_ids))
+  for i in xrange(0, len(user_ids), chunk_size):
+    chunk = user_ids[i:i + chunk_size]
+    users = list(QuerySerializer.setup_eager_loading(User.objects.filter(_local(), pk__in=chunk)))
+    _replace(chunk, users)
+
+
+def discard(user_ids):
+  """ Removes the documents of user_ids """
+  UserDocument.objects.filter(user__in=set(user_ids)).delete()
+
+
+def rebuild(chunk_size=1000):
+  """ Rebuilds the documents of all local users
+
+  Users are read in chunks of chunk_size in primary key order and the
+  documents of each chunk are replaced in a transaction of its own. Returns
+  the number of documents built.
+  """
+  count = 0
+  last = 0
+  while True:
+    users = list(QuerySerializer.setup_eager_loading(User.objects.filter(_local(), pk__gt=last)).order_by('pk')[:chunk_size])
+    if not users:
+      break
+    with transaction.atomic():
+      _replace(users, users)
+    count += len(users)
+    last = users[-1].pk
+    LOG.debug('User documents rebuilt', extra={'data': {'count': count}})
+    if len(users) < chunk_size:
+      break
+  # Users who have become external since their document was built
+  UserDocument.objects.exclude(user__in=User.objects.filter(_local())).delete()
+  return count
+
+
+# vim: tabstop=2 expandtab shiftwidth=2 softtabstop=2
+
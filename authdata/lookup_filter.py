@@ -0,0 +1,244 @@
+# -*- encoding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2014-2015 Haltu Oy, http://haltu.fi
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+"""
+Stored documents of attribute values nobody has are not looked up.
+Attribute values seen in :py:class:`authdata.models.UserAttribute` are kept in
+a Bloom filter per attribute. A value the filter does not contain was not
+stored in the database when the filter was last built or synced.
+
+The filters may lag behind writes of other processes, so a negative answer
+only skips the document lookup. The user is still looked up from the
+database before the query is answered as not found.
+
+The filters are built by a background thread the first time they are needed
+and rebuilt every ``AUTHDATA_LOOKUP_FILTER_REBUILD_INTERVAL`` seconds.
+Until the first build finishes every value is looked up. Values saved by this
+process are added right away. Rows inserted or changed by other processes
+are added by reading rows modified since the last sync, at most every
+``AUTHDATA_LOOKUP_FILTER_SYNC_INTERVAL`` seconds and only when the filter
+would otherwise answer no. Rows modified up to
+``AUTHDATA_LOOKUP_FILTER_SYNC_MARGIN`` seconds before the last sync are read
+again, which covers transactions committed after the sync and clock
+differences between servers. Writers bypassing ``save()`` must set
+``modified``. Set ``AUTHDATA_LOOKUP_FILTER = False`` to disable the filters.
+
+Values which were not found from an external source either are remembered
+for ``AUTHDATA_EXTERNAL_MISS_TIMEOUT`` seconds in the query response cache,
+see :py:mod:`authdata.query_cache`.
+"""
+
+import datetime
+import hashlib
+import logging
+import math
+import struct
+import threading
+import time
+
+from django.conf import settings
+from django.db import DatabaseError
+from django.db import connection
+from django.db.models import Count
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from django.utils import timezone
+from django.utils.encoding import force_bytes
+
+from authdata import query_cache
+from authdata.models import Attribute, UserAttribute
+
+LOG = logging.getLogger(__name__)
+
+
+class BloomFilter(object):
+  """
+  Set membership test without false negatives. False positives happen at
+  ``error_rate`` when at most ``capacity`` values have been added.
+  """
+
+  def __init__(self, capacity, error_rate=0.01):
+    capacity = max(capacity, 1000)
+    self.size = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+    self.hashes = max(1, int(round(self.size * math.log(2) / capacity)))
+    self.bits = bytearray((self.size + 7) // 8)
+
+  def _positions(self, value):
+    h1, h2 = struct.unpack('<QQ', hashlib.md5(force_bytes(value)).digest())
+    return [(h1 + i * h2) % self.size for i in xrange(self.hashes)]
+
+  def add(self, value):
+    for position in self._positions(value):
+      self.bits[position >> 3] |= 1 << (position & 7)
+
+  def __contains__(self, value):
+    return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(value))
+
+
+class KnownValues(object):
+  """
+  Bloom filters of the values of each attribute, keyed by attribute id.
+  """
+
+  def __init__(self):
+    self.filters = None  # attribute id: BloomFilter, None until built
+    self.attribute_ids = {}  # attribute name: attribute id, as of the last build
+    self.pending = None  # values added while the filters are rebuilt
+    self.synced_since = None  # modified time rows were read from at the last sync
+    self.built_at = None
+    self.synced_at = None
+    self.building = False
+    self.lock = threading.Lock()
+
+  def _add(self, filters, attribute_id, value):
+    if value is None:
+      return
+    bloom = filters.get(attribute_id)
+    if bloom is None:
+      bloom = filters[attribute_id] = BloomFilter(0, getattr(settings, 'AUTHDATA_LOOKUP_FILTER_ERROR_RATE', 0.01))
+    bloom.add(value)
+
+  def _contains(self, attribute_id, value):
+    bloom = self.filters.get(attribute_id)
+    return bloom is not None and value in bloom
+
+  def add(self, attribute_id, value):
+    with self.lock:
+      if self.filters is not None:
+        self._add(self.filters, attribute_id, value)
+      if self.pending is not None:
+        self.pending.append((attribute_id, value))
+
+  def might_contain(self, name, value):
+    """
+    Returns False only if no user had the value for attribute name at the
+    last build or sync
+    """
+    if not getattr(settings, 'AUTHDATA_LOOKUP_FILTER', True):
+      return True
+    now = time.time()
+    if self.built_at is None or now - self.built_at >= getattr(settings, 'AUTHDATA_LOOKUP_FILTER_REBUILD_INTERVAL', 3600):
+      self._start_rebuild()
+    if self.filters is None:
+      return True
+    attribute_id = self.attribute_ids.get(name)
+    if attribute_id is None:
+      # Attributes created after the build have no filter yet
+      return True
+    if self._contains(attribute_id, value):
+      return True
+    if now - self.synced_at >= getattr(settings, 'AUTHDATA_LOOKUP_FILTER_SYNC_INTERVAL', 1):
+      self.sync()
+      return self._contains(attribute_id, value)
+    return False
+
+  def sync(self):
+    """ Adds rows modified since the last build or sync """
+    started = timezone.now()
+    margin = datetime.timedelta(seconds=getattr(settings, 'AUTHDATA_LOOKUP_FILTER_SYNC_MARGIN', 60))
+    rows = list(UserAttribute.objects.filter(modified__gte=self.synced_since - margin)
+        .values_list('attribute_id', 'value'))
+    with self.lock:
+      for attribute_id, value in rows:
+        self._add(self.filters, attribute_id, value)
+      self.synced_since = started
+      self.synced_at = time.time()
+
+  def _start_rebuild(self):
+    with self.lock:
+      if self.building:
+        return
+      self.building = True
+    thread = threading.Thread(target=self.rebuild, name='authdata-lookup-filter')
+    thread.daemon = True
+    thread.start()
+
+  def rebuild(self):
+    with self.lock:
+      self.building = True
+      self.pending = []
+    try:
+      error_rate = getattr(settings, 'AUTHDATA_LOOKUP_FILTER_ERROR_RATE', 0.01)
+      started = timezone.now()
+      attributes = Attribute.objects.annotate(count=Count('userattribute')).values_list('pk', 'name', 'count')
+      attribute_ids = dict((name, pk) for pk, name, _ in attributes)
+      filters = dict((pk, BloomFilter(count, error_rate)) for pk, _, count in attributes)
+      for attribute_id, value in UserAttribute.objects.values_list('attribute_id', 'value').iterator():
+        self._add(filters, attribute_id, value)
+      with self.lock:
+        for attribute_id, value in self.pending:
+          self._add(filters, attribute_id, value)
+        self.filters = filters
+        self.attribute_ids = attribute_ids
+        self.synced_since = started
+        self.built_at = self.synced_at = time.time()
+      LOG.debug('Lookup filters built', extra={'data': {'attributes': len(filters)}})
+    except DatabaseError:
+      LOG.warning('Could not build lookup filters', exc_info=True)
+    finally:
+      with self.lock:
+        self.pending = None
+        self.building = False
+      if threading.current_thread().name == 'authdata-lookup-filter':
+        connection.close()
+
+  def reset(self):
+    with self.lock:
+      self.filters = None
+      self.built_at = None
+
+
+known_values = KnownValues()
+
+
+def _miss_key(name, value):
+  return 'authdata:miss:%s:%s' % (hashlib.md5(force_bytes(name)).hexdigest(), hashlib.md5(force_bytes(value)).hexdigest())
+
+
+def is_external_miss(name, value):
+  """ Returns True if value was recently not found from the external source """
+  return query_cache.get_cache().get(_miss_key(name, value)) is not None
+
+
+def remember_external_miss(name, value):
+  timeout = getattr(settings, 'AUTHDATA_EXTERNAL_MISS_TIMEOUT', 60)
+  if timeout:
+    query_cache.get_cache().set(_miss_key(name, value), True, timeout)
+
+
+@receiver(post_save, sender=UserAttribute)
+def _add_known_value(sender, instance, **kwargs):  # pylint: disable=unused-argument
+  known_values.add(instance.attribute_id, instance.value)
+
+
+@receiver(post_save, sender=Attribute)
+def _attribute_renamed(sender, created, **kwargs):  # pylint: disable=unused-argument
+  # Attribute ids are looked up by the name they had at the last build
+  if not created:
+    known_values.reset()
+
+
+# vim: tabstop=2 expandtab shiftwidth=2 softtabstop=2
+
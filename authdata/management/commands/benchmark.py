@@ -0,0 +1,126 @@
+# -*- encoding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2014-2015 Haltu Oy, http://haltu.fi
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+import json
+import random
+from StringIO import StringIO
+from optparse import make_option
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from authdata import benchmark
+from authdata import lookup_filter
+from authdata import query_cache
+from authdata.models import User
+
+
+class Command(BaseCommand):
+  help = """Benchmarks the /query and /user endpoints.
+
+For each scale a test database is filled with create_test_data and the
+endpoints are requested through the Django test client. Latency
+percentiles, queries per request and throughput of each scenario are
+reported. The database configured in the settings is not touched.
+
+For example: manage.py benchmark --scales 1000,10000 --baseline baseline.json
+"""
+  option_list = BaseCommand.option_list + (
+    make_option('--scales', action='store', dest='scales', default='1000,10000',
+        help='Comma separated numbers of users'),
+    make_option('--requests', action='store', dest='requests', type='int', default=200,
+        help='Number of timed requests in each scenario'),
+    make_option('--seed', action='store', dest='seed', type='int', default=0,
+        help='Seed of the test data and the requests'),
+    make_option('--baseline', action='store', dest='baseline', default=None,
+        help='Compare to the results saved in this file'),
+    make_option('--save-baseline', action='store', dest='save_baseline', default=None,
+        help='Save the results to this file'),
+    make_option('--tolerance', action='store', dest='tolerance', type='float', default=0.25,
+        help='Allowed relative change of latency and throughput from the baseline'),
+  )
+
+  def handle(self, *args, **options):
+    try:
+      scales = [int(scale) for scale in options['scales'].split(',')]
+    except ValueError:
+      raise CommandError('--scales must be comma separated numbers')
+    baseline = None
+    if options['baseline']:
+      with open(options['baseline']) as f:
+        baseline = json.load(f)
+    if settings.DEBUG:
+      self.stdout.write('WARNING, DEBUG is on, queries are logged and requests slower')
+
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    try:
+      results = {}
+      for scale in scales:
+        results[str(scale)] = self.run_scale(scale, options)
+    finally:
+      connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    self.report(results, baseline)
+    if options['save_baseline']:
+      with open(options['save_baseline'], 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    if baseline:
+      regressions = benchmark.compare(results, baseline, options['tolerance'])
+      for regression in regressions:
+        self.stdout.write('REGRESSION %s' % regression)
+      if regressions:
+        raise CommandError('%d regressions' % len(regressions))
+
+  def run_scale(self, scale, options):
+    call_command('flush', interactive=False, verbosity=0)
+    # The attributes of the source are returned to the client of the same name
+    call_command('create_test_data', users=scale, seed=options['seed'], source='benchmark', stdout=StringIO())
+    call_command('rebuild_user_documents', stdout=StringIO())
+    query_cache.get_cache().clear()
+    # Built here, since a thread of its own could not read an in-memory
+    # test database
+    lookup_filter.known_values.rebuild()
+    user = User.objects.create(username='benchmark')
+    return benchmark.run(user, random.Random(options['seed']), options['requests'])
+
+  def report(self, results, baseline):
+    self.stdout.write('%-8s %-18s %9s %9s %9s %8s %10s' % ('users', 'scenario', 'p50 ms', 'p95 ms', 'p99 ms', 'queries', 'requests/s'))
+    for scale, scenarios in sorted(results.iteritems(), key=lambda item: int(item[0])):
+      for name, result in sorted(scenarios.iteritems()):
+        self.stdout.write('%-8s %-18s %9.1f %9.1f %9.1f %8.1f %10.0f' % (scale, name, result['p50'], result['p95'],
+            result['p99'], result['queries'], result['throughput']))
+        base = (baseline or {}).get(scale, {}).get(name)
+        if base:
+          self.stdout.write('%-8s %-18s %+8.0f%% %+8.0f%% %+8.0f%% %8.1f %+9.0f%%' % ('', 'baseline',
+              _change(result['p50'], base['p50']), _change(result['p95'], base['p95']),
+              _change(result['p99'], base['p99']), base['queries'],
+              _change(result['throughput'], base['throughput'])))
+
+
+def _change(value, base):
+  return (value - base) / base * 100 if base else 0
+
+# vim: tabstop=2 expandtab shiftwidth=2 softtabstop=2
+
@@ -23,41 +23,127 @@
 # THE SOFTWARE.
 #
 
-import sys
+import hashlib
 import random
-from django.core.management.base import BaseCommand
-from authdata.models import User, Role, Attribute, UserAttribute, Municipality, School, Attendance, Source
-from authdata.tests import factories as f
+import time
+from optparse import make_option
+from django.contrib.auth.hashers import UNUSABLE_PASSWORD_PREFIX
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db import transaction
+from authdata import signals
+from authdata.models import User, Role, Attribute, UserAttribute, Municipality, School, Attendance, Source, hash_value
+
+USERNAME = '1.2.246.562.24.%011d'
 
 
 class Command(BaseCommand):
   help = """
   Creates a set of test data:
 
-  * 10000 users, random-generated username in OID format
-  * 10 municipalities
-  * 100 schools
-  * either "teacher" or "student" role in municipality
-  * varying number (1-10) of groups for each user
+  * --users users, username in OID format
+  * --municipalities municipalities with --schools schools each
+  * "teacher" role for --teacher-ratio of the users, "student" for the rest
+  * 1-2 groups for each student, 1 to --max-groups groups for each teacher,
+    all in one school
+  * --attributes attributes, each set for --attribute-ratio of the users
+  * all rows owned by the source named --source, so the user endpoint
+    returns the attributes to a client of the same username
+
+  The same options and --seed always create the same data, so that benchmark
+  runs can be compared. Users are written with bulk queries in batches of
+  --batch-size. Usernames are numbered, so the command refuses to run if any
+  of the numbered users exist already.
   """
+  option_list = BaseCommand.option_list + (
+    make_option('--users', action='store', dest='users', type='int', default=10000,
+        help='Number of users'),
+    make_option('--municipalities', action='store', dest='municipalities', type='int', default=10,
+        help='Number of municipalities'),
+    make_option('--schools', action='store', dest='schools', type='int', default=10,
+        help='Number of schools in each municipality'),
+    make_option('--attributes', action='store', dest='attributes', type='int', default=10,
+        help='Number of attributes'),
+    make_option('--attribute-ratio', action='store', dest='attribute_ratio', type='float', default=0.5,
+        help='Share of users having each attribute'),
+    make_option('--teacher-ratio', action='store', dest='teacher_ratio', type='float', default=0.1,
+        help='Share of users who are teachers'),
+    make_option('--max-groups', action='store', dest='max_groups', type='int', default=10,
+        help='Maximum number of groups of a teacher'),
+    make_option('--seed', action='store', dest='seed', type='int', default=0,
+        help='Seed of the random number generator'),
+    make_option('--source', action='store', dest='source', default='test_data',
+        help='Name of the source of the data'),
+    make_option('--batch-size', action='store', dest='batch_size', type='int', default=10000,
+        help='Number of users written at a time'),
+  )
 
   def handle(self, *args, **options):
-    source = f.SourceFactory.create()
-    attributes = f.AttributeFactory.create_batch(10)
-    roles = [Role.objects.get_or_create(name='teacher'), Role.objects.get_or_create(name='student')]
-    for m in xrange(10):
-      muni = f.MunicipalityFactory.create(data_source=source)
-      schools = f.SchoolFactory.create_batch(10, municipality=muni, data_source=source)
-      for u in xrange(1000):
-        user = f.UserFactory()
-        role = random.choice(roles)
-        for attr in attributes:
-          f.UserAttributeFactory.create(user=user, attribute=attr, data_source=source)
-        for g in xrange(random.randint(1, 10)):
-          f.AttendanceFactory(user=user, school=random.choice(schools), role=role, data_source=source)
-        sys.stdout.write('.')
-        sys.stdout.flush()
-    sys.stdout.write('\n')
+    if User.objects.filter(username__gte=USERNAME % 0, username__lte=USERNAME % (options['users'] - 1)).exists():
+      raise CommandError('Test data users exist already, create the data on an empty database')
+    self.options = options
+    self.random = random.Random(options['seed'])
+    self.source, _ = Source.objects.get_or_create(name=options['source'])
+    self.attributes = [Attribute.objects.get_or_create(name='attribute%d' % i)[0]
+        for i in xrange(options['attributes'])]
+    self.roles = {name: Role.objects.get_or_create(name=name)[0] for name in ('teacher', 'student')}
+    self.schools = []
+    for m in xrange(options['municipalities']):
+      muni, _ = Municipality.objects.get_or_create(municipality_id='%07d-%d' % (m, m % 10),
+          defaults={'name': 'Municipality%d' % m, 'data_source': self.source})
+      for s in xrange(options['schools']):
+        school, _ = School.objects.get_or_create(school_id='%05d' % (m * options['schools'] + s),
+            defaults={'name': 'School%d-%d' % (m, s), 'municipality': muni, 'data_source': self.source})
+        self.schools.append(school)
 
-# vim: tabstop=2 expandtab shiftwidth=2 softtabstop=2
+    started = time.time()
+    for first in xrange(0, options['users'], options['batch_size']):
+      with transaction.atomic():
+        self.create_users(first, min(first + options['batch_size'], options['users']))
+      elapsed = time.time() - started
+      count = min(first + options['batch_size'], options['users'])
+      self.stdout.write('Created %d users, %.0f users/s' % (count, count / elapsed if elapsed else 0))
+
+  def value(self, *args):
+    return hashlib.md5(':'.join(str(a) for a in (self.options['seed'],) + args)).hexdigest()[:16]
 
+  def bulk_create(self, model, objs):
+    """ Creates objs in chunks of at most 1000 rows, fewer if the database needs """
+    size = min(1000, connection.ops.bulk_batch_size(model._meta.concrete_fields, objs) or 1)
+    model.objects.bulk_create(objs, batch_size=size)
+
+  def create_users(self, first, last):
+    options = self.options
+    rng = self.random
+    users = [User(username=USERNAME % i, first_name='First%d' % i, last_name='Last%d' % i,
+                  email='user%d@example.com' % i, password=UNUSABLE_PASSWORD_PREFIX)
+             for i in xrange(first, last)]
+    self.bulk_create(User, users)
+    # Usernames are numbered, so the new users are a range of them
+    ids = dict(User.objects.filter(username__gte=USERNAME % first, username__lte=USERNAME % (last - 1))
+        .values_list('username', 'pk'))
+    attributes = []
+    attendances = []
+    for i in xrange(first, last):
+      user_id = ids[USERNAME % i]
+      for attribute in self.attributes:
+        if rng.random() < options['attribute_ratio']:
+          value = self.value(attribute.name, i)
+          attributes.append(UserAttribute(user_id=user_id, attribute=attribute, value=value,
+              value_hash=hash_value(value), data_source=self.source))
+      school = rng.choice(self.schools)
+      if rng.random() < options['teacher_ratio']:
+        role = self.roles['teacher']
+        groups = rng.sample(xrange(100), rng.randint(1, max(1, options['max_groups'])))
+      else:
+        role = self.roles['student']
+        groups = rng.sample(xrange(100), rng.randint(1, 2))
+      for g in groups:
+        group = '%d%s' % (g % 9 + 1, 'ABCDEFGHIJK'[g % 11])
+        attendances.append(Attendance(user_id=user_id, school=school, role=role, group=group,
+            data_source=self.source))
+    self.bulk_create(UserAttribute, attributes)
+    self.bulk_create(Attendance, attendances)
+    signals.bulk_written(ids.values(), [(a.attribute_id, a.value) for a in attributes], bump=False)
+
+# vim: tabstop=2 expandtab shiftwidth=2 softtabstop=2
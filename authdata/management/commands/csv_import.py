@@ -23,13 +23,19 @@
 # THE SOFTWARE.
 
 import csv
-import codecs
+import hashlib
+import multiprocessing
+import time
 from optparse import make_option
-from collections import OrderedDict
+from collections import Counter, OrderedDict
 from django.core.management.base import BaseCommand, CommandError
 from django.db import IntegrityError
-from django.core.exceptions import ObjectDoesNotExist
-from authdata.models import User, Role, Attribute, UserAttribute, Municipality, School, Attendance, Source
+from django.db import connection
+from django.db import transaction
+from django.db.models import Case, When, Value
+from django.utils import timezone
+from authdata import signals
+from authdata.models import User, Role, Attribute, UserAttribute, Municipality, School, Attendance, Source, ImportCheckpoint, hash_value
 
 
 class Command(BaseCommand):
@@ -39,6 +45,23 @@ Do not put any header to the CSV file. Only provide data separated by commas and
 You need to provide at least two arguments: the name of the input file and list of attributes for the User.
 
 For example: manage.py csv_import file.csv dreamschool,facebook,twitter,linkedin,mepin
+
+Rows are written in batches, each batch in a transaction of its own. If a
+batch fails its rows are written one by one and the failing rows reported.
+With --workers the batches are written by a pool of processes.
+
+With --sync the file is the complete data of the source. The attributes and
+attendances of the source are read to memory and only the differences to the
+file are written: missing users, attributes and attendances are created,
+changed names updated, attributes not in the file disabled, disabled
+attributes back in the file enabled and attendances not in the file removed.
+Only the users of the source are read up front, other users in the file are
+looked up a batch at a time. Attributes not named on the command line are not
+touched. Nothing is written for rows which have not changed.
+
+The position in the file is recorded after each batch. If an import is
+interrupted, run it again with --resume to continue after the last
+committed batch.
 """
   args = '<csvfile> <attr1,attr2...>'
   option_list = BaseCommand.option_list + (
@@ -52,6 +75,28 @@ For example: manage.py csv_import file.csv dreamschool,facebook,twitter,linkedin
         dest='municipality',
         default='-',
         help='Source value for this run'),
+    make_option('--batch-size',
+        action='store',
+        dest='batch_size',
+        type='int',
+        default=1000,
+        help='Number of rows written in a transaction'),
+    make_option('--workers',
+        action='store',
+        dest='workers',
+        type='int',
+        default=1,
+        help='Number of processes writing rows'),
+    make_option('--sync',
+        action='store_true',
+        dest='sync',
+        default=False,
+        help='Only write the changes to the data of the source, removing what is not in the file'),
+    make_option('--resume',
+        action='store_true',
+        dest='resume',
+        default=False,
+        help='Continue an interrupted import of the same file from where it stopped'),
     make_option('--run',
         action='store_true',
         dest='really_do_this',
@@ -67,6 +112,12 @@ For example: manage.py csv_import file.csv dreamschool,facebook,twitter,linkedin
   def handle(self, *args, **options):
     if len(args) != 2:
       raise CommandError('Wrong parameters, try reading --help')
+    if options['workers'] > 1 and connection.vendor == 'sqlite':
+      raise CommandError('SQLite allows only one writer at a time, --workers can not be used')
+    if options['workers'] > 1 and options['sync']:
+      raise CommandError('--workers can not be used with --sync')
+    if options['resume'] and (options['workers'] > 1 or options['sync']):
+      raise CommandError('--resume can not be used with --workers or --sync')
     self.verbose = options['verbose']
     self.municipality = options['municipality']
     # Create needed Attribute objects to the database
@@ -81,68 +132,421 @@ For example: manage.py csv_import file.csv dreamschool,facebook,twitter,linkedin
     self.role_names = OrderedDict()
     for r in ['teacher', 'student']:
       self.role_names[r], _ = Role.objects.get_or_create(name=r)
+    # Schools are looked up by school_id, see school()
+    self.schools = None
+
+    self.batch_size = options['batch_size']
+    self.really = options['really_do_this']
+    self.started = time.time()
+    self.count = 0
+    f = open(args[0], 'rb')
+    # Progress is recorded by serial imports only. With --workers batches
+    # are committed out of order and --sync needs to see every row.
+    self.checkpoint = None
+    if self.really and not options['sync'] and options['workers'] <= 1:
+      self.checkpoint = self.get_checkpoint(f, options['resume'])
+      f.seek(self.checkpoint.offset)
+      self.count = self.checkpoint.rows
+      if self.count:
+        self.stdout.write('Resuming after %d rows' % self.count)
+    self.offset = f.tell()
+    csv_data = csv.reader(self.lines(f), delimiter=',', quotechar='"')
+    rows = (self.parse_row(r) for r in csv_data)
+    if options['sync']:
+      self.sync(rows)
+    elif self.really and options['workers'] > 1:
+      self.import_parallel(rows, options['workers'])
+    else:
+      for batch in self.batches(rows):
+        self.import_batch(batch)
+
+  def get_checkpoint(self, f, resume):
+    """ Returns the checkpoint of the file for the source
+
+    Unless resume is set the checkpoint is reset to the start of the file.
+    """
+    digest = hashlib.sha1()
+    for chunk in iter(lambda: f.read(1024 * 1024), ''):
+      digest.update(chunk)
+    checkpoint, _ = ImportCheckpoint.objects.get_or_create(file_hash=digest.hexdigest(), source=self.source)
+    if not resume:
+      checkpoint.offset = checkpoint.batch = checkpoint.rows = 0
+      checkpoint.save()
+    return checkpoint
+
+  def lines(self, f):
+    """ Yields the lines of f, keeping self.offset at the end of the last line read
+
+    The CSV reader reads lines only as far as the row it returns, so after a
+    batch has been read self.offset is where the next batch starts.
+    """
+    for line in iter(f.readline, ''):
+      self.offset += len(line)
+      yield line
+
+  def parse_row(self, r):
+    # Compared to the values read from the database
+    r = [c.decode('utf-8') for c in r]
+    # These are the fixed fields for the User. These are returned from the API.
+    data = {
+      'username': r[0],  # OID
+      'school': r[1],  # School
+      'group': r[2],  # Class
+      'role': r[3],  # Role
+      'first_name': r[4],  # First name
+      'last_name': r[5],  # Last name
+    }
+
+    # This is not mandatory, but it would be nice. Can be changed to error by terminating the script here.
+    if data['role'] not in self.role_names.keys():
+      self.stdout.write('WARNING, role not in: %r' % self.role_names.keys())
+
+    attributes = {}
+    i = 6  # Next csv_data row index is 6 :)
+    for a in self.attribute_names:
+      attributes[a] = r[i]
+      i = i + 1
+
+    if self.verbose:
+      self.stdout.write(repr(data))
+      self.stdout.write(repr(attributes))
+    return data, attributes
+
+  def batches(self, rows):
+    batch = []
+    for row in rows:
+      batch.append(row)
+      if len(batch) >= self.batch_size:
+        yield batch
+        batch = []
+    if batch:
+      yield batch
+
+  def import_batch(self, rows):
+    failures = []
+    if self.really:
+      # Schools are created before the batch transaction so that the cached
+      # schools stay valid if the batch fails
+      for d, _ in rows:
+        self.school(d['school'])
+      failures = self.write_batch(rows)
+    self.report(len(rows), failures)
+    if self.checkpoint:
+      # Batches can be written again, so a crash before this only repeats
+      # the last batch
+      self.checkpoint.offset = self.offset
+      self.checkpoint.batch += 1
+      self.checkpoint.rows = self.count
+      self.checkpoint.save()
+
+  def import_parallel(self, rows, workers):
+    """ Writes rows with a pool of worker processes
+
+    Rows are sharded by a hash of the username and each shard has at most
+    one batch being written at a time, so concurrent batches never have the
+    same users. Schools are created by this process before the rows are sent
+    to the workers.
+    """
+    # The workers must not share the database connection of this process
+    connection.close()
+    pool = multiprocessing.Pool(workers, _init_worker,
+        (self.municipality, self.attribute_names, self.source, self.role_names))
+    shards = [[] for _ in xrange(workers)]
+    # The batch of each shard being written
+    running = [None] * workers
+
+    def submit(shard):
+      # Waiting for the previous batch of the shard also keeps this process
+      # from reading the file further ahead than the workers can write
+      if running[shard] is not None:
+        self.report(*running[shard].get())
+      running[shard] = pool.apply_async(_write_batch, (shards[shard],))
+      shards[shard] = []
+
+    try:
+      for d, a in rows:
+        self.school(d['school'])
+        shard = int(hashlib.md5(d['username'].encode('utf-8')).hexdigest(), 16) % workers
+        shards[shard].append((d, a))
+        if len(shards[shard]) >= self.batch_size:
+          submit(shard)
+      for shard in xrange(workers):
+        if shards[shard]:
+          submit(shard)
+      for result in running:
+        if result is not None:
+          self.report(*result.get())
+    except BaseException:
+      pool.terminate()
+      raise
+    pool.close()
+    pool.join()
+
+  def write_batch(self, rows):
+    """ Writes rows in a transaction. Returns the failing rows with their errors. """
+    try:
+      with transaction.atomic():
+        self.really_do_this(rows)
+      return []
+    except IntegrityError:
+      # Find the failing rows
+      failures = []
+      for d, a in rows:
+        try:
+          with transaction.atomic():
+            self.really_do_this([(d, a)])
+        except IntegrityError, e:
+          failures.append((unicode(e), d, a))
+      return failures
+
+  def report(self, count, failures):
+    for e, d, a in failures:
+      self.stdout.write('ERR IE %s' % e)
+      self.stdout.write(repr(d))
+      self.stdout.write(repr(a))
+    self.count += count
+    elapsed = time.time() - self.started
+    self.stdout.write('Imported %d rows, %.0f rows/s' % (self.count, self.count / elapsed if elapsed else 0))
+
+  def sync(self, rows):
+    """ Writes only the differences between rows and the data of the source """
+    # Existing rows by key. The key of a row found in the file is mapped to
+    # None, so what is left mapped to a pk at the end is removed.
+    self.attributes = {}
+    # Disabled attributes by key, enabled again if found in the file
+    self.disabled_attributes = {}
+    for pk, user_id, attribute_id, value, disabled_at in UserAttribute.objects.filter(data_source=self.source,
+        attribute__in=self.attribute_names.values()).values_list('pk', 'user_id', 'attribute_id', 'value',
+            'disabled_at').iterator():
+      if disabled_at is None:
+        self.attributes[(user_id, attribute_id, value)] = pk
+      else:
+        self.disabled_attributes[(user_id, attribute_id, value)] = pk
+    self.attendances = {(user_id, school_id, role_id, group): pk for pk, user_id, school_id, role_id, group
+        in Attendance.objects.filter(data_source=self.source)
+            .values_list('pk', 'user_id', 'school_id', 'role_id', 'group').iterator()}
+    # username: [pk, first_name, last_name] of the users of the source
+    self.users = {}
+    user_ids = sorted(set(key[0] for key in self.attributes) | set(key[0] for key in self.disabled_attributes) |
+        set(key[0] for key in self.attendances))
+    for i in xrange(0, len(user_ids), self.batch_size):
+      self.load_users(pk__in=user_ids[i:i + self.batch_size])
+    self.delta = Counter()
+    self.schools = {school.school_id: school for school in School.objects.all()}
+    for batch in self.batches(rows):
+      if self.really:
+        for d, _ in batch:
+          self.school(d['school'])
+      self.sync_batch(batch)
+      self.report(len(batch), [])
+    if not self.count:
+      raise CommandError('No rows in the file, refusing to remove all data of the source')
+    removed_attributes = [pk for pk in self.attributes.itervalues() if pk is not None]
+    removed_attendances = [pk for pk in self.attendances.itervalues() if pk is not None]
+    self.delta['attributes_disabled'] = len(removed_attributes)
+    self.delta['attendances_removed'] = len(removed_attendances)
+    if self.really:
+      now = timezone.now()
+      for i in xrange(0, len(removed_attributes), self.batch_size):
+        with transaction.atomic():
+          chunk = UserAttribute.objects.filter(pk__in=removed_attributes[i:i + self.batch_size])
+          user_ids = list(chunk.values_list('user_id', flat=True))
+          chunk.update(disabled_at=now, modified=now)
+          signals.bulk_written(user_ids)
+      for i in xrange(0, len(removed_attendances), self.batch_size):
+        with transaction.atomic():
+          pks = removed_attendances[i:i + self.batch_size]
+          user_ids = list(Attendance.objects.filter(pk__in=pks).values_list('user_id', flat=True))
+          # QuerySet.delete() would send a signal for each attendance
+          connection.cursor().execute('DELETE FROM authdata_attendance WHERE id IN (%s)'
+              % ', '.join(['%s'] * len(pks)), pks)
+          signals.bulk_written(user_ids)
+    self.stdout.write(', '.join('%s: %d' % item for item in sorted(self.delta.items())))
+
+  def load_users(self, **lookup):
+    for pk, username, first_name, last_name in User.objects.filter(**lookup) \
+        .values_list('pk', 'username', 'first_name', 'last_name').iterator():
+      self.users[username] = [pk, first_name, last_name]
+
+  def sync_batch(self, rows):
+    """ Writes the differences between rows and the data of the source """
+    # Users not of the source yet
+    others = set(d['username'] for d, _ in rows if d['username'] not in self.users)
+    if others:
+      self.load_users(username__in=others)
+    new_users = OrderedDict()
+    changed_users = OrderedDict()
+    # Keys of new attributes and attendances have the username in place of
+    # the user id, since new users have no id yet
+    new_attributes = OrderedDict()
+    enabled_attributes = OrderedDict()  # pk: key
+    new_attendances = OrderedDict()
+    for d, a in rows:
+      username = d['username']
+      names = [d['first_name'], d['last_name']]
+      user = self.users.get(username)
+      if user is None:
+        new_users[username] = names
+      elif user[1:] != names:
+        changed_users[user[0]] = names
+        user[1:] = names
+      for k, v in a.iteritems():
+        attribute_id = self.attribute_names[k].pk
+        key = (user[0], attribute_id, v) if user else None
+        if key in self.attributes:
+          self.attributes[key] = None
+        elif key in self.disabled_attributes:
+          enabled_attributes[self.disabled_attributes.pop(key)] = key
+          self.attributes[key] = None
+        else:
+          new_attributes[(username, attribute_id, v)] = None
+      if d['role'] in self.role_names:
+        # Schools are not created without --run
+        school = self.schools.get(d['school'])
+        key = (school.pk if school else ('new', d['school']), self.role_names[d['role']].pk, d['group'])
+        if user is None or (user[0],) + key not in self.attendances:
+          new_attendances[(username,) + key] = None
+        else:
+          self.attendances[(user[0],) + key] = None
+    self.delta['users_created'] += len(new_users)
+    self.delta['users_updated'] += len(changed_users)
+    self.delta['attributes_created'] += len(new_attributes)
+    self.delta['attributes_enabled'] += len(enabled_attributes)
+    self.delta['attendances_created'] += len(new_attendances)
+    if not (new_users or changed_users or new_attributes or enabled_attributes or new_attendances):
+      return
+
+    if self.really:
+      with transaction.atomic():
+        self.write_delta(new_users, changed_users, new_attributes, enabled_attributes, new_attendances)
+    else:
+      for username, names in new_users.iteritems():
+        # Stands in for the id in the keys of the rows of the new user
+        self.users[username] = [('new', username)] + names
+    for username, attribute_id, value in new_attributes:
+      self.attributes[(self.users[username][0], attribute_id, value)] = None
+    for username, school_id, role_id, group in new_attendances:
+      self.attendances[(self.users[username][0], school_id, role_id, group)] = None
+
+  def write_delta(self, new_users, changed_users, new_attributes, enabled_attributes, new_attendances):
+    now = timezone.now()
+    if new_users:
+      User.objects.bulk_create([User(username=username, first_name=first_name, last_name=last_name)
+          for username, (first_name, last_name) in new_users.iteritems()])
+      for user in User.objects.filter(username__in=new_users.keys()):
+        self.users[user.username] = [user.pk, user.first_name, user.last_name]
+    if changed_users:
+      User.objects.filter(pk__in=changed_users.keys()).update(
+          first_name=Case(*[When(pk=pk, then=Value(names[0])) for pk, names in changed_users.iteritems()]),
+          last_name=Case(*[When(pk=pk, then=Value(names[1])) for pk, names in changed_users.iteritems()]),
+          modified=now,
+          last_changed=now)
+    attributes = []
+    for username, attribute_id, value in new_attributes:
+      attributes.append(UserAttribute(user_id=self.users[username][0], attribute_id=attribute_id, value=value,
+          value_hash=hash_value(value), data_source=self.source))
+    UserAttribute.objects.bulk_create(attributes)
+    attendances = [Attendance(user_id=self.users[username][0], school_id=school_id, role_id=role_id, group=group,
+        data_source=self.source) for username, school_id, role_id, group in new_attendances]
+    Attendance.objects.bulk_create(attendances)
+    if enabled_attributes:
+      UserAttribute.objects.filter(pk__in=enabled_attributes.keys()).update(disabled_at=None, modified=now)
+
+    # Once for all rows, so that the document of each user is rebuilt once
+    signals.bulk_written([self.users[username][0] for username in new_users] + changed_users.keys() +
+        [a.user_id for a in attributes] + [key[0] for key in enabled_attributes.itervalues()] +
+        [a.user_id for a in attendances],
+        [(a.attribute_id, a.value) for a in attributes] + [key[1:] for key in enabled_attributes.itervalues()])
+
+  def school(self, school_id):
+    if self.schools is None:
+      self.schools = {s.school_id: s for s in School.objects.all()}
+    if school_id not in self.schools:
+      # Create Municipality
+      # If you leave this empty on the CLI it will default to '-'
+      municipality, _ = Municipality.objects.get_or_create(name=self.municipality,
+          defaults={'data_source': self.source})
+      # Create School
+      # School data is not updated after it is created. Data can be then changed in the admin.
+      self.schools[school_id], _ = School.objects.get_or_create(school_id=school_id,
+          defaults={'municipality': municipality, 'name': school_id, 'data_source': self.source})
+    return self.schools[school_id]
+
+  def really_do_this(self, rows):
+    """ Writes rows with a few bulk queries """
+    now = timezone.now()
 
-    csv_data = csv.reader(codecs.open(args[0], 'rb'), delimiter=',', quotechar='"')
-    for r in csv_data:
-      # These are the fixed fields for the User. These are returned from the API.
-      data = {
-        'username': r[0],  # OID
-        'school': r[1],  # School
-        'group': r[2],  # Class
-        'role': r[3],  # Role
-        'first_name': r[4],  # First name
-        'last_name': r[5],  # Last name
-      }
-
-      # This is not mandatory, but it would be nice. Can be changed to error by terminating the script here.
-      if data['role'] not in self.role_names.keys():
-        print 'WARNING, role not in:', repr(self.role_names.keys())
-
-      attributes = {}
-      i = 6  # Next csv_data row index is 6 :)
-      for a in self.attribute_names:
-        attributes[a] = r[i]
-        i = i + 1
-
-      try:
-        if self.verbose:
-          print repr(data)
-          print repr(attributes)
-        if options['really_do_this']:
-          self.really_do_this(data.copy(), attributes.copy())
-      except IntegrityError, e:
-        print "ERR IE", e
-        print repr(data)
-        print repr(attributes)
-      except ObjectDoesNotExist, e:
-        print "ERR ODN", e
-        print repr(data)
-        print repr(attributes)
-
-  def really_do_this(self, d, a):
     # Create User
     # User is identified from username and other fields are updated
-    user, _ = User.objects.get_or_create(username=d['username'])
-    user.first_name = d['first_name']
-    user.last_name = d['last_name']
-    user.save()
+    names = OrderedDict((d['username'], (d['first_name'], d['last_name'])) for d, _ in rows)
+    users = {u.username: u for u in User.objects.filter(username__in=names.keys())}
+    new_users = [User(username=username, first_name=first_name, last_name=last_name)
+        for username, (first_name, last_name) in names.iteritems() if username not in users]
+    changed_users = [u for u in users.itervalues() if (u.first_name, u.last_name) != names[u.username]]
+    if new_users:
+      User.objects.bulk_create(new_users)
+      new_users = list(User.objects.filter(username__in=[u.username for u in new_users]))
+      users.update((u.username, u) for u in new_users)
+    if changed_users:
+      User.objects.filter(pk__in=[u.pk for u in changed_users]).update(
+          first_name=Case(*[When(pk=u.pk, then=Value(names[u.username][0])) for u in changed_users]),
+          last_name=Case(*[When(pk=u.pk, then=Value(names[u.username][1])) for u in changed_users]),
+          modified=now,
+          last_changed=now)
+    user_ids = [u.pk for u in users.itervalues()]
 
     # Assign attributes for User
     # There can be multiple attributes with the same name and different value.
-    # This is one of the reasons we have the source parameter to tell where the data came from.
-    for k, v in a.iteritems():
-      UserAttribute.objects.get_or_create(user=user, attribute=self.attribute_names[k], value=v, source=self.source)
+    # This is one of the reasons we have the data_source parameter to tell where the data came from.
+    existing = set(UserAttribute.objects.filter(user__in=user_ids, data_source=self.source)
+        .values_list('user_id', 'attribute_id', 'value'))
+    new_attributes = OrderedDict()
+    for d, a in rows:
+      for k, v in a.iteritems():
+        key = (users[d['username']].pk, self.attribute_names[k].pk, v)
+        if key not in existing:
+          new_attributes[key] = UserAttribute(user_id=key[0], attribute=self.attribute_names[k], value=v,
+              value_hash=hash_value(v), data_source=self.source)
+    UserAttribute.objects.bulk_create(new_attributes.values())
 
-    # Create Municipality
-    # If you leave this empty on the CLI it will default to '-'
-    municipality, _ = Municipality.objects.get_or_create(name=self.municipality)
+    # Create Attendance object for User. There can be more than one Attendance per User.
+    existing = set(Attendance.objects.filter(user__in=user_ids, data_source=self.source)
+        .values_list('user_id', 'school_id', 'role_id', 'group'))
+    new_attendances = OrderedDict()
+    for d, _ in rows:
+      if d['role'] not in self.role_names:
+        continue
+      key = (users[d['username']].pk, self.schools[d['school']].pk, self.role_names[d['role']].pk, d['group'])
+      if key not in existing:
+        new_attendances[key] = Attendance(user_id=key[0], school_id=key[1], role_id=key[2], group=key[3],
+            data_source=self.source)
+    Attendance.objects.bulk_create(new_attendances.values())
 
-    # Create School
-    # School data is not updated after it is created. Data can be then changed in the admin.
-    school, _ = School.objects.get_or_create(school_id=d['school'], defaults={'municipality': municipality, 'name': d['school']})
+    signals.bulk_written([u.pk for u in new_users + changed_users], bump=False)
+    signals.bulk_written([a.user_id for a in new_attributes.itervalues()],
+        [(a.attribute_id, a.value) for a in new_attributes.itervalues()])
+    signals.bulk_written([a.user_id for a in new_attendances.itervalues()])
 
-    # Create Attendance object for User. There can be more than one Attendance per User.
-    Attendance.objects.get_or_create(user=user, school=school, role=self.role_names[d['role']], group=d['group'], source=self.source)
 
-# vim: tabstop=2 expandtab shiftwidth=2 softtabstop=2
+_worker = None
 
+
+def _init_worker(municipality, attribute_names, source, role_names):
+  global _worker  # pylint: disable=global-statement
+  # Each worker opens a database connection of its own
+  connection.close()
+  _worker = Command()
+  _worker.municipality = municipality
+  _worker.attribute_names = attribute_names
+  _worker.source = source
+  _worker.role_names = role_names
+  _worker.schools = None
+
+
+def _write_batch(rows):
+  for d, _ in rows:
+    # Created by the parent process already
+    _worker.school(d['school'])
+  return len(rows), _worker.write_batch(rows)
+
+# vim: tabstop=2 expandtab shiftwidth=2 softtabstop=2
@@ -0,0 +1,53 @@
+# -*- encoding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2014-2015 Haltu Oy, http://haltu.fi
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from authdata import documents
+
+
+class Command(BaseCommand):
+  help = """Rebuilds the stored query responses of all local users.
+
+Writers rebuild the documents of the users they change. Run this after
+writing data without the ORM or authdata.signals.bulk_written, or after
+attendances or user attributes were deleted one by one, which removes the
+documents of their users.
+"""
+  option_list = BaseCommand.option_list + (
+    make_option('--chunk-size',
+        action='store',
+        dest='chunk_size',
+        type='int',
+        default=1000,
+        help='Number of users read and written at a time'),
+  )
+
+  def handle(self, *args, **options):
+    count = documents.rebuild(chunk_size=options['chunk_size'])
+    self.stdout.write('Rebuilt %d user documents' % count)
+
+# vim: tabstop=2 expandtab shiftwidth=2 softtabstop=2
+
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authdata', '0005_auto_20151230_2139'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PendingProvision',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('created', models.DateTimeField(help_text='When the object was created', auto_now_add=True)),
+                ('modified', models.DateTimeField(help_text='Updated every time the object is modified', auto_now=True)),
+                ('username', models.CharField(max_length=2048)),
+                ('external_id', models.CharField(max_length=2000)),
+                ('external_source', models.CharField(max_length=2000)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import hashlib
+
+from django.db import migrations, models
+from django.db.models import Count, Min
+from django.utils.encoding import force_bytes
+
+
+INDEX_NAME = 'authdata_userattribute_enabled_value'
+
+
+def merge_duplicate_attributes(apps, schema_editor):
+    # Attribute.name becomes unique. Point user attributes of duplicate
+    # attributes to the oldest one before removing the duplicates.
+    Attribute = apps.get_model('authdata', 'Attribute')
+    UserAttribute = apps.get_model('authdata', 'UserAttribute')
+    duplicates = Attribute.objects.values('name').annotate(count=Count('id'), first=Min('id')).filter(count__gt=1)
+    for duplicate in duplicates:
+        others = Attribute.objects.filter(name=duplicate['name']).exclude(id=duplicate['first'])
+        UserAttribute.objects.filter(attribute__in=others).update(attribute=duplicate['first'])
+        others.delete()
+
+
+def fill_value_hash(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute('UPDATE authdata_userattribute SET value_hash = md5(value) WHERE value IS NOT NULL')
+        return
+    UserAttribute = apps.get_model('authdata', 'UserAttribute')
+    for pk, value in UserAttribute.objects.exclude(value=None).values_list('pk', 'value').iterator():
+        UserAttribute.objects.filter(pk=pk).update(value_hash=hashlib.md5(force_bytes(value)).hexdigest())
+
+
+def create_value_index(apps, schema_editor):
+    if schema_editor.connection.vendor in ('postgresql', 'sqlite'):
+        schema_editor.execute('CREATE INDEX %s ON authdata_userattribute (attribute_id, value_hash) '
+                              'WHERE disabled_at IS NULL' % INDEX_NAME)
+    else:
+        # Partial indexes are not supported, index all rows
+        schema_editor.execute('CREATE INDEX %s ON authdata_userattribute (attribute_id, value_hash)' % INDEX_NAME)
+
+
+def drop_value_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'mysql':
+        schema_editor.execute('DROP INDEX %s ON authdata_userattribute' % INDEX_NAME)
+    else:
+        schema_editor.execute('DROP INDEX %s' % INDEX_NAME)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authdata', '0006_pendingprovision'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_attributes, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='attribute',
+            name='name',
+            field=models.CharField(default=None, max_length=2048, unique=True, null=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='userattribute',
+            name='value_hash',
+            field=models.CharField(default=None, editable=False, max_length=32, blank=True, help_text='Digest of value, maintained on save', null=True),
+        ),
+        migrations.RunPython(fill_value_hash, migrations.RunPython.noop),
+        migrations.RunPython(create_value_index, drop_value_index),
+    ]
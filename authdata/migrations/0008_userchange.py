@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def fill_changes(apps, schema_editor):
+    # Start the log from the current modification times. Removed rows are
+    # not known, so clients should do a full sync after this migration.
+    now = schema_editor.connection.ops.value_to_db_datetime(timezone.now())
+    schema_editor.execute(
+        "INSERT INTO authdata_userchange (user_id, changed_at, kind) "
+        "SELECT id, modified, 'user' FROM authdata_user")
+    schema_editor.execute(
+        "INSERT INTO authdata_userchange (user_id, changed_at, kind) "
+        "SELECT user_id, modified, 'attribute' FROM authdata_userattribute")
+    schema_editor.execute(
+        "INSERT INTO authdata_userchange (user_id, changed_at, kind) "
+        "SELECT user_id, modified, 'attendance' FROM authdata_attendance")
+    schema_editor.execute(
+        "INSERT INTO authdata_userchange (user_id, changed_at, kind) "
+        "SELECT DISTINCT authdata_userattribute.user_id, %s, 'related' FROM authdata_userattribute "
+        "JOIN authdata_attribute ON authdata_attribute.id = authdata_userattribute.attribute_id "
+        "WHERE authdata_attribute.modified > authdata_userattribute.modified", [now])
+    schema_editor.execute(
+        "INSERT INTO authdata_userchange (user_id, changed_at, kind) "
+        "SELECT DISTINCT authdata_attendance.user_id, %s, 'related' FROM authdata_attendance "
+        "JOIN authdata_role ON authdata_role.id = authdata_attendance.role_id "
+        "WHERE authdata_role.modified > authdata_attendance.modified", [now])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authdata', '0007_attribute_value_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserChange',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('changed_at', models.DateTimeField()),
+                ('kind', models.CharField(max_length=20, choices=[('user', 'User'), ('attribute', 'Attribute'), ('attribute_removed', 'Attribute removed'), ('attendance', 'Attendance'), ('attendance_removed', 'Attendance removed'), ('related', 'Attribute, role, school or municipality')])),
+                ('user', models.ForeignKey(related_name='changes', on_delete=models.DO_NOTHING, db_constraint=False, to='authdata.User')),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='userchange',
+            index_together=set([('changed_at', 'user')]),
+        ),
+        migrations.RunPython(fill_changes, migrations.RunPython.noop),
+    ]
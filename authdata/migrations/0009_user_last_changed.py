@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+def fill_last_changed(apps, schema_editor):
+    schema_editor.execute(
+        "UPDATE authdata_user SET last_changed = "
+        "(SELECT MAX(changed_at) FROM authdata_userchange WHERE authdata_userchange.user_id = authdata_user.id) "
+        "WHERE EXISTS (SELECT 1 FROM authdata_userchange WHERE authdata_userchange.user_id = authdata_user.id)")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authdata', '0008_userchange'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='last_changed',
+            field=models.DateTimeField(default=django.utils.timezone.now, help_text='Updated when the user or its attributes, attendances or the rows they refer to change', auto_now=True, db_index=True),
+            preserve_default=False,
+        ),
+        migrations.RunPython(fill_last_changed, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authdata', '0009_user_last_changed'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserDocument',
+            fields=[
+                ('user', models.OneToOneField(related_name='document', primary_key=True, serialize=False, to='authdata.User')),
+                ('last_changed', models.DateTimeField()),
+                ('body', models.TextField()),
+            ],
+        ),
+    ]
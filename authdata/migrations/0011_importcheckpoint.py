@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authdata', '0010_userdocument'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportCheckpoint',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('created', models.DateTimeField(help_text='When the object was created', auto_now_add=True)),
+                ('modified', models.DateTimeField(help_text='Updated every time the object is modified', auto_now=True)),
+                ('file_hash', models.CharField(help_text='SHA-1 of the imported file', max_length=40)),
+                ('offset', models.BigIntegerField(default=0, help_text='Byte offset of the first row not imported')),
+                ('batch', models.IntegerField(default=0, help_text='Number of the last committed batch')),
+                ('rows', models.BigIntegerField(default=0, help_text='Number of rows imported')),
+                ('source', models.ForeignKey(related_name='import_checkpoints', to='authdata.Source')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='importcheckpoint',
+            unique_together=set([('file_hash', 'source')]),
+        ),
+    ]
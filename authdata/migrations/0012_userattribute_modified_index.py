@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authdata', '0011_importcheckpoint'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='userattribute',
+            index_together=set([('modified',)]),
+        ),
+    ]
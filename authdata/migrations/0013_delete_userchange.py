@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authdata', '0012_userattribute_modified_index'),
+    ]
+
+    operations = [
+        migrations.DeleteModel(
+            name='UserChange',
+        ),
+    ]
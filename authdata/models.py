@@ -33,9 +33,11 @@ User has :py:class:`Attendance` for a group in school with role.
 School is in Municipality.
 """
 
+import hashlib
 import logging
 from django.db import models
 from django.contrib.auth.models import AbstractUser
+from django.utils.encoding import force_bytes
 
 LOG = logging.getLogger(__name__)
 
@@ -74,9 +76,15 @@ class User(TimeStampedModel, AbstractUser):
 
   It should be considered if it is good practice to use the same model
   in different confusing ways even if it works.
+
+  ``last_changed`` is bumped whenever the data of the user changes, see
+  :py:mod:`authdata.changelog`, so users changed since a given time are
+  found with the index on it alone.
   """
   external_source = models.CharField(max_length=2000, blank=True, default='')
   external_id = models.CharField(max_length=2000, blank=True, default='')
+  last_changed = models.DateTimeField(auto_now=True, db_index=True,
+      help_text=u'Updated when the user or its attributes, attendances or the rows they refer to change')
 
   def __unicode__(self):
     return self.username
@@ -116,22 +124,43 @@ class School(TimeStampedModel):
 
 
 class Attribute(TimeStampedModel):
-  name = models.CharField(max_length=2048, blank=True, null=True, default=None)
+  name = models.CharField(max_length=2048, unique=True, blank=True, null=True, default=None)
 
   def __unicode__(self):
     return self.name
 
 
+def hash_value(value):
+  """ Returns the digest of an attribute value stored to UserAttribute.value_hash.
+
+  Values can be longer than the database is able to index, so lookups by
+  value go through an index on (attribute_id, value_hash) of enabled rows.
+  """
+  if value is None:
+    return None
+  return hashlib.md5(force_bytes(value)).hexdigest()
+
+
 class UserAttribute(TimeStampedModel):
   user = models.ForeignKey(User, related_name='attributes')
   attribute = models.ForeignKey(Attribute)
   value = models.CharField(max_length=2048, blank=True, null=True, default=None)
+  value_hash = models.CharField(max_length=32, blank=True, null=True, default=None, editable=False,
+      help_text=u'Digest of value, maintained on save')
   data_source = models.ForeignKey(Source)
   disabled_at = models.DateTimeField(null=True, blank=True)
 
+  class Meta:
+    # Rows saved by other processes are read by modified, see authdata.lookup_filter
+    index_together = [('modified',)]
+
   def __unicode__(self):
     return u'%s: %s' % (self.attribute, self.value)
 
+  def save(self, *args, **kwargs):
+    self.value_hash = hash_value(self.value)
+    super(UserAttribute, self).save(*args, **kwargs)
+
 
 class Role(TimeStampedModel):
   name = models.CharField(max_length=2048)
@@ -151,5 +180,55 @@ class Attendance(TimeStampedModel):
     return u'%s: %s / %s' % (self.role, self.school.name, self.school.municipality.name)
 
 
+class PendingProvision(TimeStampedModel):
+  """External user waiting to be written to the database.
+
+  Deferred provisioning keeps users in memory until they are written in
+  bulk, see :py:mod:`authdata.datasources.provisioning`. Users which can not
+  be kept in memory or written right away are stored here and provisioned
+  later, also after a restart.
+  """
+  username = models.CharField(max_length=2048)
+  external_id = models.CharField(max_length=2000)
+  external_source = models.CharField(max_length=2000)
+
+  def __unicode__(self):
+    return u'%s: %s' % (self.external_source, self.username)
+
+
+class UserDocument(models.Model):
+  """The query endpoint response of a local user, encoded as JSON.
+
+  ``last_changed`` is the ``last_changed`` of the user the document was built
+  from. A document is current only while the two are equal, see
+  :py:mod:`authdata.documents`.
+  """
+  user = models.OneToOneField(User, primary_key=True, related_name='document')
+  last_changed = models.DateTimeField()
+  body = models.TextField()
+
+  def __unicode__(self):
+    return unicode(self.user_id)
+
+
+class ImportCheckpoint(TimeStampedModel):
+  """Progress of a ``csv_import`` run of a file for a source.
+
+  Written after each committed batch, so ``csv_import --resume`` can
+  continue from ``offset`` instead of reading the file from the start.
+  """
+  file_hash = models.CharField(max_length=40, help_text=u'SHA-1 of the imported file')
+  source = models.ForeignKey(Source, related_name='import_checkpoints')
+  offset = models.BigIntegerField(default=0, help_text=u'Byte offset of the first row not imported')
+  batch = models.IntegerField(default=0, help_text=u'Number of the last committed batch')
+  rows = models.BigIntegerField(default=0, help_text=u'Number of rows imported')
+
+  class Meta:
+    unique_together = [('file_hash', 'source')]
+
+  def __unicode__(self):
+    return u'%s: %s' % (self.source, self.file_hash)
+
+
 # vim: tabstop=2 expandtab shiftwidth=2 softtabstop=2
 
@@ -0,0 +1,65 @@
+# -*- encoding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2014-2015 Haltu Oy, http://haltu.fi
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+"""
+List endpoints are paged with cursors in primary key order. A page is
+selected with ``WHERE id > <last id on the previous page>`` and the
+``next`` and ``previous`` links carry the position in the ``cursor``
+parameter. Every page costs one index range scan no matter how deep the
+client is and no count of all results is made. Rows created while a client
+is paging appear on the last pages and no row is skipped or returned twice.
+
+Page size is set with the ``PAGINATE_BY``, ``PAGINATE_BY_PARAM`` and
+``MAX_PAGINATE_BY`` keys of the ``REST_FRAMEWORK`` setting.
+"""
+
+from django.conf import settings
+from rest_framework import pagination
+
+
+def get_page_size(params):
+  """ Returns the page size requested in the query parameters params """
+  paging = settings.REST_FRAMEWORK
+  page_size = paging.get('PAGINATE_BY') or 10
+  try:
+    page_size = int(params.get(paging.get('PAGINATE_BY_PARAM', 'page_size'), page_size))
+  except ValueError:
+    pass
+  if page_size < 1:
+    page_size = 1
+  if paging.get('MAX_PAGINATE_BY'):
+    page_size = min(page_size, paging['MAX_PAGINATE_BY'])
+  return page_size
+
+
+class IdCursorPagination(pagination.CursorPagination):
+  ordering = 'id'
+
+  def get_page_size(self, request):
+    return get_page_size(request.query_params)
+
+
+# vim: tabstop=2 expandtab shiftwidth=2 softtabstop=2
+
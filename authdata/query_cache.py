@@ -0,0 +1,127 @@
+# -*- encoding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2014-2015 Haltu Oy, http://haltu.fi
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""
+Responses of the query endpoint for local users are cached with the Django
+cache framework, in the cache named by ``AUTHDATA_QUERY_CACHE``, for
+``AUTHDATA_QUERY_CACHE_TIMEOUT`` seconds. Responses are cached encoded as
+JSON, see :py:func:`authdata.documents.encode`, both by username and by the
+queried attribute name and value, and cached responses are returned without
+querying the database.
+
+Cache keys contain a version which is replaced whenever users, their
+attributes, attendances, schools, municipalities, roles or attributes are
+saved or deleted. Entries of older versions are never read again and expire
+from the cache. The version is read before the database is queried, so a
+response built while data was changed is stored under the old version.
+
+The version is stored in the same cache, so the cache must be shared by all
+processes writing or serving data, e.g. memcached, including management
+commands. A local-memory cache has a version of its own in each process and
+serves data changed by other processes until the timeout. Caching is
+disabled when ``AUTHDATA_QUERY_CACHE`` is None, which is the default.
+"""
+
+import hashlib
+import logging
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils.encoding import force_bytes
+
+from authdata.models import User, UserAttribute, Attendance, School, Municipality, Role, Attribute
+
+LOG = logging.getLogger(__name__)
+
+VERSION_KEY = 'authdata:query:version'
+
+
+def is_enabled():
+  return bool(getattr(settings, 'AUTHDATA_QUERY_CACHE', None))
+
+
+def get_cache():
+  return caches[getattr(settings, 'AUTHDATA_QUERY_CACHE', None) or 'default']
+
+
+def _digest(value):
+  return hashlib.md5(force_bytes(value)).hexdigest()
+
+
+def get_version():
+  cache = get_cache()
+  version = cache.get(VERSION_KEY)
+  if version is None:
+    # Another process may have set the version meanwhile
+    cache.add(VERSION_KEY, uuid.uuid4().hex, None)
+    version = cache.get(VERSION_KEY)
+  return version
+
+
+def user_key(username):
+  """ Returns the cache key for a query by username """
+  return 'authdata:query:%s:user:%s' % (get_version(), _digest(username))
+
+
+def attribute_key(name, value):
+  """ Returns the cache key for a query by attribute name and value """
+  return 'authdata:query:%s:attribute:%s:%s' % (get_version(), _digest(name), _digest(value))
+
+
+def get(key):
+  return get_cache().get(key)
+
+
+def store(key, data):
+  get_cache().set(key, data, getattr(settings, 'AUTHDATA_QUERY_CACHE_TIMEOUT', 300))
+
+
+def invalidate():
+  """ Makes all cached responses stale """
+  get_cache().set(VERSION_KEY, uuid.uuid4().hex, None)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+@receiver(post_save, sender=UserAttribute)
+@receiver(post_delete, sender=UserAttribute)
+@receiver(post_save, sender=Attendance)
+@receiver(post_delete, sender=Attendance)
+@receiver(post_save, sender=School)
+@receiver(post_delete, sender=School)
+@receiver(post_save, sender=Municipality)
+@receiver(post_delete, sender=Municipality)
+@receiver(post_save, sender=Role)
+@receiver(post_delete, sender=Role)
+@receiver(post_save, sender=Attribute)
+@receiver(post_delete, sender=Attribute)
+def _invalidate(sender, **kwargs):  # pylint: disable=unused-argument
+  invalidate()
+
+
+# vim: tabstop=2 expandtab shiftwidth=2 softtabstop=2
+
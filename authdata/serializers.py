@@ -24,6 +24,8 @@
 #
 
 
+from django.conf import settings
+from django.db.models import Prefetch
 from rest_framework import serializers
 from authdata.models import User, Attribute, UserAttribute, Municipality, School, Role, Attendance, Source
 
@@ -81,6 +83,10 @@ class QuerySerializer(serializers.ModelSerializer):
   the database.
 
   Returns user objects with roles and attributes.
+
+  Querysets passed to this serializer should go through
+  :py:meth:`setup_eager_loading` so that roles and attributes are read from
+  prefetched data instead of being queried separately for each user.
   """
   roles = serializers.SerializerMethodField('role_data')
   attributes = serializers.SerializerMethodField('attribute_data')
@@ -89,6 +95,22 @@ class QuerySerializer(serializers.ModelSerializer):
     model = User
     fields = ('username', 'first_name', 'last_name', 'roles', 'attributes')
 
+  @staticmethod
+  def setup_eager_loading(queryset):
+    """Prefetch attendances and enabled attributes of the users in queryset
+
+    Enabled attributes are stored to ``active_attributes`` of each user.
+    """
+    return queryset.prefetch_related(
+      Prefetch('attendances', queryset=Attendance.objects.select_related('school__municipality', 'role')),
+      Prefetch('attributes', queryset=UserAttribute.objects.filter(disabled_at__isnull=True).select_related('attribute'), to_attr='active_attributes'),
+    )
+
+  def active_attributes(self, obj):
+    if hasattr(obj, 'active_attributes'):
+      return obj.active_attributes
+    return obj.attributes.filter(disabled_at__isnull=True).select_related('attribute')
+
   def role_data(self, obj):
     data = []
     for a in obj.attendances.all():
@@ -102,7 +124,7 @@ class QuerySerializer(serializers.ModelSerializer):
 
   def attribute_data(self, obj):
     data = []
-    for a in obj.attributes.filter(disabled_at__isnull=True):
+    for a in self.active_attributes(obj):
       d = {}
       d['name'] = a.attribute.name
       d['value'] = a.value
@@ -118,14 +140,31 @@ class UserSerializer(QuerySerializer):
   Only attributes from the querying user's source are returned.
   """
 
+  @staticmethod
+  def setup_eager_loading(queryset, data_sources=None):
+    """Prefetch attendances and the enabled attributes of the given sources
+
+    ``data_sources`` is a list of Source ids resolved once per request.
+    Attributes are stored to ``source_attributes`` of each user. If
+    ``data_sources`` is None all enabled attributes are prefetched.
+    """
+    if data_sources is None:
+      return QuerySerializer.setup_eager_loading(queryset)
+    return queryset.prefetch_related(
+      Prefetch('attendances', queryset=Attendance.objects.select_related('school__municipality', 'role')),
+      Prefetch('attributes', queryset=UserAttribute.objects.filter(disabled_at__isnull=True, data_source__in=data_sources).select_related('attribute'), to_attr='source_attributes'),
+    )
+
   def attribute_data(self, obj):
     # attribute data is filtered. only attributes where source is requesting user's username are returned
     data = []
-    if 'request' in self.context:
-      attribute_qs = obj.attributes.filter(disabled_at__isnull=True, data_source__name=self.context['request'].user.username)
+    if hasattr(obj, 'source_attributes'):
+      attributes = obj.source_attributes
+    elif 'request' in self.context:
+      attributes = obj.attributes.filter(disabled_at__isnull=True, data_source__name=self.context['request'].user.username).select_related('attribute')
     else:
-      attribute_qs = obj.attributes.filter(disabled_at__isnull=True)
-    for a in attribute_qs:
+      attributes = self.active_attributes(obj)
+    for a in attributes:
       d = {}
       d['name'] = a.attribute.name
       d['value'] = a.value
@@ -138,6 +177,38 @@ class UserSerializer(QuerySerializer):
     fields = ('username', 'first_name', 'last_name', 'external_id', 'roles', 'attributes')
 
 
+class AttributeValueSerializer(serializers.Serializer):  # pylint: disable=abstract-method
+  name = serializers.CharField()
+  value = serializers.CharField()
+
+
+class BatchQuerySerializer(serializers.Serializer):  # pylint: disable=abstract-method
+  """Serializer for the batch query endpoint.
+
+  Data posted to the API looks like this::
+
+    {
+      "usernames": ["123abc", "456def"],
+      "attributes": [
+        {
+          "name": "facebook_id",
+          "value": "foo"
+        }
+      ]
+    }
+
+  Both lists are optional.
+  """
+  usernames = serializers.ListField(child=serializers.CharField(), required=False)
+  attributes = AttributeValueSerializer(many=True, required=False)
+
+  def validate(self, attrs):
+    max_size = getattr(settings, 'AUTHDATA_BATCH_QUERY_MAX_SIZE', 1000)
+    if len(attrs.get('usernames', [])) + len(attrs.get('attributes', [])) > max_size:
+      raise serializers.ValidationError('At most %d queries are allowed' % max_size)
+    return attrs
+
+
 class AttributeSerializer(serializers.ModelSerializer):
   class Meta:
     model = Attribute
@@ -151,6 +222,7 @@ class UserAttributeSerializer(serializers.ModelSerializer):
 
   class Meta:
     model = UserAttribute
+    exclude = ('value_hash',)
 
   def save(self, *args, **kwargs):
     username = self.context['request'].user.username
@@ -0,0 +1,61 @@
+# -*- encoding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2014-2015 Haltu Oy, http://haltu.fi
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""
+Bulk queries, raw SQL and ``QuerySet.update()`` send no ``post_save`` or
+``post_delete`` signals, so the receivers keeping ``User.last_changed``, the
+stored documents, the lookup filters and the query response cache up to date
+do not see rows written with them. Writers using them call :py:func:`bulk_written` for the
+rows instead.
+"""
+
+from authdata import changelog
+from authdata import documents
+from authdata import lookup_filter
+from authdata import query_cache
+
+
+def bulk_written(user_ids, values=(), bump=True):
+  """ Does what the signal receivers would do for rows written by bulk queries
+
+  Bumps last_changed of user_ids and rebuilds their documents, see
+  :py:func:`authdata.changelog.record`, adds the (attribute id, value) pairs
+  in values to the lookup filters and makes cached query responses stale.
+  Pass ``bump=False`` when the written rows are the users themselves, which
+  set last_changed already. Call this in the transaction writing the rows,
+  after writing them.
+  """
+  user_ids = list(user_ids)
+  if not user_ids:
+    return
+  if bump:
+    changelog.record(user_ids)
+  else:
+    documents.refresh(user_ids)
+  for attribute_id, value in values:
+    lookup_filter.known_values.add(attribute_id, value)
+  query_cache.invalidate()
+
+
+# vim: tabstop=2 expandtab shiftwidth=2 softtabstop=2
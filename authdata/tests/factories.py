@@ -73,6 +73,7 @@ class SchoolFactory(factory.django.DjangoModelFactory):
 class AttributeFactory(factory.django.DjangoModelFactory):
   class Meta:
     model = models.Attribute
+    django_get_or_create = ('name',)
 
   name = factory.Sequence(lambda n: 'attribute{0}'.format(n))
 
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2014-2015 Haltu Oy, http://haltu.fi
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+# pylint: disable=locally-disabled, no-member
+
+
+import random
+from StringIO import StringIO
+
+from django.core.management import call_command
+from django.test import TestCase
+from django.test import override_settings
+from authdata import benchmark
+from authdata.tests import factories as f
+
+
+class TestBenchmark(TestCase):
+
+  def result(self, p50=10.0, queries=3.0, throughput=100.0):
+    return {'p50': p50, 'p95': 20.0, 'p99': 30.0, 'queries': queries, 'throughput': throughput}
+
+  def test_percentile(self):
+    values = range(1, 101)
+    self.assertEqual(benchmark.percentile(values, 50), 50)
+    self.assertEqual(benchmark.percentile(values, 95), 95)
+    self.assertEqual(benchmark.percentile(values, 99), 99)
+    self.assertEqual(benchmark.percentile([3, 1, 2], 99), 3)
+    self.assertEqual(benchmark.percentile([1], 50), 1)
+
+  def test_compare(self):
+    baseline = {'100': {'query_username': self.result()}}
+    self.assertEqual(benchmark.compare({'100': {'query_username': self.result(p50=12.0, throughput=80.0)}}, baseline, 0.25), [])
+    regressions = benchmark.compare({'100': {'query_username': self.result(p50=13.0, queries=4.0, throughput=70.0)}}, baseline, 0.25)
+    self.assertEqual(len(regressions), 3)
+    self.assertIn('100 query_username: 4.0 queries per request, was 3.0', regressions)
+
+  def test_compare_missing(self):
+    results = {'100': {'query_username': self.result(queries=10.0)}, '1000': {'user_school': self.result()}}
+    self.assertEqual(benchmark.compare(results, {'100': {'user_school': self.result()}}, 0.25), [])
+
+  @override_settings(AUTHDATA_QUERY_CACHE=None)
+  def test_run(self):
+    call_command('create_test_data', users=20, seed=1, source='benchmark', stdout=StringIO())
+    user = f.UserFactory(username='benchmark')
+    results = benchmark.run(user, random.Random(1), 3)
+    self.assertEqual(sorted(results), ['query_attribute', 'query_username', 'query_username_cold', 'user_changed_at',
+                                       'user_group', 'user_municipality', 'user_school'])
+    # the responses are built from the tables
+    self.assertTrue(results['query_username_cold']['queries'] > results['query_username']['queries'])
+    for result in results.values():
+      self.assertTrue(0 < result['p50'] <= result['p95'] <= result['p99'])
+      self.assertTrue(result['queries'] >= 1)
+      self.assertTrue(result['throughput'] > 0)
+
+
+# vim: tabstop=2 expandtab shiftwidth=2 softtabstop=2
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2014-2015 Haltu Oy, http://haltu.fi
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# pylint: disable=locally-disabled, no-member
+
+import datetime
+
+from django.test import TestCase
+from django.utils import timezone
+from authdata import changelog
+from authdata.datasources.base import ExternalDataSource, stored_users
+from authdata.models import User
+from authdata.tests import factories as f
+
+
+class TestChangeLog(TestCase):
+
+  def setUp(self):
+    self.past = timezone.now() - datetime.timedelta(days=1)
+
+  def assertChanged(self, user, changed=True):
+    last_changed = User.objects.get(pk=user.pk).last_changed
+    if changed:
+      self.assertGreater(last_changed, self.past)
+    else:
+      self.assertEqual(last_changed, self.past)
+
+  def test_user_attribute(self):
+    user = f.UserFactory()
+    User.objects.update(last_changed=self.past)
+    attribute = f.UserAttributeFactory(user=user)
+    self.assertChanged(user)
+    User.objects.update(last_changed=self.past)
+    attribute.delete()
+    self.assertChanged(user)
+
+  def test_attendance(self):
+    user = f.UserFactory()
+    User.objects.update(last_changed=self.past)
+    attendance = f.AttendanceFactory(user=user)
+    self.assertChanged(user)
+    User.objects.update(last_changed=self.past)
+    attendance.delete()
+    self.assertChanged(user)
+
+  def test_related(self):
+    attendance = f.AttendanceFactory()
+    attribute = f.UserAttributeFactory(user=attendance.user)
+    other = f.AttendanceFactory()
+    for write in (attribute.attribute.save, attendance.role.save, attendance.school.save,
+                  attendance.school.municipality.save):
+      User.objects.update(last_changed=self.past)
+      write()
+      self.assertChanged(attendance.user)
+      self.assertChanged(other.user, False)
+
+  def test_record(self):
+    user = f.UserFactory()
+    other = f.UserFactory()
+    User.objects.update(last_changed=self.past)
+    with self.assertNumQueries(6):
+      # bump, then user, attendances, attributes, delete and insert for the
+      # document
+      changelog.record([user.pk, user.pk])
+    self.assertChanged(user)
+    self.assertChanged(other, False)
+    with self.assertNumQueries(0):
+      changelog.record([])
+
+  def test_provision_users(self):
+    stored_users.clear()
+    obj = ExternalDataSource()
+    obj.external_source = 'foo'
+    obj.provision_user(oid='oid', external_id='1')
+    user = User.objects.get(username='oid')
+    User.objects.update(last_changed=self.past)
+    obj.provision_user(oid='oid', external_id='2')
+    # external_id of the user changes too
+    self.assertChanged(user)
+
+# vim: tabstop=2 expandtab shiftwidth=2 softtabstop=2
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2014-2015 Haltu Oy, http://haltu.fi
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+# pylint: disable=locally-disabled, no-member
+
+from StringIO import StringIO
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase
+from authdata.models import User, UserAttribute, Attendance, School
+
+
+class TestCreateTestData(TestCase):
+
+  def create(self, **options):
+    call_command('create_test_data', municipalities=2, schools=3, attributes=4, stdout=StringIO(), **options)
+    return (sorted(UserAttribute.objects.values_list('user__username', 'attribute__name', 'value', 'value_hash')),
+            sorted(Attendance.objects.values_list('user__username', 'school__school_id', 'role__name', 'group')))
+
+  def clear(self):
+    UserAttribute.objects.all().delete()
+    Attendance.objects.all().delete()
+    User.objects.all().delete()
+
+  def test_create(self):
+    attributes, attendances = self.create(users=25, batch_size=10)
+    self.assertEqual(User.objects.count(), 25)
+    self.assertEqual(School.objects.count(), 6)
+    self.assertEqual(len(set(a[0] for a in attendances)), 25)
+    self.assertTrue(0 < len(attributes) < 25 * 4)
+
+  def test_deterministic(self):
+    data = self.create(users=25, batch_size=10, seed=1)
+    self.clear()
+    # the batch size does not change the data
+    self.assertEqual(self.create(users=25, batch_size=7, seed=1), data)
+    self.clear()
+    self.assertNotEqual(self.create(users=25, batch_size=10, seed=2), data)
+
+  def test_users_exist(self):
+    self.create(users=5)
+    with self.assertRaises(CommandError):
+      self.create(users=10)
+    self.assertEqual(User.objects.count(), 5)
+
+  def test_distribution(self):
+    attributes, attendances = self.create(users=100, attribute_ratio=1, teacher_ratio=0, max_groups=5)
+    self.assertEqual(len(attributes), 400)
+    self.assertEqual(set(a[2] for a in attendances), set(['student']))
+    self.assertTrue(all(1 <= sum(1 for a in attendances if a[0] == u) <= 2 for u, _, _, _ in attendances))
+
+
+# vim: tabstop=2 expandtab shiftwidth=2 softtabstop=2
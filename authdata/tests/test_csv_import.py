@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2014-2015 Haltu Oy, http://haltu.fi
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+# pylint: disable=locally-disabled, no-member
+
+import datetime
+import os
+import tempfile
+from StringIO import StringIO
+
+import mock
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.test import TestCase
+from django.utils import timezone
+from authdata.management.commands.csv_import import Command
+from authdata.models import User, UserAttribute, Attendance, School, Source, ImportCheckpoint
+from authdata.tests import factories as f
+
+ROWS = u'''oid1,school1,7A,teacher,Teppo,Testaaja,fb1,tw1
+oid2,school1,7B,student,Maija,Meikäläinen,fb2,tw2
+oid3,school2,7A,student,Matti,Meikäläinen,fb3,tw3
+oid1,school2,8A,teacher,Teppo,Testaaja,fb1,tw1
+oid4,school2,8A,janitor,Jaana,Talonmies,fb4,tw4
+'''
+
+
+class SerialPool(object):
+  """ Stands in for multiprocessing.Pool, a task runs in this process when its result is read """
+
+  def __init__(self, processes, initializer, initargs):
+    initializer(*initargs)
+    self.running = []  # usernames of each batch submitted but not read
+    self.overlapping = []
+
+  def apply_async(self, func, args):
+    usernames = set(d['username'] for d, _ in args[0])
+    self.overlapping.extend(usernames & other for other in self.running if usernames & other)
+    self.running.append(usernames)
+
+    def get():
+      self.running.remove(usernames)
+      return func(*args)
+    return mock.Mock(get=mock.Mock(side_effect=get))
+
+  def terminate(self):
+    pass
+
+  def close(self):
+    pass
+
+  def join(self):
+    pass
+
+
+class TestCSVImport(TestCase):
+
+  def setUp(self):
+    fd, self.path = tempfile.mkstemp(suffix='.csv')
+    os.write(fd, ROWS.encode('utf-8'))
+    os.close(fd)
+
+  def tearDown(self):
+    os.remove(self.path)
+
+  def run_import(self, *args, **kwargs):
+    out = StringIO()
+    call_command('csv_import', self.path, 'facebook,twitter', really_do_this=True, source='roster', stdout=out, **kwargs)
+    return out.getvalue()
+
+  def test_import(self):
+    self.run_import(batch_size=2)
+    self.assertEqual(User.objects.count(), 4)
+    self.assertEqual(User.objects.get(username='oid2').last_name, u'Meikäläinen')
+    self.assertEqual(UserAttribute.objects.filter(data_source__name='roster').count(), 8)
+    self.assertIsNotNone(UserAttribute.objects.get(attribute__name='facebook', value='fb1').value_hash)
+    # the unknown role gets no attendance
+    self.assertEqual(Attendance.objects.filter(data_source__name='roster').count(), 4)
+    self.assertEqual(School.objects.count(), 2)
+
+  def test_import_again(self):
+    self.run_import()
+    past = timezone.now() - datetime.timedelta(days=1)
+    User.objects.update(last_changed=past)
+    User.objects.filter(username='oid1').update(first_name='Seppo')
+    with self.assertNumQueries(20):
+      # 2 attributes, source, 2 roles, checkpoint, reset checkpoint and
+      # schools once, then savepoint, users, update user, user attributes,
+      # attendances, 5 for the document of the user, release and checkpoint
+      # for the batch
+      self.run_import()
+    self.assertEqual(User.objects.get(username='oid1').first_name, 'Teppo')
+    self.assertGreater(User.objects.get(username='oid1').last_changed, past)
+    self.assertEqual(User.objects.get(username='oid2').last_changed, past)
+    self.assertEqual(UserAttribute.objects.count(), 8)
+
+  def test_resume(self):
+    really_do_this = Command.really_do_this
+    calls = []
+
+    def fail_second_batch(command, rows):
+      calls.append(rows)
+      if len(calls) == 2:
+        raise RuntimeError('killed')
+      really_do_this(command, rows)
+
+    with mock.patch.object(Command, 'really_do_this', fail_second_batch):
+      with self.assertRaises(RuntimeError):
+        self.run_import(batch_size=2)
+    calls.append(None)
+    checkpoint = ImportCheckpoint.objects.get()
+    self.assertEqual((checkpoint.batch, checkpoint.rows), (1, 2))
+    self.assertEqual(checkpoint.offset, len(u'\n'.join(ROWS.splitlines()[:2]).encode('utf-8')) + 1)
+    self.assertEqual(User.objects.count(), 2)
+
+    with mock.patch.object(Command, 'really_do_this', fail_second_batch):
+      out = self.run_import(batch_size=2, resume=True)
+    self.assertIn('Resuming after 2 rows', out)
+    self.assertIn('Imported 5 rows', out)
+    # the first two rows were not read again
+    self.assertEqual([d['username'] for rows in calls[3:] for d, _ in rows], ['oid3', 'oid1', 'oid4'])
+    self.assertEqual(User.objects.count(), 4)
+    self.assertEqual(Attendance.objects.count(), 4)
+    self.assertEqual(ImportCheckpoint.objects.get().rows, 5)
+
+  def write_rows(self, rows):
+    with open(self.path, 'w') as f:
+      f.write(rows.encode('utf-8'))
+
+  def test_sync(self):
+    self.run_import()
+    f.UserAttributeFactory(user=User.objects.get(username='oid1'), attribute__name='other', value='other',
+                           data_source=Source.objects.get(name='roster'))
+    modified = dict(User.objects.values_list('username', 'modified'))
+    with self.assertNumQueries(9):
+      # 2 attributes, source, 2 roles, users, user attributes, attendances,
+      # schools
+      out = self.run_import(sync=True)
+    self.assertIn('attributes_created: 0, attributes_disabled: 0', out)
+    self.assertEqual(dict(User.objects.values_list('username', 'modified')), modified)
+
+    past = timezone.now() - datetime.timedelta(days=1)
+    User.objects.update(last_changed=past)
+    self.write_rows(ROWS.splitlines()[0].replace('fb1', 'fb5').replace('Teppo', 'Seppo') + u'\n' +
+                    u'oid5,school3,1A,student,Uusi,Oppilas,fb6,tw6\n')
+    out = self.run_import(sync=True)
+    self.assertIn('attendances_created: 1, attendances_removed: 3, attributes_created: 3, attributes_disabled: 7, '
+                  'attributes_enabled: 0, users_created: 1, users_updated: 1', out)
+    user = User.objects.get(username='oid1')
+    self.assertEqual(user.first_name, 'Seppo')
+    self.assertEqual(sorted(user.attributes.filter(disabled_at__isnull=True).values_list('value', flat=True)),
+                     ['fb5', 'other', 'tw1'])
+    self.assertEqual(Attendance.objects.filter(user=user).count(), 1)
+    # users whose attributes or attendances were removed are changed
+    self.assertGreater(User.objects.get(username='oid2').last_changed, past)
+    self.assertGreater(User.objects.get(username='oid3').last_changed, past)
+    self.assertEqual(User.objects.get(username='oid5').attendances.get().school.school_id, 'school3')
+
+  def test_sync_dry_run(self):
+    self.run_import()
+    self.write_rows(u'oid5,school3,1A,student,Uusi,Oppilas,fb6,tw6\n' * 2)
+    out = StringIO()
+    call_command('csv_import', self.path, 'facebook,twitter', sync=True, source='roster', stdout=out)
+    self.assertIn('attendances_created: 1, attendances_removed: 4, attributes_created: 2, attributes_disabled: 8, '
+                  'attributes_enabled: 0, users_created: 1, users_updated: 0', out.getvalue())
+    self.assertEqual(User.objects.count(), 4)
+    self.assertEqual(UserAttribute.objects.filter(disabled_at__isnull=True).count(), 8)
+
+  def test_sync_enable(self):
+    self.run_import()
+    self.write_rows(ROWS.replace('fb1', 'fb5'))
+    self.run_import(sync=True)
+    self.write_rows(ROWS)
+    out = self.run_import(sync=True)
+    self.assertIn('attributes_created: 0, attributes_disabled: 1, attributes_enabled: 1', out)
+    user = User.objects.get(username='oid1')
+    self.assertEqual(user.attributes.filter(value='fb1').count(), 1)
+    self.assertEqual(user.attributes.get(value='fb1').disabled_at, None)
+    self.assertNotEqual(user.attributes.get(value='fb5').disabled_at, None)
+
+  def test_sync_other_users(self):
+    self.run_import()
+    # a user of no source
+    f.UserFactory(username='oid5', first_name='Uusi', last_name='Oppilas')
+    self.write_rows(ROWS + u'oid5,school2,1A,student,Uusi,Oppilas,fb6,tw6\n')
+    with self.assertNumQueries(20):
+      # 2 attributes, source, 2 roles, user attributes, attendances, users of
+      # the source and schools, then users not of the source, savepoint, user
+      # attributes, attendances, bump last_changed, 5 for the document and
+      # release for the batch
+      out = self.run_import(sync=True)
+    self.assertIn('users_created: 0, users_updated: 0', out)
+    self.assertEqual(User.objects.get(username='oid5').attributes.count(), 2)
+
+  def test_sync_empty(self):
+    self.run_import()
+    self.write_rows(u'')
+    with self.assertRaises(CommandError):
+      self.run_import(sync=True)
+    self.assertEqual(UserAttribute.objects.filter(disabled_at__isnull=True).count(), 8)
+
+  def test_workers_sqlite(self):
+    with self.assertRaises(CommandError):
+      self.run_import(workers=2)
+
+  def test_workers(self):
+    pools = []
+
+    def create_pool(*args):
+      pools.append(SerialPool(*args))
+      return pools[-1]
+
+    with mock.patch('authdata.management.commands.csv_import.multiprocessing.Pool', create_pool):
+      with mock.patch.object(connection, 'vendor', 'postgresql'):
+        out = self.run_import(workers=2, batch_size=1)
+    # the two rows of oid1 are in the same shard and never written concurrently
+    self.assertEqual(pools[0].overlapping, [])
+    self.assertEqual(pools[0].running, [])
+    self.assertIn('Imported 5 rows', out)
+    self.assertNotIn('ERR', out)
+    self.assertEqual(User.objects.count(), 4)
+    self.assertEqual(UserAttribute.objects.count(), 8)
+    self.assertEqual(Attendance.objects.count(), 4)
+
+  def test_dry_run(self):
+    call_command('csv_import', self.path, 'facebook,twitter', stdout=StringIO())
+    self.assertEqual(User.objects.count(), 0)
+
+
+# vim: tabstop=2 expandtab shiftwidth=2 softtabstop=2
@@ -25,16 +25,21 @@
 # pylint: disable=locally-disabled, no-member, protected-access
 
 import base64
+import time
 
 import mock
 import requests
 
 from django.test import TestCase
+from django.test import TransactionTestCase
 from django.test import RequestFactory
 from django.test import override_settings
 
 from authdata import models
+from authdata.datasources import base
 from authdata.datasources.base import ExternalDataSource
+from authdata.datasources import provisioning
+from authdata.datasources import registry
 import authdata.datasources.dreamschool
 import authdata.datasources.ldap_base
 import authdata.datasources.oulu
@@ -83,6 +88,50 @@ class TestExternalDataSource(TestCase):
     self.assertEqual(models.Attribute.objects.count(), 1)
     self.assertEqual(models.UserAttribute.objects.count(), 1)
 
+  def test_provision_user_updates(self):
+    obj = self.o
+    obj.external_source = 'foo'
+    obj.provision_user(oid='oid', external_id='foo')
+    obj.provision_user(oid='oid', external_id='bar')
+    user = models.User.objects.get(username='oid')
+    self.assertEqual(user.external_id, 'bar')
+    self.assertEqual(user.external_source, 'foo')
+    self.assertEqual(models.UserAttribute.objects.get().value, 'bar')
+    self.assertEqual(models.UserAttribute.objects.get().value_hash, models.hash_value('bar'))
+
+  def test_provision_users(self):
+    obj = self.o
+    obj.external_source = 'foo'
+    obj.provision_user(oid='oid1', external_id='1')
+    obj.provision_user(oid='oid2', external_id='2')
+    batch = [('oid%d' % i, str(i * 10)) for i in xrange(100)]
+    obj.provision_users(batch)
+    self.assertEqual(models.User.objects.count(), 100)
+    self.assertEqual(models.UserAttribute.objects.count(), 100)
+    for oid, external_id in batch:
+      user = models.User.objects.get(username=oid)
+      self.assertEqual(user.external_id, external_id)
+      self.assertEqual(user.external_source, 'foo')
+      self.assertEqual(user.attributes.get(attribute__name='foo').value, external_id)
+      self.assertEqual(user.attributes.get(attribute__name='foo').value_hash, models.hash_value(external_id))
+
+  def test_provision_users_query_count(self):
+    obj = self.o
+    obj.external_source = 'foo'
+    obj.provision_users([('oid%d' % i, str(i)) for i in xrange(100)])
+    with self.assertNumQueries(1):
+      # existence check finds all users
+      obj.provision_users([('oid%d' % i, str(i)) for i in xrange(100)])
+    with self.assertNumQueries(14):
+      # existence check, savepoint, source, attribute, users, user attributes,
+      # update users, update user attributes, bump last_changed, release and
+      # twice local users and documents to remove
+      obj.provision_users([('oid%d' % i, str(i + 1)) for i in xrange(100)])
+
+  def test_provision_users_empty(self):
+    with self.assertNumQueries(0):
+      self.o.provision_users([])
+
   def test_oid(self):
     with self.assertRaises(NotImplementedError):
       self.o.get_oid(username='foo')
@@ -96,6 +145,260 @@ class TestExternalDataSource(TestCase):
       self.o.get_user_data(request='foo')
 
 
+class TestStoredUsers(TransactionTestCase):
+
+  def setUp(self):
+    base.stored_users.clear()
+    self.o = ExternalDataSource()
+    self.o.external_source = 'foo'
+
+  def tearDown(self):
+    base.stored_users.clear()
+
+  def test_repeat_provision(self):
+    self.o.provision_user(oid='oid', external_id='foo')
+    self.assertTrue(('foo', 'oid', 'foo') in base.stored_users)
+    with self.assertNumQueries(0):
+      self.o.provision_user(oid='oid', external_id='foo')
+
+  def test_existence_check(self):
+    self.o.provision_user(oid='oid', external_id='foo')
+    base.stored_users.clear()
+    with self.assertNumQueries(1):
+      self.o.provision_user(oid='oid', external_id='foo')
+    self.assertTrue(('foo', 'oid', 'foo') in base.stored_users)
+
+  def test_changed_external_id(self):
+    self.o.provision_user(oid='oid', external_id='foo')
+    self.o.provision_user(oid='oid', external_id='bar')
+    self.assertEqual(models.User.objects.get(username='oid').external_id, 'bar')
+
+  def test_cleared_on_delete(self):
+    self.o.provision_user(oid='oid', external_id='foo')
+    models.User.objects.get(username='oid').delete()
+    self.assertEqual(len(base.stored_users), 0)
+    self.o.provision_user(oid='oid', external_id='foo')
+    self.assertTrue(models.User.objects.filter(username='oid').exists())
+
+  def test_cache_is_bounded(self):
+    cache = base.FingerprintCache(maxsize=2)
+    cache.add(1)
+    cache.add(2)
+    self.assertTrue(1 in cache)
+    cache.add(3)
+    self.assertTrue(1 in cache)
+    self.assertFalse(2 in cache)
+    self.assertTrue(3 in cache)
+
+
+@mock.patch('authdata.datasources.base.time.time', return_value=1000)
+class TestDataCache(TestCase):
+
+  def setUp(self):
+    self.fetch = mock.Mock(return_value={'roles': ['foo']})
+    self.cache = base.DataCache(self.fetch, ttl=60, max_age=3600, maxsize=10,
+        queue_size=2, start_worker=False)
+
+  def test_fresh(self, time_mock):
+    data = self.cache.get('1')
+    data['roles'].append('bar')
+    time_mock.return_value = 1059
+    self.assertEqual(self.cache.get('1'), {'roles': ['foo']})
+    self.assertEqual(self.fetch.call_count, 1)
+    self.assertFalse(self.cache.queue)
+
+  def test_stale_while_revalidate(self, time_mock):
+    self.cache.get('1')
+    self.fetch.return_value = {'roles': ['bar']}
+    time_mock.return_value = 1060
+    self.assertEqual(self.cache.get('1'), {'roles': ['foo']})
+    self.assertEqual(self.cache.get('1'), {'roles': ['foo']})
+    # only one refresh is queued for the key
+    self.assertEqual(list(self.cache.queue), ['1'])
+    self.cache.work()
+    self.assertEqual(self.cache.get('1'), {'roles': ['bar']})
+    self.assertEqual(self.fetch.call_count, 2)
+
+  def test_refresh_fails(self, time_mock):
+    self.cache.get('1')
+    self.fetch.side_effect = requests.exceptions.Timeout
+    time_mock.return_value = 1060
+    self.cache.get('1')
+    self.cache.work()
+    self.assertEqual(self.cache.get('1'), {'roles': ['foo']})
+    # the key is queued again by the next request
+    self.assertEqual(list(self.cache.queue), ['1'])
+
+  def test_refresh_not_found(self, time_mock):
+    self.cache.get('1')
+    self.fetch.return_value = None
+    time_mock.return_value = 1060
+    self.cache.get('1')
+    self.cache.work()
+    self.assertEqual(len(self.cache.entries), 0)
+    self.assertEqual(self.cache.get('1'), None)
+
+  def test_max_age(self, time_mock):
+    self.cache.get('1')
+    self.fetch.side_effect = requests.exceptions.Timeout
+    time_mock.return_value = 4600
+    with self.assertRaises(requests.exceptions.Timeout):
+      self.cache.get('1')
+    self.fetch.side_effect = None
+    self.fetch.return_value = None
+    self.assertEqual(self.cache.get('1'), None)
+    self.assertEqual(len(self.cache.entries), 0)
+
+  def test_not_found(self, time_mock):
+    self.fetch.return_value = None
+    self.assertEqual(self.cache.get('1'), None)
+    self.assertEqual(self.cache.get('1'), None)
+    self.assertEqual(self.fetch.call_count, 2)
+
+  def test_disabled(self, time_mock):
+    self.cache.ttl = 0
+    self.cache.get('1')
+    self.cache.get('1')
+    self.assertEqual(self.fetch.call_count, 2)
+
+  def test_bounded(self, time_mock):
+    for key in xrange(20):
+      self.cache.get(key)
+    self.assertEqual(self.cache.entries.keys(), range(10, 20))
+
+  def test_external_data_source(self, time_mock):
+    obj = ExternalDataSource(cache_ttl=10, cache_max_age=20, cache_size=5)
+    self.assertEqual((obj.data_cache.ttl, obj.data_cache.max_age, obj.data_cache.maxsize), (10, 20, 5))
+    with mock.patch.object(obj.data_cache, 'fetch', self.fetch):
+      obj.get_cached_data('1')
+      obj.get_cached_data('1')
+    self.fetch.assert_called_once_with('1')
+
+  def test_refresh_queue_bounded(self, time_mock):
+    for key in xrange(3):
+      self.cache.get(key)
+    time_mock.return_value = 1060
+    for key in xrange(3):
+      self.assertEqual(self.cache.get(key), {'roles': ['foo']})
+    self.assertEqual(list(self.cache.queue), [0, 1])
+    self.assertEqual(self.cache.refreshing, set([0, 1]))
+    self.cache.work()
+    self.cache.get(2)
+    self.assertEqual(list(self.cache.queue), [1, 2])
+
+  @mock.patch('authdata.datasources.base.threading.Thread')
+  def test_one_worker(self, thread_mock, time_mock):
+    self.cache.start_worker = True
+    for key in xrange(2):
+      self.cache.get(key)
+    time_mock.return_value = 1060
+    for key in xrange(2):
+      self.cache.get(key)
+    thread_mock.assert_called_once_with(target=self.cache._run, name='authdata-data-cache')
+    self.assertTrue(thread_mock.return_value.start.called)
+
+
+class TestProvisioningQueue(TestCase):
+
+  def setUp(self):
+    self.queue = provisioning.ProvisioningQueue(maxsize=3, batch_size=2, start_worker=False)
+
+  def test_put_and_flush(self):
+    self.queue.put('foo', [('oid1', '1'), ('oid2', '2')])
+    self.assertFalse(models.User.objects.exists())
+    self.queue.flush()
+    self.assertEqual(models.User.objects.get(username='oid1').external_id, '1')
+    self.assertEqual(models.User.objects.get(username='oid2').external_source, 'foo')
+    self.assertFalse(self.queue.items)
+
+  def test_overflow_is_stored(self):
+    self.queue.put('foo', [('oid%d' % i, str(i)) for i in xrange(5)])
+    self.assertEqual(len(self.queue.items), 3)
+    self.assertEqual(models.PendingProvision.objects.count(), 2)
+
+  def test_failed_write_is_stored(self):
+    self.queue.put('foo', [('oid1', '1')])
+    with mock.patch('authdata.datasources.provisioning.save', side_effect=ValueError):
+      self.queue.flush()
+    pending = models.PendingProvision.objects.get()
+    self.assertEqual((pending.username, pending.external_id, pending.external_source), ('oid1', '1', 'foo'))
+
+  def test_drain_pending(self):
+    for i in xrange(5):
+      models.PendingProvision.objects.create(username='oid%d' % i, external_id=str(i), external_source='foo')
+    self.queue.drain_pending()
+    self.assertFalse(models.PendingProvision.objects.exists())
+    self.assertEqual(models.User.objects.filter(external_source='foo').count(), 5)
+
+  def test_drain_pending_failed(self):
+    models.PendingProvision.objects.create(username='oid1', external_id='1', external_source='foo')
+    with mock.patch('authdata.datasources.provisioning.save', side_effect=ValueError):
+      self.queue.drain_pending()
+    self.assertTrue(models.PendingProvision.objects.exists())
+
+  def test_drain_periodically(self):
+    self.queue.flush_interval = 0
+    self.queue.work()
+    # stored at runtime, e.g. when the queue was full
+    models.PendingProvision.objects.create(username='oid1', external_id='1', external_source='foo')
+    self.queue.work()
+    self.assertTrue(models.PendingProvision.objects.exists())
+    self.queue.drain_at = 0
+    self.queue.work()
+    self.assertFalse(models.PendingProvision.objects.exists())
+    self.assertTrue(models.User.objects.filter(username='oid1').exists())
+
+  @override_settings(AUTHDATA_PROVISIONING_MODE='deferred')
+  def test_deferred_provision_users(self):
+    data_source = ExternalDataSource()
+    data_source.external_source = 'foo'
+    with mock.patch('authdata.datasources.provisioning.get_queue', return_value=self.queue):
+      with self.assertNumQueries(1):
+        data_source.provision_user(oid='oid1', external_id='1')
+    self.assertEqual(list(self.queue.items), [('oid1', '1', 'foo')])
+
+
+@override_settings(AUTH_EXTERNAL_SOURCES=AUTH_EXTERNAL_SOURCES)
+class TestRegistry(TestCase):
+
+  def test_get_handler(self):
+    handler = registry.get_handler('dreamschool')
+    self.assertTrue(isinstance(handler, authdata.datasources.dreamschool.DreamschoolDataSource))
+    self.assertEqual(handler.api_url, 'https://foo.fi/api/2/user/')
+
+  def test_get_handler_is_shared(self):
+    self.assertTrue(registry.get_handler('dreamschool') is registry.get_handler('dreamschool'))
+
+  def test_get_handler_not_configured(self):
+    with self.assertRaises(KeyError):
+      registry.get_handler('doesntexist')
+
+  @override_settings(AUTH_EXTERNAL_SOURCES={'broken': ['authdata.datasources.doesntexist', 'Foo', {}]})
+  def test_get_handler_import_error(self):
+    with self.assertRaises(ImportError):
+      registry.get_handler('broken')
+
+  @override_settings(AUTH_EXTERNAL_SOURCES={'broken': ['authdata.datasources.dreamschool', 'DreamschoolDataSource', {}]})
+  def test_get_handler_wrong_kwargs(self):
+    with self.assertRaises(ImportError):
+      registry.get_handler('broken')
+
+  @override_settings(AUTH_EXTERNAL_SOURCES={
+    'dreamschool': AUTH_EXTERNAL_SOURCES['dreamschool'],
+    'broken': ['authdata.datasources.doesntexist', 'Foo', {}],
+  })
+  def test_load(self):
+    handlers = registry.load()
+    self.assertEqual(handlers.keys(), ['dreamschool'])
+
+  def test_reset_on_setting_changed(self):
+    handler = registry.get_handler('dreamschool')
+    with override_settings(AUTH_EXTERNAL_SOURCES={}):
+      with self.assertRaises(KeyError):
+        registry.get_handler('dreamschool')
+    self.assertFalse(registry.get_handler('dreamschool') is handler)
+
+
 @override_settings(AUTH_EXTERNAL_SOURCES=AUTH_EXTERNAL_SOURCES)
 @override_settings(AUTH_EXTERNAL_ATTRIBUTE_BINDING=AUTH_EXTERNAL_ATTRIBUTE_BINDING)
 @override_settings(AUTH_EXTERNAL_MUNICIPALITY_BINDING=AUTH_EXTERNAL_MUNICIPALITY_BINDING)
@@ -103,12 +406,17 @@ class TestExternalDataSource(TestCase):
 class TestDreamschoolDataSource(TestCase):
 
   def setUp(self):
+    requests_patcher = mock.patch('authdata.datasources.dreamschool.requests')
+    requests_mock = requests_patcher.start()
+    self.addCleanup(requests_patcher.stop)
+    requests_mock.codes = requests.codes
+    requests_mock.RequestException = requests.RequestException
+    requests_mock.HTTPError = requests.HTTPError
+    self.session = requests_mock.Session.return_value
+
     self.o = authdata.datasources.dreamschool.DreamschoolDataSource(api_url='mock://foo',
         username='foo', password='bar')
 
-    authdata.datasources.dreamschool.requests = mock.Mock()
-    authdata.datasources.dreamschool.requests.codes = requests.codes
-
     data = {'objects': [
       {'id': 123,
       'username': 'user',
@@ -139,7 +447,7 @@ class TestDreamschoolDataSource(TestCase):
     response_mock.status_code = requests.codes.ok
     response_mock.json.return_value = data
 
-    authdata.datasources.dreamschool.requests.get.return_value = response_mock
+    self.session.get.return_value = response_mock
     self.factory = RequestFactory()
 
   def test_init(self):
@@ -177,7 +485,7 @@ class TestDreamschoolDataSource(TestCase):
     response_mock = mock.Mock()
     response_mock.status_code = 500
     response_mock.json.return_value = self.data
-    authdata.datasources.dreamschool.requests.get.return_value = response_mock
+    self.session.get.return_value = response_mock
 
     d = {'municipality': 'Bar', 'school': 'school1', 'group': 'Group1'}
     request = self.factory.get('/foo', d)
@@ -192,7 +500,7 @@ class TestDreamschoolDataSource(TestCase):
     response_mock = mock.Mock()
     response_mock.status_code = 200
     response_mock.json.side_effect = ValueError('foo')
-    authdata.datasources.dreamschool.requests.get.return_value = response_mock
+    self.session.get.return_value = response_mock
 
     d = {'municipality': 'Bar', 'school': 'school1', 'group': 'Group1'}
     request = self.factory.get('/foo', d)
@@ -203,6 +511,54 @@ class TestDreamschoolDataSource(TestCase):
     self.assertEqual(data['previous'], None)
     self.assertEqual(data['results'], [])
 
+  def test_session(self):
+    self.assertEqual(self.session.auth, ('foo', 'bar'))
+    self.assertEqual(self.session.mount.call_count, 2)
+
+  def test_get_data_timeout(self):
+    self.session.get.return_value.json.return_value = self.data['objects'][0]
+    self.o.get_data(external_id='123')
+    self.session.get.assert_called_once_with('mock://foo123/', params={}, headers={}, timeout=(5, 30))
+
+  def test_get_data_request_exception(self):
+    self.session.get.side_effect = requests.exceptions.ConnectTimeout('foo')
+    with self.assertRaises(requests.exceptions.ConnectTimeout):
+      self.o.get_data(external_id='123')
+
+  def test_get_data_not_found(self):
+    self.session.get.return_value.status_code = requests.codes.not_found
+    self.assertEqual(self.o.get_data(external_id='123'), None)
+
+  def test_get_data_conditional(self):
+    data = self.data['objects'][0]
+    response_mock = mock.Mock()
+    response_mock.status_code = requests.codes.ok
+    response_mock.json.return_value = data
+    response_mock.headers = {'ETag': '"abc"', 'Last-Modified': 'Tue, 20 Oct 2015 10:00:00 GMT'}
+    self.session.get.return_value = response_mock
+    first = self.o.get_data(external_id='123')
+
+    not_modified_mock = mock.Mock()
+    not_modified_mock.status_code = requests.codes.not_modified
+    self.session.get.return_value = not_modified_mock
+    second = self.o.get_data(external_id='123')
+
+    self.session.get.assert_called_with('mock://foo123/', params={}, timeout=(5, 30),
+        headers={'If-None-Match': '"abc"', 'If-Modified-Since': 'Tue, 20 Oct 2015 10:00:00 GMT'})
+    self.assertEqual(second['username'], first['username'])
+    self.assertEqual(list(second['roles']), list(first['roles']))
+
+  def test_conditional_cache_is_bounded(self):
+    self.o.conditional_cache_size = 2
+    response_mock = mock.Mock()
+    response_mock.status_code = requests.codes.ok
+    response_mock.json.return_value = self.data['objects'][0]
+    response_mock.headers = {'ETag': '"abc"'}
+    self.session.get.return_value = response_mock
+    for external_id in ['1', '2', '3']:
+      self.o.get_data(external_id=external_id)
+    self.assertEqual(len(self.o.conditional_cache), 2)
+
   def test_get_municipality_by_org_id(self):
     org_id = 1
     municipality = self.o._get_municipality_by_org_id(org_id)
@@ -326,7 +682,7 @@ class TestDreamschoolDataSource(TestCase):
     response_mock.status_code = requests.codes.ok
     response_mock.json.return_value = data
 
-    authdata.datasources.dreamschool.requests.get.return_value = response_mock
+    self.session.get.return_value = response_mock
     data = self.o.get_data(external_id=external_id)
     data['roles'] = list(data['roles'])
     expected_data = {
@@ -372,9 +728,9 @@ class TestDreamschoolDataSource(TestCase):
     response_mock.status_code = 500
     response_mock.json.return_value = data
 
-    authdata.datasources.dreamschool.requests.get.return_value = response_mock
-    data = self.o.get_data(external_id=external_id)
-    self.assertEqual(data, None)
+    self.session.get.return_value = response_mock
+    with self.assertRaises(requests.HTTPError):
+      self.o.get_data(external_id=external_id)
 
   def test_get_data_json_parse_fail(self):
     external_id = '123'
@@ -405,11 +761,86 @@ class TestDreamschoolDataSource(TestCase):
     response_mock.status_code = 200
     response_mock.json.side_effect = ValueError('foo')
 
-    authdata.datasources.dreamschool.requests.get.return_value = response_mock
+    self.session.get.return_value = response_mock
     data = self.o.get_data(external_id=external_id)
     self.assertEqual(data, None)
 
 
+class TestLDAPConnectionPool(TestCase):
+
+  def setUp(self):
+    self.factory = mock.Mock(side_effect=lambda: mock.Mock())
+    self.validate = mock.Mock(return_value=True)
+    self.pool = authdata.datasources.ldap_base.LDAPConnectionPool(self.factory,
+        self.validate, size=2, max_idle=300, timeout=0)
+
+  def test_connection_is_reused(self):
+    connection = self.pool.acquire()
+    self.pool.release(connection)
+    self.assertTrue(self.pool.acquire() is connection)
+    self.assertEqual(self.factory.call_count, 1)
+    self.validate.assert_called_once_with(connection)
+
+  def test_size_is_bounded(self):
+    self.pool.acquire()
+    self.pool.acquire()
+    with self.assertRaises(authdata.datasources.ldap_base.PoolTimeout):
+      self.pool.acquire()
+
+  def test_dead_connection_is_replaced(self):
+    connection = self.pool.acquire()
+    self.pool.release(connection)
+    self.validate.return_value = False
+    new_connection = self.pool.acquire()
+    self.assertFalse(new_connection is connection)
+    connection.unbind_s.assert_called_once_with()
+
+  def test_idle_connection_is_closed(self):
+    connection = self.pool.acquire()
+    self.pool.release(connection)
+    self.pool.max_idle = 10
+    with mock.patch('authdata.datasources.ldap_base.time.time', return_value=time.time() + 60):
+      new_connection = self.pool.acquire()
+    self.assertFalse(new_connection is connection)
+    connection.unbind_s.assert_called_once_with()
+    self.assertFalse(self.validate.called)
+
+  def test_discard_frees_slot(self):
+    connection = self.pool.acquire()
+    self.pool.acquire()
+    self.pool.discard(connection)
+    self.assertTrue(self.pool.acquire())
+
+  def test_factory_error_frees_slot(self):
+    self.factory.side_effect = ValueError('foo')
+    for _ in xrange(3):
+      with self.assertRaises(ValueError):
+        self.pool.acquire()
+
+  def test_park(self):
+    connection = self.pool.acquire()
+    self.pool.park('key', connection, 'state')
+    self.assertEqual(self.pool.unpark('key'), (connection, 'state'))
+    self.assertEqual(self.pool.unpark('key'), None)
+
+  def test_parked_connection_is_evicted_when_full(self):
+    connection = self.pool.acquire()
+    self.pool.park('key', connection, 'state')
+    self.pool.acquire()
+    self.assertTrue(self.pool.acquire())
+    connection.unbind_s.assert_called_once_with()
+    self.assertEqual(self.pool.unpark('key'), None)
+
+  def test_parked_connection_expires(self):
+    connection = self.pool.acquire()
+    self.pool.park('key', connection, 'state')
+    self.pool.max_idle = 10
+    with mock.patch('authdata.datasources.ldap_base.time.time', return_value=time.time() + 60):
+      self.pool.acquire()
+    self.assertEqual(self.pool.unpark('key'), None)
+    connection.unbind_s.assert_called_once_with()
+
+
 class TestLDAPDataSource(TestCase):
 
   def setUp(self):
@@ -423,11 +854,110 @@ class TestLDAPDataSource(TestCase):
     self.assertEqual(self.obj.external_source, 'foo')
 
   def test_connect(self):
-    self.obj.connect()
+    connection = self.obj.connect()
+    connection.simple_bind_s.assert_called_once_with('foo', 'bar')
 
   def test_query(self):
     self.obj.query(query_filter=None)
 
+  def test_query_reuses_connection(self):
+    self.obj.query(query_filter=None)
+    self.obj.query(query_filter=None)
+    self.assertEqual(self.obj.ldap.initialize.call_count, 1)
+
+  def test_query_reconnects(self):
+    class ServerDown(Exception):
+      pass
+    self.obj.ldap.SERVER_DOWN = ServerDown
+    dead = mock.Mock()
+    dead.search_s.side_effect = ServerDown
+    alive = mock.Mock()
+    alive.search_s.return_value = []
+    self.obj.ldap.initialize.side_effect = [dead, alive]
+    self.assertEqual(self.obj.query(query_filter=None), [])
+    dead.unbind_s.assert_called_once_with()
+
+  def _page_connection(self, pages):
+    """Connection mock returning the given (results, cookie) pages"""
+    connection = mock.Mock()
+    page_control = mock.Mock()
+    page_control.controlType = 'paged'
+    self.obj.ldap.controls.SimplePagedResultsControl.controlType = 'paged'
+    responses = []
+    for results, cookie in pages:
+      control = mock.Mock(controlType='paged', cookie=cookie)
+      responses.append((None, results, None, [control]))
+    connection.result3.side_effect = responses
+    self.obj.ldap.initialize.return_value = connection
+    return connection
+
+  def test_paged_query(self):
+    connection = self._page_connection([(['a', 'b'], 'cookie1'), (['c'], '')])
+    results, cursor = self.obj.paged_query('(uid=*)', page_size=2, base_dn='dc=foo')
+    self.assertEqual(results, ['a', 'b'])
+    self.assertTrue(cursor.endswith('.1'))
+
+    results, cursor = self.obj.paged_query('(uid=*)', page_size=2, cursor=cursor, base_dn='dc=foo')
+    self.assertEqual(results, ['c'])
+    self.assertEqual(cursor, None)
+    # second page continues the search on the same connection
+    self.assertEqual(self.obj.ldap.initialize.call_count, 1)
+    self.obj.ldap.controls.SimplePagedResultsControl.assert_called_with(True, size=2, cookie='cookie1')
+
+  def test_paged_query_lost_connection(self):
+    self._page_connection([(['a', 'b'], 'cookie1'), (['c'], '')])
+    results, cursor = self.obj.paged_query('(uid=*)', page_size=2, cursor='unknown.1', base_dn='dc=foo')
+    # first page is skipped
+    self.assertEqual(results, ['c'])
+    self.assertEqual(cursor, None)
+
+  def test_paged_query_past_last_page(self):
+    self._page_connection([(['a', 'b'], '')])
+    results, cursor = self.obj.paged_query('(uid=*)', page_size=2, cursor='unknown.3', base_dn='dc=foo')
+    self.assertEqual(results, [])
+    self.assertEqual(cursor, None)
+
+  def test_paged_query_replay_limit(self):
+    self._page_connection([])
+    self.obj.max_replay_pages = 2
+    with self.assertRaises(base.CursorExpired):
+      self.obj.paged_query('(uid=*)', page_size=2, cursor='unknown.3', base_dn='dc=foo')
+    self.assertFalse(self.obj.ldap.initialize.called)
+
+  def test_paged_query_reconnects(self):
+    class ServerDown(Exception):
+      pass
+    self.obj.ldap.SERVER_DOWN = ServerDown
+    connection = self._page_connection([(['a', 'b'], 'cookie1')])
+    results, cursor = self.obj.paged_query('(uid=*)', page_size=2, base_dn='dc=foo')
+    # the server dropped the parked connection
+    connection.search_ext.side_effect = ServerDown
+    alive = self._page_connection([(['a', 'b'], 'cookie1'), (['c'], '')])
+    results, cursor = self.obj.paged_query('(uid=*)', page_size=2, cursor=cursor, base_dn='dc=foo')
+    self.assertEqual(results, ['c'])
+    self.assertEqual(cursor, None)
+    connection.unbind_s.assert_called_once_with()
+    self.assertEqual(alive.search_ext.call_count, 2)
+
+  def test_get_page_size(self):
+    request = mock.Mock()
+    request.GET = {}
+    self.assertEqual(self.obj.get_page_size(request), 10)
+    request.GET = {'page_size': '50'}
+    self.assertEqual(self.obj.get_page_size(request), 50)
+    request.GET = {'page_size': '5000'}
+    self.assertEqual(self.obj.get_page_size(request), 1000)
+    request.GET = {'page_size': 'foo'}
+    self.assertEqual(self.obj.get_page_size(request), 10)
+
+  def test_paginated_response(self):
+    request = RequestFactory().get('/api/1/user/', {'municipality': 'Foo'})
+    data = self.obj.paginated_response(request, ['a'], 'abc.1')
+    self.assertEqual(data['count'], None)
+    self.assertEqual(data['next'], 'http://testserver/api/1/user/?cursor=abc.1&municipality=Foo')
+    self.assertEqual(data['previous'], None)
+    self.assertEqual(data['results'], ['a'])
+
   def test_get_municipality_id(self):
     muni_id = self.obj.get_municipality_id(name='foo')
     self.assertEqual(muni_id, 'foo')
@@ -527,7 +1057,7 @@ class TestLdapTest(TestCase):
     )]
     mock_request = mock.Mock()
     mock_request.GET = {'school': u'Ääkkösschool', 'group': u'Ääkköskoulu'}
-    with mock.patch.object(self.obj, 'query', return_value=r):
+    with mock.patch.object(self.obj, 'paged_query', return_value=(r, None)):
       query_result = self.obj.get_user_data(request=mock_request)
 
     expected_data = {
@@ -666,7 +1196,7 @@ class TestOuluLDAPDataSource(TestCase):
     mock_request = mock.Mock()
     mock_request.GET = {'school': u'Ääkkösschool', 'group': u'Ääkköskoulu'}
 
-    with mock.patch.object(self.obj, 'query', return_value=self.q_results):
+    with mock.patch.object(self.obj, 'paged_query', return_value=(self.q_results, None)):
       query_result = self.obj.get_user_data(request=mock_request)
 
     expected_data = {
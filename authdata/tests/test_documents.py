@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2014-2015 Haltu Oy, http://haltu.fi
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+# pylint: disable=locally-disabled, no-member
+
+import json
+from StringIO import StringIO
+
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils import timezone
+from authdata import documents
+from authdata.models import User, UserDocument
+from authdata.serializers import QuerySerializer
+from authdata.tests import factories as f
+
+
+class TestDocuments(TestCase):
+
+  def test_refresh(self):
+    user = f.UserFactory(username=u'Ääkköset')
+    f.AttendanceFactory(user=user)
+    UserDocument.objects.all().delete()
+    documents.refresh([user.pk, user.pk])
+    self.assertEqual(json.loads(documents.get(user__username=user.username)), QuerySerializer(user).data)
+
+  def test_refresh_external(self):
+    user = f.UserFactory()
+    User.objects.filter(pk=user.pk).update(external_source='foo', external_id='bar')
+    documents.refresh([user.pk])
+    self.assertEqual(UserDocument.objects.count(), 0)
+
+  def test_written(self):
+    user = f.UserFactory()
+    self.assertEqual(json.loads(documents.get(user=user))['attributes'], [])
+    user_attribute = f.UserAttributeFactory(user=user, attribute__name='foo', value='bar')
+    self.assertEqual(json.loads(documents.get(user=user))['attributes'], [{'name': 'foo', 'value': 'bar'}])
+    user_attribute.attribute.name = 'zap'
+    user_attribute.attribute.save()
+    self.assertEqual(json.loads(documents.get(user=user))['attributes'], [{'name': 'zap', 'value': 'bar'}])
+
+  def test_deleted(self):
+    attendance = f.AttendanceFactory()
+    f.UserAttributeFactory(user=attendance.user)
+    attendance.delete()
+    self.assertEqual(documents.get(user=attendance.user), None)
+    # a document is not built for a user being deleted
+    attendance.user.delete()
+    self.assertEqual(UserDocument.objects.count(), 0)
+
+  def test_stale(self):
+    user = f.UserFactory()
+    User.objects.filter(pk=user.pk).update(last_changed=timezone.now())
+    self.assertEqual(documents.get(user=user), None)
+
+  def test_many(self):
+    f.UserFactory.create_batch(2, first_name='foo')
+    self.assertEqual(documents.get(user__first_name='foo'), None)
+
+  def test_rebuild(self):
+    users = f.UserFactory.create_batch(5)
+    for user in users:
+      f.AttendanceFactory(user=user)
+      f.UserAttributeFactory(user=user)
+    external = f.UserFactory()
+    User.objects.filter(pk=external.pk).update(external_source='foo', external_id='bar')
+    # chunks of 2, 2 and 1 users, each read with 3 queries and replaced with
+    # 4, and the document of the external user removed
+    with self.assertNumQueries(3 * 7 + 1):
+      self.assertEqual(documents.rebuild(chunk_size=2), 5)
+    for user in users:
+      self.assertEqual(json.loads(documents.get(user=user)), QuerySerializer(user).data)
+    self.assertFalse(UserDocument.objects.filter(user=external).exists())
+
+  def test_command(self):
+    user = f.UserFactory()
+    out = StringIO()
+    call_command('rebuild_user_documents', stdout=out)
+    self.assertEqual(out.getvalue().strip(), 'Rebuilt 1 user documents')
+    self.assertEqual(json.loads(documents.get(user=user)), QuerySerializer(user).data)
+
+
+# vim: tabstop=2 expandtab shiftwidth=2 softtabstop=2
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2014-2015 Haltu Oy, http://haltu.fi
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+# pylint: disable=locally-disabled, no-member
+
+import datetime
+
+import mock
+
+from django.test import TestCase
+from django.test import override_settings
+from django.utils import timezone
+
+from authdata import lookup_filter
+from authdata import query_cache
+from authdata.datasources.base import ExternalDataSource, stored_users
+from authdata.models import UserAttribute
+from authdata.tests import factories as f
+
+
+class TestBloomFilter(TestCase):
+
+  def test_no_false_negatives(self):
+    bloom = lookup_filter.BloomFilter(1000)
+    values = [u'välue%d' % i for i in xrange(1000)]
+    for value in values:
+      bloom.add(value)
+    for value in values:
+      self.assertTrue(value in bloom)
+
+  def test_error_rate(self):
+    bloom = lookup_filter.BloomFilter(1000, error_rate=0.01)
+    for i in xrange(1000):
+      bloom.add('value%d' % i)
+    false_positives = sum(1 for i in xrange(10000) if 'other%d' % i in bloom)
+    self.assertLess(false_positives, 300)
+
+  def test_types(self):
+    bloom = lookup_filter.BloomFilter(10)
+    bloom.add(123)
+    self.assertTrue(u'123' in bloom)
+
+
+@override_settings(AUTHDATA_LOOKUP_FILTER=True)
+@mock.patch('authdata.lookup_filter.threading.Thread')
+class TestKnownValues(TestCase):
+
+  def setUp(self):
+    self.known_values = lookup_filter.KnownValues()
+
+  def test_not_built(self, thread_mock):
+    self.assertTrue(self.known_values.might_contain('foo', 'bar'))
+    self.assertTrue(self.known_values.might_contain('foo', 'bar'))
+    thread_mock.assert_called_once_with(target=self.known_values.rebuild, name='authdata-lookup-filter')
+
+  def test_rebuild(self, thread_mock):
+    f.UserAttributeFactory(attribute__name='foo', value='bar')
+    f.AttributeFactory(name='empty')
+    self.known_values.rebuild()
+    self.assertTrue(self.known_values.might_contain('foo', 'bar'))
+    # rows are not read again within the sync interval
+    with self.assertNumQueries(0):
+      self.assertFalse(self.known_values.might_contain('foo', 'baz'))
+      self.assertFalse(self.known_values.might_contain('empty', 'baz'))
+      # attributes created after the build have no filter
+      self.assertTrue(self.known_values.might_contain('unknown', 'baz'))
+    self.assertFalse(thread_mock.called)
+
+  def test_add(self, thread_mock):
+    attribute = f.AttributeFactory(name='foo')
+    self.known_values.rebuild()
+    self.known_values.add(attribute.pk, 'bar')
+    self.assertTrue(self.known_values.might_contain('foo', 'bar'))
+
+  @override_settings(AUTHDATA_LOOKUP_FILTER_SYNC_INTERVAL=0)
+  def test_sync(self, thread_mock):
+    attribute = f.AttributeFactory(name='foo')
+    self.known_values.rebuild()
+    with mock.patch.object(lookup_filter, 'known_values', lookup_filter.KnownValues()):
+      # saved by another process
+      f.UserAttributeFactory(attribute=attribute, value='bar')
+    self.assertTrue(self.known_values.might_contain('foo', 'bar'))
+
+  @override_settings(AUTHDATA_LOOKUP_FILTER_SYNC_INTERVAL=0)
+  def test_sync_changed(self, thread_mock):
+    user_attribute = f.UserAttributeFactory(attribute__name='foo', value='bar')
+    self.known_values.rebuild()
+    # changed in place by another process
+    UserAttribute.objects.filter(pk=user_attribute.pk).update(value='baz', modified=timezone.now())
+    self.assertTrue(self.known_values.might_contain('foo', 'baz'))
+
+  @override_settings(AUTHDATA_LOOKUP_FILTER_SYNC_INTERVAL=0)
+  def test_sync_margin(self, thread_mock):
+    attribute = f.AttributeFactory(name='foo')
+    self.known_values.rebuild()
+    self.known_values.sync()
+    # committed by another process after the sync, with an earlier modified time
+    with mock.patch.object(lookup_filter, 'known_values', lookup_filter.KnownValues()):
+      user_attribute = f.UserAttributeFactory(attribute=attribute, value='bar')
+    UserAttribute.objects.filter(pk=user_attribute.pk).update(modified=timezone.now() - datetime.timedelta(seconds=30))
+    self.assertTrue(self.known_values.might_contain('foo', 'bar'))
+    UserAttribute.objects.filter(pk=user_attribute.pk).update(value='baz',
+        modified=timezone.now() - datetime.timedelta(seconds=90))
+    self.assertFalse(self.known_values.might_contain('foo', 'baz'))
+
+  def test_rebuild_interval(self, thread_mock):
+    self.known_values.rebuild()
+    self.known_values.built_at -= 3600
+    self.known_values.might_contain('foo', 'bar')
+    self.assertTrue(thread_mock.called)
+
+  def test_reset(self, thread_mock):
+    self.known_values.rebuild()
+    self.known_values.reset()
+    self.assertTrue(self.known_values.might_contain('foo', 'bar'))
+
+  @override_settings(AUTHDATA_LOOKUP_FILTER=False)
+  def test_disabled(self, thread_mock):
+    self.known_values.rebuild()
+    self.assertTrue(self.known_values.might_contain('foo', 'bar'))
+
+  def test_signals(self, thread_mock):
+    with mock.patch.object(lookup_filter, 'known_values', self.known_values):
+      self.known_values.rebuild()
+      user_attribute = f.UserAttributeFactory(attribute__name='foo', value='baz')
+      attribute = user_attribute.attribute
+      self.known_values.rebuild()
+      # the attribute is not fetched to add the value
+      user_attribute = UserAttribute.objects.get(pk=user_attribute.pk)
+      user_attribute.value = 'bar'
+      with self.assertNumQueries(0):
+        lookup_filter._add_known_value(UserAttribute, user_attribute)  # pylint: disable=protected-access
+      self.assertTrue(self.known_values.might_contain('foo', 'bar'))
+      attribute.name = 'zap'
+      attribute.save()
+      self.assertEqual(self.known_values.filters, None)
+
+  def test_provision_users(self, thread_mock):
+    stored_users.clear()
+    obj = ExternalDataSource()
+    obj.external_source = 'foo'
+    f.AttributeFactory(name='foo')
+    with mock.patch.object(lookup_filter, 'known_values', self.known_values):
+      self.known_values.rebuild()
+      obj.provision_user(oid='oid', external_id='123')
+      with self.assertNumQueries(0):
+        self.assertTrue(self.known_values.might_contain('foo', '123'))
+
+
+class TestExternalMiss(TestCase):
+
+  def setUp(self):
+    query_cache.get_cache().clear()
+
+  def test_miss(self):
+    self.assertFalse(lookup_filter.is_external_miss('foo', 'bar'))
+    lookup_filter.remember_external_miss('foo', 'bar')
+    self.assertTrue(lookup_filter.is_external_miss('foo', 'bar'))
+    self.assertFalse(lookup_filter.is_external_miss('foo', 'baz'))
+
+  @override_settings(AUTHDATA_EXTERNAL_MISS_TIMEOUT=0)
+  def test_disabled(self):
+    lookup_filter.remember_external_miss('foo', 'bar')
+    self.assertFalse(lookup_filter.is_external_miss('foo', 'bar'))
+
+
+# vim: tabstop=2 expandtab shiftwidth=2 softtabstop=2
@@ -108,6 +108,13 @@ class TestUserAttribute(TestCase):
     self.assertIn(u'Ääkkösattribute', unicode(o))
     self.assertIn(u'Ääkkösvalue', unicode(o))
 
+  def test_value_hash(self):
+    o = f.UserAttributeFactory(value=u'Ääkkösvalue')
+    self.assertEqual(o.value_hash, models.hash_value(u'Ääkkösvalue'))
+    o.value = None
+    o.save()
+    self.assertEqual(o.value_hash, None)
+
 
 class TestRole(TestCase):
   def test_role(self):
@@ -132,6 +139,15 @@ class TestAttendance(TestCase):
     self.assertIn(u'Ääkkösmunicipality', unicode(o))
 
 
+class TestPendingProvision(TestCase):
+  def test_pendingprovision(self):
+    o = models.PendingProvision.objects.create(username=u'oid', external_id=u'Ääkkösid', external_source=u'foo')
+    self.assertTrue(o)
+    self.assertTrue(o.created)
+    self.assertIn(u'oid', unicode(o))
+    self.assertIn(u'foo', unicode(o))
+
+
 class TestTimeStampedModel(TestCase):
   def test_timestampedmodel(self):
     o = models.TimeStampedModel()
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2014-2015 Haltu Oy, http://haltu.fi
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+# pylint: disable=locally-disabled, no-member
+
+from django.test import TestCase
+from django.test import override_settings
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from authdata.pagination import IdCursorPagination
+
+
+@override_settings(REST_FRAMEWORK={'PAGINATE_BY': 10, 'PAGINATE_BY_PARAM': 'page_size', 'MAX_PAGINATE_BY': 1000})
+class TestIdCursorPagination(TestCase):
+
+  def get_page_size(self, query):
+    request = Request(APIRequestFactory().get('/api/1/user/', query))
+    return IdCursorPagination().get_page_size(request)
+
+  def test_page_size(self):
+    self.assertEqual(self.get_page_size({}), 10)
+    self.assertEqual(self.get_page_size({'page_size': '50'}), 50)
+    self.assertEqual(self.get_page_size({'page_size': '5000'}), 1000)
+    self.assertEqual(self.get_page_size({'page_size': '0'}), 1)
+    self.assertEqual(self.get_page_size({'page_size': 'foo'}), 10)
+
+
+# vim: tabstop=2 expandtab shiftwidth=2 softtabstop=2
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2014-2015 Haltu Oy, http://haltu.fi
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+# pylint: disable=locally-disabled, no-member
+
+from django.test import TestCase
+from django.test import override_settings
+from authdata import query_cache
+from authdata.datasources.base import ExternalDataSource, stored_users
+from authdata.tests import factories as f
+
+
+class TestQueryCache(TestCase):
+
+  def setUp(self):
+    query_cache.get_cache().clear()
+
+  def test_store(self):
+    key = query_cache.user_key(u'Ääkköset')
+    self.assertEqual(query_cache.get(key), None)
+    query_cache.store(key, {'username': u'Ääkköset'})
+    self.assertEqual(query_cache.get(key), {'username': u'Ääkköset'})
+    self.assertEqual(query_cache.user_key(u'Ääkköset'), key)
+
+  def test_enabled(self):
+    self.assertTrue(query_cache.is_enabled())
+    with override_settings(AUTHDATA_QUERY_CACHE=None):
+      self.assertFalse(query_cache.is_enabled())
+
+  def test_keys(self):
+    self.assertNotEqual(query_cache.user_key('foo'), query_cache.attribute_key('foo', 'bar'))
+    self.assertNotEqual(query_cache.attribute_key('foo', 'bar'), query_cache.attribute_key('foo', 'baz'))
+
+  def test_invalidate(self):
+    key = query_cache.attribute_key('foo', 'bar')
+    query_cache.store(key, {})
+    query_cache.invalidate()
+    self.assertNotEqual(query_cache.attribute_key('foo', 'bar'), key)
+
+  def test_version_lost(self):
+    key = query_cache.user_key('foo')
+    query_cache.get_cache().delete(query_cache.VERSION_KEY)
+    self.assertNotEqual(query_cache.user_key('foo'), key)
+
+  def test_signals(self):
+    for factory in (f.UserFactory, f.UserAttributeFactory, f.AttendanceFactory, f.SchoolFactory,
+                    f.MunicipalityFactory, f.RoleFactory, f.AttributeFactory):
+      obj = factory()
+      version = query_cache.get_version()
+      obj.save()
+      self.assertNotEqual(query_cache.get_version(), version)
+      version = query_cache.get_version()
+      obj.delete()
+      self.assertNotEqual(query_cache.get_version(), version)
+
+  def test_provision_users(self):
+    stored_users.clear()
+    obj = ExternalDataSource()
+    obj.external_source = 'foo'
+    obj.provision_user(oid='oid', external_id='1')
+    version = query_cache.get_version()
+    obj.provision_user(oid='oid', external_id='2')
+    self.assertNotEqual(query_cache.get_version(), version)
+
+
+# vim: tabstop=2 expandtab shiftwidth=2 softtabstop=2
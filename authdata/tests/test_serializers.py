@@ -5,6 +5,7 @@
 from mock import Mock
 from django.test import TestCase
 from authdata import serializers
+from authdata.models import User
 from authdata.tests import factories as f
 
 
@@ -84,6 +85,23 @@ class TestUserSerializer(TestCase):
     self.assertEqual(data[0], d)
 
 
+  def test_attribute_data_prefetched(self):
+    obj = serializers.UserSerializer()
+    obj.context['request'] = Mock()
+    obj.context['request'].user = Mock()
+    obj.context['request'].user.username = u'foo'
+
+    user_obj = f.UserFactory()
+    user_attribute_obj = f.UserAttributeFactory(user=user_obj, data_source__name=u'foo')
+    f.UserAttributeFactory(user=user_obj, data_source__name=u'bar')
+
+    qs = User.objects.filter(pk=user_obj.pk)
+    user_obj = serializers.UserSerializer.setup_eager_loading(qs, data_sources=[user_attribute_obj.data_source.pk])[0]
+    with self.assertNumQueries(0):
+      data = obj.attribute_data(user_obj)
+    self.assertEqual(data, [{'name': user_attribute_obj.attribute.name, 'value': user_attribute_obj.value}])
+
+
 class TestUserAttributeSerializer(TestCase):
 
   def test_save(self):
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2014-2015 Haltu Oy, http://haltu.fi
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+# pylint: disable=locally-disabled, no-member
+import mock
+
+from django.test import TestCase
+from django.test import override_settings
+from authdata import lookup_filter
+from authdata import query_cache
+from authdata import signals
+from authdata.models import User
+from authdata.tests import factories as f
+
+
+@override_settings(AUTHDATA_LOOKUP_FILTER=True)
+class TestBulkWritten(TestCase):
+
+  def setUp(self):
+    self.known_values = lookup_filter.KnownValues()
+    with mock.patch('authdata.lookup_filter.threading.Thread'):
+      self.known_values.rebuild()
+
+  def test_bulk_written(self):
+    user = f.UserFactory()
+    attribute = f.AttributeFactory(name='foo')
+    version = query_cache.get_version()
+    with mock.patch.object(lookup_filter, 'known_values', self.known_values):
+      signals.bulk_written([user.pk], [(attribute.pk, 'bar')])
+    self.assertGreater(User.objects.get(pk=user.pk).last_changed, user.last_changed)
+    self.assertTrue(self.known_values._contains(attribute.pk, 'bar'))  # pylint: disable=protected-access
+    self.assertNotEqual(query_cache.get_version(), version)
+
+  def test_nothing_written(self):
+    version = query_cache.get_version()
+    with self.assertNumQueries(0):
+      signals.bulk_written([])
+    self.assertEqual(query_cache.get_version(), version)
+
+
+# vim: tabstop=2 expandtab shiftwidth=2 softtabstop=2
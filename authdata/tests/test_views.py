@@ -24,6 +24,10 @@
 # THE SOFTWARE.
 # pylint: disable=locally-disabled, no-member, unused-argument
 
+import datetime
+import json
+import time
+
 import mock
 import requests
 
@@ -32,11 +36,19 @@ from rest_framework.test import APITestCase
 from rest_framework.test import force_authenticate
 
 import django.http
+from django.db import connection
 from django.test import override_settings
+from django.utils import timezone
+from django.test.utils import CaptureQueriesContext
 
 import authdata.models
 import authdata.views
 import authdata.datasources.dreamschool
+from authdata import lookup_filter
+from authdata import query_cache
+from authdata.datasources import registry
+from authdata.datasources.base import CursorExpired
+from authdata.serializers import QuerySerializer
 from authdata.tests import factories as f
 
 
@@ -120,13 +132,17 @@ class TestAdminView(APITestCase):
 @override_settings(AUTHDATA_DREAMSCHOOL_ORG_MAP=AUTHDATA_DREAMSCHOOL_ORG_MAP)
 class TestHelpers(APITestCase):
 
+  def setUp(self):
+    # handlers are shared, create them again with the mocked requests
+    registry.reset()
+
   def test_get_external_user_data(self):
     with mock.patch('authdata.datasources.dreamschool.requests') as requests_mock:
       response_mock = mock.Mock()
       response_mock.status_code = 200
       response_mock.json.return_value = DS_DATA
 
-      requests_mock.get.return_value = response_mock
+      requests_mock.Session.return_value.get.return_value = response_mock
       requests_mock.codes = requests.codes
 
       ext_user_data = authdata.views._get_external_user_data('dreamschool', '123')
@@ -143,6 +159,8 @@ class TestHelpers(APITestCase):
 class TestQueryView(APITestCase):
 
   def setUp(self):
+    registry.reset()
+    query_cache.get_cache().clear()
     self.request_factory = APIRequestFactory()
     self.user = f.UserFactory.create()
 
@@ -185,6 +203,103 @@ class TestQueryView(APITestCase):
 
     self.assertEqual(response.status_code, 200)
 
+  def test_get_user_query_count(self, requests_mock):
+    request = self.request_factory.get('/api/1/users')
+    force_authenticate(request, user=self.user)
+    view = authdata.views.QueryView.as_view()
+
+    user = f.UserFactory.create(username='foo')
+    for _ in xrange(3):
+      f.AttendanceFactory(user=user)
+      f.UserAttributeFactory(user=user)
+    f.UserAttributeFactory(user=user, disabled_at=timezone.now())
+    authdata.models.UserDocument.objects.all().delete()
+    with self.assertNumQueries(4):
+      # document, user, attendances, attributes
+      response = view(request, username='foo')
+      response.render()
+
+    self.assertEqual(response.status_code, 200)
+    self.assertEqual(len(response.data['roles']), 3)
+    self.assertEqual(len(response.data['attributes']), 3)
+
+  def test_get_user_document(self, requests_mock):
+    request = self.request_factory.get('/api/1/users')
+    force_authenticate(request, user=self.user)
+    view = authdata.views.QueryView.as_view()
+
+    attendance = f.AttendanceFactory(user__username='foo', role__name='student')
+    with self.assertNumQueries(1):
+      response = view(request, username='foo')
+    self.assertEqual(response.status_code, 200)
+    self.assertEqual(json.loads(response.content),
+        QuerySerializer(authdata.models.User.objects.get(username='foo')).data)
+
+    # the document is rebuilt when the data of the user changes
+    attendance.role.name = 'teacher'
+    attendance.role.save()
+    with self.assertNumQueries(1):
+      response = view(request, username='foo')
+    self.assertEqual(json.loads(response.content)['roles'][0]['role'], 'teacher')
+
+  def test_get_object_with_attributes_document(self, requests_mock):
+    request = self.request_factory.get('/api/1/user', {'foo': 'bar'})
+    force_authenticate(request, user=self.user)
+    view = authdata.views.QueryView.as_view()
+
+    f.UserAttributeFactory(attribute__name='foo', value='bar', user__username='baz')
+    with self.assertNumQueries(1):
+      response = view(request)
+    self.assertEqual(json.loads(response.content)['username'], 'baz')
+
+  def test_get_user_cached(self, requests_mock):
+    request = self.request_factory.get('/api/1/users')
+    force_authenticate(request, user=self.user)
+    view = authdata.views.QueryView.as_view()
+
+    attendance = f.AttendanceFactory(user__username='foo', role__name='student')
+    view(request, username='foo')
+    with self.assertNumQueries(0):
+      response = view(request, username='foo')
+    self.assertEqual(json.loads(response.content)['roles'][0]['role'], 'student')
+
+    attendance.role = f.RoleFactory(name='teacher')
+    attendance.save()
+    response = view(request, username='foo')
+    self.assertEqual(json.loads(response.content)['roles'][0]['role'], 'teacher')
+
+  @override_settings(AUTHDATA_QUERY_CACHE=None)
+  def test_get_user_cache_disabled(self, requests_mock):
+    self.client.force_authenticate(user=self.user)
+    f.AttendanceFactory(user__username='foo')
+    with self.assertNumQueries(1):
+      # the stored document
+      self.assertEqual(json.loads(self.client.get('/api/1/query/foo').content)['username'], 'foo')
+
+  def test_get_object_with_attributes_cached(self, requests_mock):
+    request = self.request_factory.get('/api/1/user', {'foo': 'bar'})
+    force_authenticate(request, user=self.user)
+    view = authdata.views.QueryView.as_view()
+
+    user_attribute = f.UserAttributeFactory(attribute__name='foo', value='bar')
+    self.assertEqual(view(request).status_code, 200)
+    with self.assertNumQueries(0):
+      self.assertEqual(view(request).status_code, 200)
+
+    user_attribute.delete()
+    self.assertEqual(view(request).status_code, 404)
+
+  @override_settings(AUTHDATA_LOOKUP_FILTER=True, AUTHDATA_LOOKUP_FILTER_SYNC_INTERVAL=0)
+  def test_get_object_with_attributes_changed_elsewhere(self, requests_mock):
+    user_attribute = f.UserAttributeFactory(attribute__name='foo', value='bar')
+    self.client.force_authenticate(user=self.user)
+    with mock.patch.object(lookup_filter, 'known_values', lookup_filter.KnownValues()) as known_values:
+      known_values.rebuild()
+      # changed in place by another process
+      authdata.models.UserAttribute.objects.filter(pk=user_attribute.pk).update(value='baz',
+          value_hash=authdata.models.hash_value('baz'), modified=timezone.now())
+      self.assertEqual(self.client.get('/api/1/user?foo=baz').status_code, 200)
+
   def test_get_user_external_source_not_configured(self, requests_mock):
     request = self.request_factory.get('/api/1/users')
     force_authenticate(request, user=self.user)
@@ -234,7 +349,7 @@ class TestQueryView(APITestCase):
     ds_response_mock = mock.Mock()
     ds_response_mock.status_code = 200
     ds_response_mock.json.return_value = DS_DATA
-    requests_mock.get.return_value = ds_response_mock
+    requests_mock.Session.return_value.get.return_value = ds_response_mock
     requests_mock.codes = requests.codes
 
     request = self.request_factory.get('/api/1/users')
@@ -258,7 +373,7 @@ class TestQueryView(APITestCase):
     ds_response_mock = mock.Mock()
     ds_response_mock.status_code = 200
     ds_response_mock.json.return_value = DS_DATA
-    requests_mock.get.return_value = ds_response_mock
+    requests_mock.Session.return_value.get.return_value = ds_response_mock
     requests_mock.codes = requests.codes
 
     request = self.request_factory.get('/api/1/users', {'dreamschool': 123})
@@ -272,6 +387,17 @@ class TestQueryView(APITestCase):
     expected['attributes'] = [{'name': u'dreamschool', 'value': u'123'}]
     self.assertEqual(response.data, expected)
 
+  def test_get_user_fetch_external_disabled_attributes(self, requests_mock):
+    user = f.UserFactory(username='external')
+    f.UserAttributeFactory(user=user, attribute__name='foo', value='1')
+    f.UserAttributeFactory(user=user, attribute__name='bar', value='2', disabled_at=timezone.now())
+    self.client.force_authenticate(user=self.user)
+
+    with mock.patch('authdata.views._get_external_user_data', return_value={'username': 'external', 'attributes': []}):
+      result = self.client.get('/api/1/user?dreamschool=123')
+
+    self.assertEqual(result.data['attributes'], [{'name': 'foo', 'value': '1'}])
+
   def test_get_user_fetch_doesnt_exist(self, requests_mock):
     self.client.force_authenticate(user=self.user)
 
@@ -281,6 +407,34 @@ class TestQueryView(APITestCase):
     self.assertEqual(result.status_code, 200, repr(result))
     self.assertEqual(result.data, None)
 
+  def test_get_user_fetch_doesnt_exist_remembered(self, requests_mock):
+    self.client.force_authenticate(user=self.user)
+
+    with mock.patch('authdata.views._get_external_user_data', return_value=None) as get_mock:
+      self.client.get('/api/1/user?dreamschool=123')
+      result = self.client.get('/api/1/user?dreamschool=123')
+
+    self.assertEqual(result.data, None)
+    self.assertEqual(get_mock.call_count, 1)
+    self.assertTrue(lookup_filter.is_external_miss('dreamschool', '123'))
+
+  def test_get_object_with_attributes_unknown_value(self, requests_mock):
+    user_attribute = f.UserAttributeFactory(attribute__name='foo', value='bar')
+    request = self.request_factory.get('/api/1/user', {'foo': 'bar'})
+    force_authenticate(request, user=self.user)
+    view = authdata.views.QueryView()
+    view.kwargs = {}
+    view.request = request
+    view.format_kwarg = None
+    with mock.patch.object(lookup_filter, 'known_values') as known_values_mock:
+      known_values_mock.might_contain.return_value = False
+      # the document is not looked up
+      with self.assertNumQueries(0):
+        self.assertEqual(view.get_document(), None)
+      # the filter may not know the value yet, the user is found anyway
+      self.assertEqual(view.get_object(), user_attribute.user)
+    known_values_mock.might_contain.assert_called_once_with('foo', 'bar')
+
   def test_get_user_external_source_import_error(self, requests_mock):
     self.client.force_authenticate(user=self.user)
 
@@ -294,7 +448,7 @@ class TestQueryView(APITestCase):
     ds_response_mock.status_code = 200
     ds_response_mock.json.return_value = DS_DATA
     requests_mock.codes = requests.codes
-    requests_mock.get.return_value = ds_response_mock
+    requests_mock.Session.return_value.get.return_value = ds_response_mock
 
     self.client.force_authenticate(user=self.user)
     user_obj = f.UserFactory(
@@ -314,7 +468,7 @@ class TestQueryView(APITestCase):
     ds_response_mock.status_code = 200
     ds_response_mock.json.return_value = DS_DATA
     requests_mock.codes = requests.codes
-    requests_mock.get.return_value = ds_response_mock
+    requests_mock.Session.return_value.get.return_value = ds_response_mock
 
     self.client.force_authenticate(user=self.user)
     user_obj = f.UserFactory(
@@ -334,12 +488,28 @@ class TestQueryView(APITestCase):
     result = self.client.get('/api/1/user?dreamschool=123')
     self.assertEqual(result.status_code, 200)
 
+  def test_get_object_with_attributes_query_count(self, requests_mock):
+    self.client.force_authenticate(user=self.user)
+    user_obj = f.UserFactory()
+    f.UserAttributeFactory(user=user_obj, attribute__name='foo', value='bar')
+    f.UserAttributeFactory(attribute__name='foo', value='bar', disabled_at=timezone.now())
+    request = self.request_factory.get('/api/1/user', {'foo': 'bar'})
+    force_authenticate(request, user=self.user)
+    view = authdata.views.QueryView()
+    view.kwargs = {}
+    view.request = request
+    view.format_kwarg = None
+    # user lookup and the prefetches of roles and attributes
+    with self.assertNumQueries(3):
+      obj = view.get_object()
+    self.assertEqual(obj, user_obj)
+
   def test_get_user_fetch_no_attribute_binding(self, requests_mock):
     ds_response_mock = mock.Mock()
     ds_response_mock.status_code = 200
     ds_response_mock.json.return_value = DS_DATA
     requests_mock.codes = requests.codes
-    requests_mock.get.return_value = ds_response_mock
+    requests_mock.Session.return_value.get.return_value = ds_response_mock
 
     self.client.force_authenticate(user=self.user)
     f.UserAttributeFactory(user=self.user, attribute__name='foo', value='bar')
@@ -353,6 +523,106 @@ class TestQueryView(APITestCase):
     self.assertEqual(result.status_code, 404)
 
 
+@override_settings(AUTH_EXTERNAL_ATTRIBUTE_BINDING=AUTH_EXTERNAL_ATTRIBUTE_BINDING)
+class TestBatchQueryView(APITestCase):
+
+  def setUp(self):
+    query_cache.get_cache().clear()
+    self.user = f.UserFactory.create()
+    self.client.force_authenticate(user=self.user)
+
+  def _create_users(self, count):
+    for _ in xrange(count):
+      user = f.UserFactory()
+      f.AttendanceFactory(user=user)
+      f.UserAttributeFactory(user=user, attribute__name='foo')
+
+  def test_local(self):
+    user = f.UserFactory(username='user1')
+    f.AttendanceFactory(user=user, role__name='teacher')
+    f.UserAttributeFactory(user=user, attribute__name='foo', value='bar')
+    data = {'usernames': ['user1', 'nobody'],
+            'attributes': [{'name': 'foo', 'value': 'bar'}, {'name': 'foo', 'value': 'baz'}]}
+    response = self.client.post('/api/1/batch_query', data, format='json')
+    self.assertEqual(response.status_code, 200)
+    self.assertEqual(response.data['usernames']['nobody'], None)
+    self.assertEqual(response.data['usernames']['user1']['roles'][0]['role'], 'teacher')
+    self.assertEqual(response.data['attributes']['foo']['bar']['username'], 'user1')
+    self.assertEqual(response.data['attributes']['foo']['baz'], None)
+
+  def test_query_count(self):
+    self._create_users(2)
+    with CaptureQueriesContext(connection) as few:
+      self.client.post('/api/1/batch_query', {
+        'usernames': list(authdata.models.User.objects.values_list('username', flat=True)),
+        'attributes': [{'name': 'foo', 'value': v} for v in authdata.models.UserAttribute.objects.values_list('value', flat=True)],
+      }, format='json')
+    self._create_users(8)
+    with CaptureQueriesContext(connection) as many:
+      self.client.post('/api/1/batch_query', {
+        'usernames': list(authdata.models.User.objects.values_list('username', flat=True)),
+        'attributes': [{'name': 'foo', 'value': v} for v in authdata.models.UserAttribute.objects.values_list('value', flat=True)],
+      }, format='json')
+    self.assertEqual(len(few), len(many))
+
+  def test_ambiguous_value(self):
+    f.UserAttributeFactory(attribute__name='foo', value='bar')
+    f.UserAttributeFactory(attribute__name='foo', value='bar')
+    response = self.client.post('/api/1/batch_query', {'attributes': [{'name': 'foo', 'value': 'bar'}]}, format='json')
+    self.assertEqual(response.data['attributes']['foo']['bar'], None)
+
+  def test_user_deleted(self):
+    f.UserAttributeFactory(attribute__name='foo', value='bar')
+    # deleted after the attribute lookup
+    with mock.patch('authdata.views.QuerySerializer.setup_eager_loading', return_value=authdata.models.User.objects.none()):
+      response = self.client.post('/api/1/batch_query', {'attributes': [{'name': 'foo', 'value': 'bar'}]}, format='json')
+    self.assertEqual(response.status_code, 200)
+    self.assertEqual(response.data['attributes']['foo']['bar'], None)
+
+  def test_user_named_batch(self):
+    f.UserFactory(username='batch')
+    response = self.client.get('/api/1/query/batch')
+    self.assertEqual(response.status_code, 200)
+    self.assertEqual(json.loads(response.content)['username'], 'batch')
+
+  def test_external(self):
+    user = f.UserFactory(username='user1', external_source='dreamschool', external_id='1')
+    f.UserAttributeFactory(user=user, attribute__name='foo', value='bar')
+    f.UserAttributeFactory(user__username='user3', attribute__name='zap', value='zup')
+
+    def get_external_user_data(external_source, external_id):
+      self.assertEqual(external_source, 'dreamschool')
+      if external_id == 'missing':
+        return None
+      if external_id == 'error':
+        raise KeyError
+      username = {'1': 'user1', '2': 'user2', '3': 'user3'}[external_id]
+      return {'username': username, 'roles': [], 'attributes': []}
+
+    data = {'usernames': ['user1'],
+            'attributes': [{'name': 'dreamschool', 'value': v} for v in ('2', '3', 'missing', 'error')]}
+    with mock.patch('authdata.views._get_external_user_data', side_effect=get_external_user_data) as get_mock:
+      response = self.client.post('/api/1/batch_query', data, format='json')
+    self.assertEqual(get_mock.call_count, 5)
+    self.assertEqual(response.data['usernames']['user1'],
+        {'username': 'user1', 'roles': [], 'attributes': [{'name': 'foo', 'value': 'bar'}]})
+    self.assertEqual(response.data['attributes']['dreamschool']['2']['username'], 'user2')
+    self.assertEqual(response.data['attributes']['dreamschool']['3']['attributes'], [{'name': 'zap', 'value': 'zup'}])
+    self.assertEqual(response.data['attributes']['dreamschool']['missing'], None)
+    self.assertEqual(response.data['attributes']['dreamschool']['error'], None)
+    self.assertTrue(lookup_filter.is_external_miss('dreamschool', 'missing'))
+
+  @override_settings(AUTHDATA_BATCH_QUERY_MAX_SIZE=2)
+  def test_too_many(self):
+    data = {'usernames': ['user1', 'user2'], 'attributes': [{'name': 'foo', 'value': 'bar'}]}
+    response = self.client.post('/api/1/batch_query', data, format='json')
+    self.assertEqual(response.status_code, 400)
+
+  def test_invalid(self):
+    response = self.client.post('/api/1/batch_query', {'attributes': [{'name': 'foo'}]}, format='json')
+    self.assertEqual(response.status_code, 400)
+
+
 class TestUserFilter(APITestCase):
 
   def test_timestamp_filter(self):
@@ -381,6 +651,7 @@ class TestUserFilter(APITestCase):
 class TestUserViewSet(APITestCase):
 
   def setUp(self):
+    registry.reset()
     self.request_factory = APIRequestFactory()
     self.user = f.UserFactory.create()
     self.client.force_authenticate(user=self.user)
@@ -389,18 +660,144 @@ class TestUserViewSet(APITestCase):
     ds_response_mock = mock.Mock()
     ds_response_mock.status_code = 200
     ds_response_mock.json.return_value = {'objects': [DS_DATA]}
-    requests_mock.get.return_value = ds_response_mock
+    requests_mock.Session.return_value.get.return_value = ds_response_mock
     requests_mock.codes = requests.codes
 
     response = self.client.get('/api/1/user/?municipality=Bar')
     self.assertEquals(response.status_code, 200)
 
+  def _list_users(self, count):
+    for _ in xrange(count):
+      user = f.UserFactory()
+      for _ in xrange(2):
+        f.AttendanceFactory(user=user)
+        f.UserAttributeFactory(user=user, data_source__name=self.user.username)
+    with CaptureQueriesContext(connection) as queries:
+      response = self.client.get('/api/1/user/')
+    self.assertEquals(response.status_code, 200)
+    return len(queries)
+
+  def test_list_query_count(self, requests_mock):
+    few = self._list_users(2)
+    many = self._list_users(8)
+    self.assertEquals(few, many)
+
+  def test_list_source_attributes(self, requests_mock):
+    user = f.UserFactory()
+    f.UserAttributeFactory(user=user, attribute__name='own', data_source__name=self.user.username)
+    f.UserAttributeFactory(user=user, attribute__name='other', data_source__name='other')
+    response = self.client.get('/api/1/user/', {'username': user.username})
+    self.assertEquals(response.status_code, 200)
+    self.assertEquals([a['name'] for a in response.data['results'][0]['attributes']], ['own'])
+
+  def test_list_changed_at(self, requests_mock):
+    old = f.UserFactory()
+    attribute = f.UserAttributeFactory()
+    attendance = f.AttendanceFactory()
+    authdata.models.User.objects.update(last_changed=timezone.now() - datetime.timedelta(days=1))
+    tstamp = time.time() - 60
+    attribute.delete()
+    attendance.role.save()
+    changed = f.UserFactory()
+    with CaptureQueriesContext(connection) as queries:
+      response = self.client.get('/api/1/user/', {'changed_at': tstamp})
+    self.assertEquals(response.status_code, 200)
+    usernames = set(u['username'] for u in response.data['results'])
+    self.assertEquals(usernames, set([attribute.user.username, attendance.user.username, changed.username]))
+    self.assertNotIn(old.username, usernames)
+    user_query = [q['sql'] for q in queries.captured_queries if 'last_changed" >=' in q['sql']][0]
+    self.assertNotIn('JOIN', user_query)
+
+  def test_list_changed_at_invalid(self, requests_mock):
+    f.UserFactory()
+    response = self.client.get('/api/1/user/', {'changed_at': 'foo'})
+    self.assertEquals(response.status_code, 200)
+    self.assertEquals(response.data['results'], [])
+
+  def test_list_cursor(self, requests_mock):
+    for _ in xrange(4):
+      f.UserFactory()
+    usernames = []
+    url = '/api/1/user/?page_size=2'
+    while url:
+      response = self.client.get(url)
+      self.assertEquals(response.status_code, 200)
+      self.assertFalse('count' in response.data)
+      self.assertLessEqual(len(response.data['results']), 2)
+      usernames.extend(u['username'] for u in response.data['results'])
+      if len(usernames) == 2:
+        # created while paging
+        f.UserFactory(username='late')
+      url = response.data['next']
+    self.assertEquals(usernames, list(authdata.models.User.objects.order_by('id').values_list('username', flat=True)))
+    self.assertEquals(usernames[-1], 'late')
+
+  def test_list_cursor_query_count(self, requests_mock):
+    for _ in xrange(6):
+      f.UserFactory()
+    first = self.client.get('/api/1/user/?page_size=2')
+    with CaptureQueriesContext(connection) as queries:
+      self.client.get(first.data['next'])
+    # page and the prefetches, no count
+    self.assertEquals(len([q for q in queries if 'COUNT' in q['sql']]), 0)
+
+  def _export(self, url):
+    response = self.client.get(url)
+    self.assertEquals(response.status_code, 200)
+    self.assertEquals(response['Content-Type'], 'application/x-ndjson')
+    return [json.loads(line) for line in ''.join(response.streaming_content).splitlines()]
+
+  def test_export(self, requests_mock):
+    user = f.UserFactory()
+    f.AttendanceFactory(user=user, school__municipality__name='Foobar', role__name='teacher')
+    f.UserAttributeFactory(user=user, attribute__name='own', value=u'Äkäslompolo', data_source__name=self.user.username)
+    f.UserAttributeFactory(user=user, attribute__name='other', data_source__name='other')
+    f.AttendanceFactory(school__municipality__name='Other')
+    lines = self._export('/api/1/user/export/?municipality=foobar')
+    self.assertEquals(len(lines), 1)
+    self.assertEquals(lines[0]['attributes'][0]['value'], u'Äkäslompolo')
+    self.assertEquals(lines[0]['roles'][0]['role'], 'teacher')
+    self.assertEquals([a['name'] for a in lines[0]['attributes']], ['own'])
+
+  @override_settings(AUTHDATA_EXPORT_CHUNK_SIZE=2)
+  def test_export_chunks(self, requests_mock):
+    for _ in xrange(4):
+      f.AttendanceFactory()
+    with CaptureQueriesContext(connection) as few:
+      lines = self._export('/api/1/user/export/')
+    self.assertEquals(len(lines), 5)
+    self.assertEquals(sorted(l['username'] for l in lines),
+        sorted(authdata.models.User.objects.values_list('username', flat=True)))
+    for _ in xrange(4):
+      f.AttendanceFactory()
+    with CaptureQueriesContext(connection) as many:
+      self._export('/api/1/user/export/')
+    # source lookup and users and attendances of each chunk, the client has
+    # no attributes to prefetch
+    self.assertEquals(len(few), 1 + 3 * 2)
+    self.assertEquals(len(many), 1 + 5 * 2)
+
+  def test_export_external(self, requests_mock):
+    response = self.client.get('/api/1/user/export/?municipality=Foo')
+    self.assertEquals(response.status_code, 400)
+
   def test_list_import_error(self, requests_mock):
-    with mock.patch('authdata.views.importlib') as importlib_mock:
-      importlib_mock.import_module = mock.Mock()
-      importlib_mock.import_module.side_effect = ImportError
+    with mock.patch('authdata.datasources.registry.get_handler', side_effect=ImportError):
+      response = self.client.get('/api/1/user/?municipality=Bar')
+    self.assertEquals(response.status_code, 200)
+
+  def test_list_cursor_expired(self, requests_mock):
+    handler = mock.Mock()
+    handler.get_user_data.side_effect = CursorExpired
+    with mock.patch('authdata.datasources.registry.get_handler', return_value=handler):
+      response = self.client.get('/api/1/user/?municipality=Bar&cursor=abc.20')
+    self.assertEquals(response.status_code, 400)
+
+  def test_list_source_not_configured(self, requests_mock):
+    with override_settings(AUTH_EXTERNAL_MUNICIPALITY_BINDING={'Bar': 'doesntexist'}):
       response = self.client.get('/api/1/user/?municipality=Bar')
     self.assertEquals(response.status_code, 200)
+    self.assertEquals(len(response.data['results']), 0)
 
 
 class TestAttributeViewSet(APITestCase):
@@ -508,7 +905,7 @@ class TestAttendanceViewSet(APITestCase):
     attendance = f.AttendanceFactory()
     result = self.client.get('/api/1/attendance/')
     self.assertEqual(result.status_code, 200, repr(result))
-    self.assertEqual(result.data[0]['group'], attendance.group)
+    self.assertEqual(result.data['results'][0]['group'], attendance.group)
 
   def test_delete(self):
     attendance = f.AttendanceFactory()
@@ -26,7 +26,7 @@
 from django.conf.urls import patterns, include, url
 from django.contrib import admin
 from rest_framework import routers
-from authdata.views import QueryView
+from authdata.views import QueryView, BatchQueryView
 from authdata.views import UserViewSet, AttributeViewSet, UserAttributeViewSet, MunicipalityViewSet, SchoolViewSet, RoleViewSet, AttendanceViewSet
 
 router = routers.DefaultRouter()
@@ -41,6 +41,7 @@ router.register(r'attendance', AttendanceViewSet)
 
 urlpatterns = patterns('',
     url(r'^api/1/user$', QueryView.as_view()),  # This should be removed as "/user" and "/user/" are now different which is confusing. User "/query/" instead
+    url(r'^api/1/batch_query/?$', BatchQueryView.as_view()),
     url(r'^api/1/query(/(?P<username>[\w._-]+))?/?$', QueryView.as_view()),
     url(r'^api/1/', include(router.urls)),
     url(r'^sysadmin/', include(admin.site.urls)),
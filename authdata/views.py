@@ -30,18 +30,31 @@ of the database.
 
 import logging
 import datetime
-import importlib
+import json
+import Queue
+import threading
+from django.db import connection
 from django.db.models import Q
 from django.http import Http404
-from django.shortcuts import get_object_or_404
+from django.http import HttpResponse
+from django.http import StreamingHttpResponse
 from django.conf import settings
+from django.utils import timezone
 from rest_framework import filters
 from rest_framework import generics
 from rest_framework import viewsets
+from rest_framework.decorators import list_route
 from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
 import django_filters
-from authdata.serializers import QuerySerializer, UserSerializer, AttributeSerializer, UserAttributeSerializer, MunicipalitySerializer, SchoolSerializer, RoleSerializer, AttendanceSerializer
-from authdata.models import User, Attribute, UserAttribute, Municipality, School, Role, Attendance
+from authdata import documents
+from authdata import lookup_filter
+from authdata.pagination import IdCursorPagination
+from authdata import query_cache
+from authdata.datasources import registry
+from authdata.datasources.base import CursorExpired
+from authdata.serializers import QuerySerializer, BatchQuerySerializer, UserSerializer, AttributeSerializer, UserAttributeSerializer, MunicipalitySerializer, SchoolSerializer, RoleSerializer, AttendanceSerializer
+from authdata.models import User, Attribute, UserAttribute, Municipality, School, Role, Attendance, Source, hash_value
 
 LOG = logging.getLogger(__name__)
 
@@ -50,13 +63,21 @@ def _get_external_user_data(external_source, external_id):
   """ Helper for selecting data source and making the query.
 
   Raises ImportError if external source configuration is wrong
+  and KeyError if the external source is not configured.
   """
-  source = settings.AUTH_EXTERNAL_SOURCES[external_source]
-  LOG.debug('Trying to import module of external authentication source', extra={'data': {'module_name': source[0]}})
-  handler_module = importlib.import_module(source[0])
-  kwargs = source[2]
-  handler = getattr(handler_module, source[1])(**kwargs)
-  return handler.get_data(external_id)
+  handler = registry.get_handler(external_source)
+  return handler.get_cached_data(external_id)
+
+
+def _attribute_user_ids(name, value):
+  """ Returns a subquery for the ids of users having an enabled attribute name with value
+
+  Attribute names are unique and enabled user attributes are indexed by
+  (attribute_id, value_hash), so the users are found with one probe. value is
+  compared as well in case of a hash collision.
+  """
+  return UserAttribute.objects.filter(attribute__name=name, value_hash=hash_value(value), value=value,
+      disabled_at__isnull=True).values('user_id')
 
 
 class QueryView(generics.RetrieveAPIView):
@@ -64,6 +85,12 @@ class QueryView(generics.RetrieveAPIView):
 
   Returned data format is defined in :py:class:`authdata.serializers.QuerySerializer`.
 
+  Responses for local users are cached, see :py:mod:`authdata.query_cache`,
+  and read from the documents stored by the writers, see
+  :py:mod:`authdata.documents`.
+  Documents are not looked up for unknown attribute values and the external
+  source is not queried repeatedly for them, see :py:mod:`authdata.lookup_filter`.
+
   Auth Data has endpoint ``/api/1/query?name=value`` which can be queried for the attributes.
 
   Query is made by GET parameters. Only one parameter is allowed.
@@ -89,11 +116,22 @@ class QueryView(generics.RetrieveAPIView):
 
   User attributes can be queried with username also. For example: ``/api/1/query/[username]``
   """
-  queryset = User.objects.all()
+  queryset = QuerySerializer.setup_eager_loading(User.objects.all())
   serializer_class = QuerySerializer
   lookup_field = 'username'
 
   def get(self, request, *args, **kwargs):
+    cache_key = self.get_cache_key()
+    body = query_cache.get(cache_key) if cache_key else None
+    if body is None:
+      body = self.get_document()
+      if body is not None and cache_key:
+        query_cache.store(cache_key, body)
+    if body is not None:
+      if request.accepted_renderer.format == 'json':
+        # the body is encoded the same way by the JSON renderer
+        return HttpResponse(body, content_type='application/json')
+      return Response(json.loads(body))
     # 1. look for a user object matching the query parameter. if it's found, check if it's an external user and fetch data
     try:
       user_obj = self.get_object()
@@ -114,24 +152,32 @@ class QueryView(generics.RetrieveAPIView):
         if user_data is None:
           # queried user does not exist in the external source
           return Response(None)
-        for user_attribute in user_obj.attributes.all():
+        for user_attribute in user_obj.active_attributes:
           # Add attributes to user data
           user_data['attributes'].append({'name': user_attribute.attribute.name, 'value': user_attribute.value})
         LOG.debug('/query returning data', extra={'data': {'user_data': repr(user_data)}})
         return Response(user_data)
+      serializer = self.get_serializer(user_obj)
+      if cache_key:
+        query_cache.store(cache_key, documents.encode(serializer.data))
+      return Response(serializer.data)
     else:
       # 2. if user was not found and query parameter is mapped to an external source, fetch and create user
       for attr in request.GET.keys():
         if attr in settings.AUTH_EXTERNAL_ATTRIBUTE_BINDING:
           try:
-            user_data = _get_external_user_data(settings.AUTH_EXTERNAL_ATTRIBUTE_BINDING[attr], request.GET.get(attr))
+            value = request.GET.get(attr)
+            if lookup_filter.is_external_miss(attr, value):
+              return Response(None)
+            user_data = _get_external_user_data(settings.AUTH_EXTERNAL_ATTRIBUTE_BINDING[attr], value)
             if user_data is None:
               # queried user does not exist in the external source
+              lookup_filter.remember_external_miss(attr, value)
               return Response(None)
 
-            # New users are created in data source
-            user_obj = User.objects.get(username=user_data['username'])
-            for user_attribute in user_obj.attributes.all():
+            # New users are created in data source. With deferred
+            # provisioning the user may not have been written yet.
+            for user_attribute in UserAttribute.objects.filter(user__username=user_data['username'], disabled_at__isnull=True).select_related('attribute'):
               # Add attributes to user data
               user_data['attributes'].append({'name': user_attribute.attribute.name, 'value': user_attribute.value})
             LOG.debug('/query returning data', extra={'data': {'user_data': repr(user_data)}})
@@ -145,19 +191,36 @@ class QueryView(generics.RetrieveAPIView):
         break
     return super(QueryView, self).get(request, *args, **kwargs)
 
+  def get_cache_key(self):
+    if not query_cache.is_enabled():
+      return None
+    lookup = self.kwargs.get(self.lookup_field, None)
+    if lookup:
+      return query_cache.user_key(lookup)
+    if len(self.request.GET) == 1:
+      return query_cache.attribute_key(*self.request.GET.items()[0])
+    return None
+
+  def get_document(self):
+    lookup = self.kwargs.get(self.lookup_field, None)
+    if lookup:
+      return documents.get(user__username=lookup)
+    if len(self.request.GET) == 1:
+      name, value = self.request.GET.items()[0]
+      if lookup_filter.known_values.might_contain(name, value):
+        return documents.get(user__in=_attribute_user_ids(name, value))
+    return None
+
   def get_object(self):
     qs = self.filter_queryset(self.get_queryset())
-    qs = qs.distinct()
     filter_kwargs = {}
     lookup = self.kwargs.get(self.lookup_field, None)
     if lookup:
       filter_kwargs = {self.lookup_field: lookup}
     else:
       for k, v in self.request.GET.iteritems():
-        a = get_object_or_404(Attribute.objects.all(), name=k)
-        filter_kwargs['attributes__attribute__name'] = a.name
-        filter_kwargs['attributes__value'] = v
-        filter_kwargs['attributes__disabled_at__isnull'] = True
+        # The lookup filter may lag behind other processes, so it is not used here
+        filter_kwargs['pk__in'] = _attribute_user_ids(k, v)
         break
       else:
         raise Http404
@@ -166,6 +229,157 @@ class QueryView(generics.RetrieveAPIView):
     return obj
 
 
+def _get_external_users_data(queries):
+  """ Helper for making many external queries concurrently.
+
+  queries is a dict of key: (external_source, external_id). Returns a dict
+  of key: user data, or None if the user was not found or the external
+  source failed.
+  """
+  results = {}
+  pending = Queue.Queue()
+  for key, query in queries.iteritems():
+    pending.put((key, query))
+
+  def fetch():
+    while True:
+      try:
+        key, (external_source, external_id) = pending.get_nowait()
+      except Queue.Empty:
+        return
+      try:
+        results[key] = _get_external_user_data(external_source, external_id)
+      except (ImportError, KeyError):
+        LOG.error('External source not available', extra={'data': {'external_source': repr(external_source)}})
+        results[key] = None
+      except Exception:  # pylint: disable=broad-except
+        LOG.error('External query failed', exc_info=True,
+            extra={'data': {'external_source': repr(external_source), 'external_id': repr(external_id)}})
+        results[key] = None
+
+  def work():
+    try:
+      fetch()
+    finally:
+      # the thread has a database connection of its own if users were provisioned
+      connection.close()
+
+  workers = min(getattr(settings, 'AUTHDATA_BATCH_QUERY_WORKERS', 10), len(queries))
+  if workers <= 1:
+    fetch()
+    return results
+  threads = [threading.Thread(target=work, name='authdata-batch-query') for _ in xrange(workers)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  return results
+
+
+class BatchQueryView(generics.GenericAPIView):
+  """The batch query endpoint resolves many users with one request
+
+  ``POST /api/1/batch_query`` accepts a list of usernames and a list of
+  attribute name and value pairs as defined in
+  :py:class:`authdata.serializers.BatchQuerySerializer`.
+
+  The response maps each queried username and each attribute value to the
+  data :py:class:`QueryView` would return for it, or to ``null`` if the user
+  was not found::
+
+    {
+      "usernames": {
+        "123abc": {"username": "123abc", "first_name": "Teppo", ...},
+        "456def": null
+      },
+      "attributes": {
+        "facebook_id": {
+          "foo": {"username": "789ghi", ...}
+        }
+      }
+    }
+
+  Local users are fetched with a fixed number of queries. Users of external
+  sources are fetched concurrently by up to ``AUTHDATA_BATCH_QUERY_WORKERS``
+  threads.
+  """
+  queryset = User.objects.all()
+  serializer_class = BatchQuerySerializer
+
+  def post(self, request, *args, **kwargs):
+    serializer = self.get_serializer(data=request.data)
+    serializer.is_valid(raise_exception=True)
+    usernames = set(serializer.validated_data.get('usernames', []))
+    pairs = set((a['name'], a['value']) for a in serializer.validated_data.get('attributes', []))
+
+    # user ids matching the attribute values
+    user_ids = {}
+    lookup = Q()
+    for name, value in pairs:
+      lookup |= Q(attribute__name=name, value_hash=hash_value(value), value=value)
+    if lookup:
+      matches = UserAttribute.objects.filter(lookup, disabled_at__isnull=True)
+      for name, value, user_id in matches.values_list('attribute__name', 'value', 'user_id'):
+        user_ids.setdefault((name, value), set()).add(user_id)
+    # like in QueryView, values matching many users match none
+    user_ids = dict((pair, ids.pop()) for pair, ids in user_ids.iteritems() if len(ids) == 1)
+
+    users = QuerySerializer.setup_eager_loading(User.objects.filter(Q(username__in=usernames) | Q(pk__in=user_ids.values())))
+    users = dict((u.pk, u) for u in users)
+
+    data = {}
+    external_queries = {}
+    external_users = {}
+    for user in users.itervalues():
+      if user.external_source and user.external_id:
+        external_queries[user.username] = (user.external_source, user.external_id)
+        external_users[user.username] = user
+      else:
+        data[user.username] = QuerySerializer(user, context=self.get_serializer_context()).data
+    unknown_pairs = []
+    for name, value in pairs:
+      if (name, value) in user_ids:
+        continue
+      if name in settings.AUTH_EXTERNAL_ATTRIBUTE_BINDING and not lookup_filter.is_external_miss(name, value):
+        external_queries[(name, value)] = (settings.AUTH_EXTERNAL_ATTRIBUTE_BINDING[name], value)
+        unknown_pairs.append((name, value))
+
+    external_data = _get_external_users_data(external_queries)
+    for username, user in external_users.iteritems():
+      user_data = external_data[username]
+      if user_data is not None:
+        for user_attribute in user.active_attributes:
+          user_data['attributes'].append({'name': user_attribute.attribute.name, 'value': user_attribute.value})
+      data[username] = user_data
+    # attributes of users fetched from external sources for the first time
+    fetched = {}
+    for pair in unknown_pairs:
+      if external_data[pair] is not None:
+        fetched.setdefault(external_data[pair]['username'], []).append(external_data[pair])
+    if fetched:
+      attributes = UserAttribute.objects.filter(user__username__in=fetched.keys(), disabled_at__isnull=True)
+      for username, name, value in attributes.values_list('user__username', 'attribute__name', 'value'):
+        for user_data in fetched[username]:
+          user_data['attributes'].append({'name': name, 'value': value})
+    for pair in unknown_pairs:
+      if external_data[pair] is None:
+        lookup_filter.remember_external_miss(*pair)
+
+    result = {'usernames': {}, 'attributes': {}}
+    for username in usernames:
+      result['usernames'][username] = data.get(username)
+    for name, value in pairs:
+      if (name, value) in user_ids:
+        # the user may have been deleted after the attribute lookup
+        user = users.get(user_ids[(name, value)])
+        user_data = data.get(user.username) if user else None
+      else:
+        user_data = external_data.get((name, value))
+      result['attributes'].setdefault(name, {})[value] = user_data
+    LOG.debug('/batch_query returning data', extra={'data': {'usernames': len(usernames), 'attributes': len(pairs)}})
+    return Response(result)
+
+
 class UserFilter(django_filters.FilterSet):
   municipality = django_filters.CharFilter(name='attendances__school__municipality__name', lookup_type='iexact')
   school = django_filters.CharFilter(name='attendances__school__name', lookup_type='iexact')
@@ -173,19 +387,13 @@ class UserFilter(django_filters.FilterSet):
   changed_at = django_filters.MethodFilter(action='timestamp_filter')
 
   def timestamp_filter(self, queryset, value):
-    # TODO: this is unaware of removed UserAttributes
+    # last_changed is bumped when attributes and attendances are removed too,
+    # so users who lost them are returned as well
     try:
-      tstamp = datetime.datetime.fromtimestamp(float(value))
+      tstamp = datetime.datetime.fromtimestamp(float(value), timezone.utc)
     except ValueError:
       return queryset.none()
-    by_user = Q(modified__gte=tstamp)
-    by_user_attribute = Q(attributes__modified__gte=tstamp)
-    by_attribute_name = Q(attributes__attribute__modified__gte=tstamp)
-    by_attendance = Q(attendances__modified__gte=tstamp)
-    by_role_name = Q(attendances__role__modified__gte=tstamp)
-    # SELECT DISTINCT ON ("authdata_user"."id") - makes this query perform a lot faster,
-    # but is ONLY compatible with PostgreSQL!
-    return queryset.filter(by_user | by_user_attribute | by_attribute_name | by_attendance | by_role_name).distinct('id')
+    return queryset.filter(last_changed__gte=tstamp)
 
   class Meta:
     model = User
@@ -202,37 +410,97 @@ class UserViewSet(viewsets.ModelViewSet):
 
   * ``municipality`` is a mandatory search parameter
   * ``school``, ``group`` and ``username`` are string parameters
-  * ``changed_at`` is a POSIX timestamp parameter. Only records changed after
-    this timestamp will be returned. When used with external datasources this
+  * ``changed_at`` is a POSIX timestamp parameter. Only users changed after
+    this timestamp, including users whose attributes or attendances were
+    removed, will be returned. When used with external datasources this
     parameter has no effect on results.
 
+  Users are paged with a ``cursor`` parameter, see
+  :py:mod:`authdata.pagination`.
+
+  Users of municipalities bound to an LDAP source are paged by the LDAP
+  server. Follow the ``next`` link, which carries a ``cursor`` parameter, to
+  get the next page. ``count`` is ``null`` when there is more than one page.
+  The cursor is continued by the server process which returned it; far into
+  a listing, another process answers 400 and the listing must be started
+  again.
+
   Example query: ``/api/1/user/?municipality=Esimerkkikunta&school=Keskustan%20koulu&group=7A&changed_at=1444398009``
   """
   queryset = User.objects.all().distinct()
   serializer_class = UserSerializer
   filter_backends = (filters.DjangoFilterBackend,)
   filter_class = UserFilter
+  pagination_class = IdCursorPagination
+
+  def get_queryset(self):
+    # Sources of the requesting client are resolved once, attributes of the
+    # whole page are then fetched with a single query by source id
+    data_sources = list(Source.objects.filter(name=self.request.user.username).values_list('id', flat=True))
+    queryset = super(UserViewSet, self).get_queryset()
+    return UserSerializer.setup_eager_loading(queryset, data_sources=data_sources)
 
   def list(self, request, *args, **kwargs):
     if 'municipality' in request.GET and request.GET['municipality'].lower() in [binding_name.lower() for binding_name in settings.AUTH_EXTERNAL_MUNICIPALITY_BINDING.keys()]:
       for binding_name, binding in settings.AUTH_EXTERNAL_MUNICIPALITY_BINDING.iteritems():
         if binding_name.lower() == request.GET['municipality'].lower():
-          source = settings.AUTH_EXTERNAL_SOURCES[binding]
+          external_source = binding
       try:
-        handler_module = importlib.import_module(source[0])
-        k = source[2]
-        handler = getattr(handler_module, source[1])(**k)
-        user_data = handler.get_user_data(request)
-        LOG.debug('/user returning data', extra={'data': {'user_data': repr(user_data)}})
-        return Response(user_data)
+        handler = registry.get_handler(external_source)
       except ImportError as e:
         LOG.error('Could not import external data source',
                 extra={'data': {'error': unicode(e)}})
         # TODO: error handling
         # flow back to normal implementation most likely return empty
+      except KeyError:
+        LOG.error('External source not configured', extra={'data': {'external_source': repr(external_source)}})
+      else:
+        try:
+          user_data = handler.get_user_data(request)
+        except CursorExpired:
+          return Response({'detail': 'The cursor has expired, start the listing again'}, status=400)
+        LOG.debug('/user returning data', extra={'data': {'user_data': repr(user_data)}})
+        return Response(user_data)
 
     return super(UserViewSet, self).list(request, *args, **kwargs)
 
+  @list_route(methods=['get'])
+  def export(self, request, *args, **kwargs):
+    """Streaming export of users
+
+    ``/api/1/user/export/`` accepts the same search parameters as the user
+    listing and returns all matching users in one response, one JSON object
+    per line (``application/x-ndjson``).
+
+    Users are read in primary key order in chunks of
+    ``AUTHDATA_EXPORT_CHUNK_SIZE`` with the attendances and attributes of
+    each chunk prefetched, so memory use does not grow with the number of
+    users. Users of municipalities bound to an external source can not be
+    exported.
+    """
+    municipality = request.GET.get('municipality', '').lower()
+    if municipality in [binding_name.lower() for binding_name in settings.AUTH_EXTERNAL_MUNICIPALITY_BINDING.keys()]:
+      return Response({'detail': 'Users of external sources can not be exported'}, status=400)
+    queryset = self.filter_queryset(self.get_queryset())
+    chunk_size = getattr(settings, 'AUTHDATA_EXPORT_CHUNK_SIZE', 1000)
+    response = StreamingHttpResponse(self._export_lines(queryset, chunk_size), content_type='application/x-ndjson')
+    response['Content-Disposition'] = 'attachment; filename="users.ndjson"'
+    return response
+
+  def _export_lines(self, queryset, chunk_size):
+    last_id = 0
+    context = self.get_serializer_context()
+    while True:
+      chunk = list(queryset.filter(pk__gt=last_id).order_by('pk')[:chunk_size])
+      if not chunk:
+        return
+      for user in chunk:
+        data = self.get_serializer_class()(user, context=context).data
+        yield json.dumps(data, cls=JSONEncoder, ensure_ascii=False).encode('utf-8') + '\n'
+      if len(chunk) < chunk_size:
+        return
+      last_id = chunk[-1].pk
+
 
 class AttributeViewSet(viewsets.ReadOnlyModelViewSet):
   queryset = Attribute.objects.all()
@@ -253,6 +521,7 @@ class UserAttributeViewSet(viewsets.ModelViewSet):
   serializer_class = UserAttributeSerializer
   filter_backends = (filters.DjangoFilterBackend,)
   filter_class = UserAttributeFilter
+  pagination_class = IdCursorPagination
 
   def destroy(self, request, *args, **kwargs):
     # UserAttribute is flagged as disabled
@@ -280,6 +549,7 @@ class RoleViewSet(viewsets.ReadOnlyModelViewSet):
 class AttendanceViewSet(viewsets.ModelViewSet):
   queryset = Attendance.objects.all()
   serializer_class = AttendanceSerializer
+  pagination_class = IdCursorPagination
 
 # vim: tabstop=2 expandtab shiftwidth=2 softtabstop=2
 
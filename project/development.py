@@ -81,6 +81,10 @@ if 'test' in sys.argv:
   TEST_RUNNER = 'django_nose.NoseTestSuiteRunner'
   BROKER_BACKEND = 'memory'
   CELERY_ALWAYS_EAGER = True
+  # Filters are built by a background thread, tests enable them explicitly
+  AUTHDATA_LOOKUP_FILTER = False
+  # One process, so the local-memory cache is shared by everything
+  AUTHDATA_QUERY_CACHE = 'default'
 
   PASSWORD_HASHERS = (
     'django.contrib.auth.hashers.MD5PasswordHasher',
@@ -133,6 +133,46 @@ REST_FRAMEWORK = {
 AUTH_EXTERNAL_SOURCES = {
 }
 
+# Users fetched from external sources are written to the database either
+# 'immediate'ly or 'deferred' to a background thread in bulk.
+# See authdata.datasources.provisioning
+AUTHDATA_PROVISIONING_MODE = 'immediate'
+AUTHDATA_PROVISIONING_QUEUE_SIZE = 10000
+AUTHDATA_PROVISIONING_BATCH_SIZE = 500
+AUTHDATA_PROVISIONING_FLUSH_INTERVAL = 2  # seconds
+AUTHDATA_PROVISIONING_DRAIN_INTERVAL = 60  # seconds
+# Number of provisioned users remembered to skip provisioning them again
+AUTHDATA_PROVISIONING_CACHE_SIZE = 100000
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+# Responses of /api/1/query are cached in this cache, see authdata.query_cache.
+# It must be shared by all processes, e.g. memcached. None disables caching.
+AUTHDATA_QUERY_CACHE = None
+AUTHDATA_QUERY_CACHE_TIMEOUT = 300  # seconds
+
+# Known attribute values are kept in Bloom filters so that queries for unknown
+# values skip the document lookup, see authdata.lookup_filter
+AUTHDATA_LOOKUP_FILTER = True
+AUTHDATA_LOOKUP_FILTER_ERROR_RATE = 0.01
+AUTHDATA_LOOKUP_FILTER_REBUILD_INTERVAL = 3600  # seconds
+AUTHDATA_LOOKUP_FILTER_SYNC_INTERVAL = 1  # seconds
+AUTHDATA_LOOKUP_FILTER_SYNC_MARGIN = 60  # seconds
+# Values not found from an external source are not asked again for
+AUTHDATA_EXTERNAL_MISS_TIMEOUT = 60  # seconds
+
+# Maximum number of usernames and attribute values in one batch query and
+# the number of threads querying external sources for one batch
+AUTHDATA_BATCH_QUERY_MAX_SIZE = 1000
+AUTHDATA_BATCH_QUERY_WORKERS = 10
+
+# Number of users read at a time by /api/1/user/export/
+AUTHDATA_EXPORT_CHUNK_SIZE = 1000
+
 # Dreamschool Data Source
 # {'Municipality: {'Organisation/School': 'organisation id in dreamschool'}}
 # Everything in lowercase